@@ -17,7 +17,7 @@ import random
 from requests.exceptions import HTTPError, SSLError, ConnectionError
 from requests.packages.urllib3.exceptions import NewConnectionError, MaxRetryError
 
-from utils import log_worker_configurer, log
+from utils import log_worker_configurer, log, CycleClock
 
 # Add dschelpers into our path
 import sys
@@ -27,12 +27,17 @@ from firebasemethods import FirebaseMethods
 from modbusmethods import ModbusMethods
 from analysemethods import AnalyseMethods
 from webanalyticsmethods import WebAnalyticsMethods
+from historystore import HistoryStore
+from ipc import SampleRing, Channel, wait, PUBLISH, LOSSLESS, LATEST
+
+# How long our workers sleep waiting for data before they check whether they have been stopped
+_WAIT_TIMEOUT = 1
 
 
 # This process will handle everything to do with Modbus communications
 class ModbusCommunications(ModbusMethods):
     def __init__(self, **kwargs):
-        super().__init__(kwargs['analyse_to_modbus_queue'])
+        super().__init__(kwargs['analyse_to_modbus_queue'], kwargs.get('e5_port', '/dev/serial0'))
 
         self.logger = None
 
@@ -44,30 +49,38 @@ class ModbusCommunications(ModbusMethods):
         # This will initialize the Modbus parameters
         # self.modbus_methods = ModbusMethods()
 
-        # Now unpack the queues we need
-        self.modbus_to_firebase_queue = kwargs['modbus_to_firebase_queue']
-        self.modbus_to_analyse_queue = kwargs['modbus_to_analyse_queue']
-        self.modbus_to_webanalytics_queue = kwargs['modbus_to_webanalytics_queue']
+        # Every sample we read goes into the shared memory ring, where the other processes read it
+        self.modbus_sample_ring = kwargs['modbus_sample_ring']
 
         self.log_queue = kwargs['log_queue']
 
-        # Define our stop events
+        # Define our stop event
         self._stop_event = kwargs['stop_event']
-        self._webanalytics_event = kwargs['webanalytics_event']
+
+        # We tick as fast as our fastest register group
+        self.cycle_clock = CycleClock(self.poll_scheduler.base_period)
 
     def stop(self):
         log('tried to stop modbus')
         self._stop_event.set()
-        self._webanalytics_event.set()
         log('Modbus stop signal set')
 
     def stopped(self):
         return self._stop_event.is_set()
 
+    def snapshot(self):
+        """ Returns the timing and failure statistics of our Modbus transactions and of our cycle clock """
+        return {'transactions': self.transaction_stats.snapshot(),
+                'cycle_clock': self.cycle_clock.stats()}
+
     def start_transmission(self):
         error_counter = 0
+
+        # Firebase and WebAnalytics still get one sample a second
+        self.cycle_clock.start()
+        last_published_second = None
+        next_stats_second = 600
         while True:
-            start = time.time()
             # log('start of a new cycle!', datetime.now())
 
             # Check if a flag has been raised to stop the process
@@ -77,24 +90,30 @@ class ModbusCommunications(ModbusMethods):
 
             try:
                 # This gets a dictionary of tuples of libraries that is ready to be uploaded to Firebase
-                # The structure of modbus_data is: # {modbus_data: (inverter_data, bt_data, dpm_data)}
+                # modbus_data is a ModbusSample holding the raw value of every register we read from the E5
                 modbus_data = self.get_modbus_data()
 
                 # if self.kill_counter == self.kill_count:
                 #     raise IOError
 
-                # Then we upload this to Firebase by adding the library to the queue.
-                self.modbus_to_firebase_queue.put(modbus_data)
+                # We flag the first sample of every second for Analyse, Firebase and WebAnalytics. The charge rate
+                # algorithm's window and ramp rate are tuned for one sample a second. If we overran and skipped a
+                # second, the next sample is still flagged and WebAnalytics integrates it over the time that it covers
+                current_second = int(self.cycle_clock.tick * self.cycle_clock.period)
+                if current_second != last_published_second:
+                    last_published_second = current_second
 
-                # Push the data to the Analyse process
-                self.modbus_to_analyse_queue.put(modbus_data)
+                    self.modbus_sample_ring.put(modbus_data, PUBLISH)
+                else:
+                    self.modbus_sample_ring.put(modbus_data)
 
-                # Push the data to the WebAnalytics process
-                self.modbus_to_webanalytics_queue.put(modbus_data)
-                self._webanalytics_event.set()
+                # Log how well we are keeping time and how our transactions are going every 10 minutes
+                if current_second >= next_stats_second:
+                    next_stats_second = current_second + 600
+                    log('Modbus snapshot:', self.snapshot())
 
-                end = time.time()
-                time.sleep(1 - (end - start))
+                # Sleep until our next tick. Overruns are logged and counted by the clock rather than treated as errors
+                self.cycle_clock.wait()
 
             # When we get an exception, we reinitialize the MODBUS library and keep going.
             except IOError as error:
@@ -105,6 +124,7 @@ class ModbusCommunications(ModbusMethods):
 
                 log("IO Error!")
                 log(error)
+                log('Modbus snapshot:', self.snapshot())
                 self.initiate_parameters(1, 5)
 
             except ValueError as error:
@@ -115,6 +135,7 @@ class ModbusCommunications(ModbusMethods):
 
                 log("Value Error!")
                 log(error)
+                log('Modbus snapshot:', self.snapshot())
                 self.initiate_parameters(1, 5)
 
     def run(self):
@@ -130,14 +151,13 @@ class FirebaseCommunications(FirebaseMethods, Process):
 
         self.log_queue = kwargs['log_queue']
 
-        # Define queues going into FirebaseCommunications
-        self.modbus_to_firebase_queue = kwargs['modbus_to_firebase_queue']
+        # Define queues going into FirebaseCommunications. We only read the Modbus samples that are flagged for publishing
+        self.modbus_reader = kwargs['modbus_sample_ring'].reader(PUBLISH)
         self.analyse_to_firebase_queue = kwargs['analyse_to_firebase_queue']
         self.webanalytics_to_firebase_queue = kwargs['webanalytics_to_firebase_queue']
         self.firebase_to_analyse_queue = kwargs['firebase_to_analyse_queue']
 
-        # Define multiprocessing events
-        self._webanalytics_event = kwargs['webanalytics_event']
+        # Define our stop event
         self._stop_event = kwargs['stop_event']
 
         # self.firebase = FirebaseMethods(kwargs['stop_event'], kwargs["firebase_to_analyse_queue"])
@@ -148,36 +168,77 @@ class FirebaseCommunications(FirebaseMethods, Process):
 
         log('Firebase broken')
         self._stop_event.set()
-        self._webanalytics_event.set()
 
     def stopped(self):
         return self._stop_event.is_set()
 
+    def channel_stats(self):
+        """ Returns how backed up each of our inputs is and how much each one has dropped """
+        stats = {'modbus': self.modbus_reader.stats(),
+                 'analyse': self.analyse_to_firebase_queue.stats(),
+                 'webanalytics': self.webanalytics_to_firebase_queue.stats(),
+                 'firebase_to_analyse': self.firebase_to_analyse_queue.stats()}
+        if self.uploader is not None:
+            stats['uploader'] = self.uploader.stats()
+        if self.http_session is not None:
+            stats['http'] = self.http_session.stats()
+        stats['live_database'] = self.live_database_encoder.stats()
+        if self.data_budget is not None:
+            stats['data_budget'] = self.data_budget.stats()
+        return stats
+
     def run(self):
         log_worker_configurer(self.log_queue)
+
+        # Our Firebase writes are sent from a thread in this process, over connections of our own
+        if self.http_session is not None:
+            self.http_session.after_fork()
+        if self.uploader is not None:
+            self.uploader.start()
+
+        # We log our channel stats every 10 minutes
+        next_stats_time = time.monotonic() + 600
         while True:
+            if time.monotonic() >= next_stats_time:
+                next_stats_time = time.monotonic() + 600
+                log('Firebase channels:', self.channel_stats())
+
+            # Write out any log rows that have been waiting too long
+            self.log_writers.flush_due()
+            if self.history_store is not None:
+                self.history_store.commit_due()
+
             # Check if a stop event has been raised and then break out
             if self.stopped():
                 log('Firebase broken')
+                log('Firebase channels:', self.channel_stats())
                 # Close our OCPP Websocket Client
                 self.ocpp_ws.stop()
                 break
 
-            try:
-                if not self.analyse_to_firebase_queue.empty():
-                    data_from_analyse = self.analyse_to_firebase_queue.get()
+            # Sleep until one of our inputs has something for us
+            wait([self.analyse_to_firebase_queue, self.modbus_reader, self.webanalytics_to_firebase_queue],
+                 _WAIT_TIMEOUT)
 
+            try:
+                analyse_messages = self.analyse_to_firebase_queue.get_all()
+                for i, data_from_analyse in enumerate(analyse_messages):
                     # If the data from analyze is a charging mode, then we have to update charge mode, not charge rate
                     if data_from_analyse in ['MAX_CHARGE_GRID', 'MAX_CHARGE_STANDALONE', 'PV_no_BT', 'PV_with_BT']:
                         self.update_external_sources(['update_charge_mode', data_from_analyse])
 
+                    # A charge rate that is followed by a newer one is out of date, so we skip it
+                    elif isinstance(data_from_analyse, dict) and i + 1 < len(analyse_messages) and \
+                            isinstance(analyse_messages[i + 1], dict):
+                        continue
+
                     # If the type is not a tuple then it is either a charge rate or start/stop
                     else:
                         self.update_external_sources(['update_charge_rate', data_from_analyse])
 
-                if not self.modbus_to_firebase_queue.empty():
-                    # First we get the data from our queue (remember: data is a tuple of dictionaries)
-                    modbus_data = self.modbus_to_firebase_queue.get()
+                # First we get the next sample from the ring (remember: data is a ModbusSample)
+                modbus_data = self.modbus_reader.get()
+                if modbus_data is not None:
                     # Then we send it to be uploaded to Firebase
                     self.update_external_sources(['modbus_data', modbus_data])
 
@@ -210,25 +271,37 @@ class FirebaseCommunications(FirebaseMethods, Process):
                 log('got a OS Error, laters', e, datetime.now())
                 self.stop()
 
+            # Send all of the Firebase writes that we made this time around together
+            if self.uploader is not None:
+                self.uploader.tick()
+
+        # Send what is left of our Firebase writes and make sure everything that we have logged is on the disk
+        if self.uploader is not None:
+            self.uploader.stop()
+        self.log_writers.close()
+        if self.history_store is not None:
+            self.history_store.close()
+
 
 # This process handles all charge rate calculations
 class Analyse(Process):
     def __init__(self, **kwargs):
         super().__init__()
 
-        self.modbus_to_analyse_queue = kwargs['modbus_to_analyse_queue']
+        # Analyse reads one Modbus sample a second, as _WINDOWSIZE and the charge rate ramps are per sample
+        self.modbus_reader = kwargs['modbus_sample_ring'].reader(PUBLISH)
         self.analyse_to_firebase_queue = kwargs['analyse_to_firebase_queue']
 
         # # self.analyse contains all of our analysis methods
         self.analyse = AnalyseMethods(kwargs['firebase_to_analyse_queue'], kwargs['analyse_to_modbus_queue'])
+        if kwargs['stdin_payload'].get('HISTORY_STORE') is not None:
+            self.analyse.history_store = HistoryStore(**kwargs['stdin_payload']['HISTORY_STORE'])
 
-        self._webanalytics_event = kwargs['webanalytics_event']
         self._stop_event = kwargs['stop_event']
 
     def stop(self):
         log('tried to stop analyse')
         self._stop_event.set()
-        self._webanalytics_event.set()
         log('analyse stop signal sent')
 
     def stopped(self):
@@ -238,18 +311,20 @@ class Analyse(Process):
         while True:
             if self.stopped():
                 log('Analyse broken')
+                self.analyse.log_writers.close()
+                if self.analyse.history_store is not None:
+                    self.analyse.history_store.close()
                 break
 
-            # When we see that the queue has been populated with something then we take action
-            if not self.modbus_to_analyse_queue.empty():
-                # First we get the data from our queue (remember: data is a tuple of dictionaries)
-                modbus_data = self.modbus_to_analyse_queue.get()
+            # Sleep until Modbus writes a new sample
+            wait([self.modbus_reader], _WAIT_TIMEOUT)
 
+            # When we see that the ring has a new sample then we take action (remember: data is a ModbusSample)
+            modbus_data = self.modbus_reader.get()
+            if modbus_data is not None:
                 charge_rate = self.analyse.make_decision(modbus_data)
                 self.analyse_to_firebase_queue.put(charge_rate)
 
-        time.sleep(0.10)
-
 
 # WebAnalytics process handles all calculations for analytics displayed on the web
 class WebAnalytics(WebAnalyticsMethods, Process):
@@ -262,15 +337,14 @@ class WebAnalytics(WebAnalyticsMethods, Process):
         self._LIMIT_DATA = stdin_payload['LIMIT_DATA']
 
         # Define the queues going in and out of webanalytics
-        self.modbus_to_webanalytics_queue = kwargs['modbus_to_webanalytics_queue']
+        self.modbus_reader = kwargs['modbus_sample_ring'].reader(PUBLISH)
         self.webanalytics_to_firebase_queue = kwargs['webanalytics_to_firebase_queue']
 
         # Define the log queue
         self.log_queue = kwargs['log_queue']
 
-        # Define our stop events
+        # Define our stop event
         self._stop_event = kwargs['stop_event']
-        self._webanalytics_event = kwargs['webanalytics_event']
 
         # (If we are online) This function makes sure our analytics are up to date in this program
         if self._ONLINE:
@@ -289,18 +363,14 @@ class WebAnalytics(WebAnalyticsMethods, Process):
             # log('Webanalytics at the start of loop', self.stopped())
             if self.stopped():
                 log('Webanalytics broken')
+                if self._ONLINE:
+                    self.save_analytics_checkpoint()
                 break
             # Wait for new data to come
-            self._webanalytics_event.wait()
-            # Check if a stop event has been raised and then break out
-            # log('Webanalytics after webanalytics event', self.stopped())
-            if self.stopped():
-                log('Webanalytics broken')
-                break
-
-            while not self.modbus_to_webanalytics_queue.empty():
-                new_data = self.modbus_to_webanalytics_queue.get()
+            wait([self.modbus_reader], _WAIT_TIMEOUT)
 
+            new_data = self.modbus_reader.get()
+            while new_data is not None:
                 if self._ONLINE:
                     # Call this function to update all our current analytics data (completely offline)
                     self.update_analytics(new_data)
@@ -312,8 +382,7 @@ class WebAnalytics(WebAnalyticsMethods, Process):
                     log('Webanalytics broken')
                     break
 
-            # Clear the event and wait for the next event to be signalled
-            self._webanalytics_event.clear()
+                new_data = self.modbus_reader.get()
 
 
 class LogListenerProcess(Process):
@@ -367,23 +436,22 @@ def main():
     # Read from stdin and get the data that has been sent from start.py
     stdin_payload = loads(stdin.read())
 
-    # Create our Queues to transmit information between processes
-    _modbus_to_firebase_queue = process_manager.Queue()
-    _modbus_to_analyse_queue = process_manager.Queue()
-    _modbus_to_webanalytics_queue = process_manager.Queue()
+    # Modbus samples go through a ring buffer in shared memory rather than through the manager
+    _modbus_sample_ring = SampleRing()
 
-    _analyse_to_modbus_queue = process_manager.Queue()
-    _analyse_to_firebase_queue = process_manager.Queue()
+    # Create our Queues to transmit information between processes. Only the newest operation mode and analytics matter,
+    # but every control message from Firebase has to get through, and so does every charge mode and stop from Analyse
+    # (they share a channel with the charge rates)
+    _analyse_to_modbus_queue = Channel(LATEST)
+    _analyse_to_firebase_queue = Channel(LOSSLESS)
 
-    _firebase_to_modbus_queue = process_manager.Queue()
-    _firebase_to_analyse_queue = process_manager.Queue()
+    _firebase_to_modbus_queue = Channel(LOSSLESS)
+    _firebase_to_analyse_queue = Channel(LOSSLESS)
 
-    _webanalytics_to_firebase_queue = process_manager.Queue()
+    _webanalytics_to_firebase_queue = Channel(LATEST)
 
     # Package it into one dictionary
-    queue_kwargs = {"modbus_to_firebase_queue": _modbus_to_firebase_queue,
-                    "modbus_to_analyse_queue": _modbus_to_analyse_queue,
-                    'modbus_to_webanalytics_queue': _modbus_to_webanalytics_queue,
+    queue_kwargs = {'modbus_sample_ring': _modbus_sample_ring,
 
                     "analyse_to_modbus_queue": _analyse_to_modbus_queue,
                     "analyse_to_firebase_queue": _analyse_to_firebase_queue,
@@ -398,13 +466,18 @@ def main():
 
     queue_kwargs.update({'stdin_payload': stdin_payload})
 
+    # If we have been asked to, talk to an emulated E5 instead of the real one. The payload holds the E5Emulator
+    # arguments, eg. {"log_path": "../data/logs/2019-01-01.csv", "speed": 10, "faults": {"timeout": 0.01}}
+    e5_emulator = None
+    if stdin_payload.get('E5_EMULATOR') is not None:
+        from e5emulator import E5Emulator
+        e5_emulator = E5Emulator(**stdin_payload['E5_EMULATOR'])
+        queue_kwargs.update({'e5_port': e5_emulator.start()})
+
     # Create a multiprocessing stop event. This event will be raised whenever any process has an exception
     _stop_event = process_manager.Event()
-    _webanalytics_event = process_manager.Event()
 
-    queue_kwargs.update({'stop_event': _stop_event,
-                         'webanalytics_event': _webanalytics_event,
-                         })
+    queue_kwargs.update({'stop_event': _stop_event})
 
     # Define and start our processes
     webanalytics_process = WebAnalytics(**queue_kwargs)
@@ -507,6 +580,10 @@ def main():
     firebasecommunications_process.refresh_timer.cancel()
     log('refresh timer cancelled', firebasecommunications_process.refresh_timer, datetime.now())
 
+    if e5_emulator is not None:
+        e5_emulator.stop()
+        log('E5 emulator stopped')
+
     # Check what other threads are still running
     log(threading.enumerate())
 
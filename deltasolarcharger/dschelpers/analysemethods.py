@@ -2,15 +2,172 @@ import random
 import csv
 import os
 
-from statistics import stdev
 import numpy as np
 
-from math import floor
-from statistics import mean
+from math import floor, log as ln
 from collections import deque
 from datetime import datetime
 
 from utils import log
+from logwriter import LogWriters
+
+# The dynamic buffer curves of each buffer aggressiveness setting (see tests/dynamic_buffer_calculations.py). Each curve
+# is (polynomial coefficients of log(sd / mean) giving the buffer in %, sd / mean above which the curve is not used,
+# buffer above that point). Standalone is used whenever the inverter is in Stand Alone
+BUFFER_CURVES = {
+    'Aggressive': ((17.5, 3.64807365, 0.1886117), 0.1, 0.1),
+    'Balanced': ((35.25, 7.70872705, 0.42437632), 0.1, 0.20),
+    'Conservative': ((49.25, 6.53613195, 0.14145877), 0.1, 0.35),
+    'Standalone': ((49.25, 6.53613195, 0.14145877), 0.1, 0.35),
+}
+
+
+class BufferTable:
+    """ A dynamic buffer curve (see BUFFER_CURVES) precomputed into a table over log(z), where z is sd / mean of the PV
+    window. Looking a buffer up interpolates between two entries of the table, so it doesn't need NumPy or allocate any
+    arrays. Values of z below the table fall back to evaluating the polynomial """
+
+    # The number of entries in the table, and the smallest z that it covers
+    _SIZE = 1024
+    _MIN_Z = 1e-6
+
+    def __init__(self, coefficients, clamp_z, clamp_buffer):
+        self.coefficients = tuple(float(c) for c in coefficients)
+        self.clamp_z = float(clamp_z)
+        self.clamp_buffer = float(clamp_buffer)
+        if not self.clamp_z > self._MIN_Z:
+            raise ValueError('clamp_z must be greater than ' + str(self._MIN_Z))
+
+        self._log_min_z = ln(self._MIN_Z)
+        self._step = (ln(self.clamp_z) - self._log_min_z) / (self._SIZE - 1)
+        self._table = [self.evaluate(self._log_min_z + i * self._step) for i in range(self._SIZE)]
+
+    @classmethod
+    def from_curve(cls, curve):
+        """ Creates a table from a curve in the form used by BUFFER_CURVES, or from a dictionary with coefficients,
+        clamp_z and clamp_buffer keys (as sent through Firebase) """
+        if isinstance(curve, dict):
+            coefficients = curve['coefficients']
+            # Firebase may turn a list into a dictionary keyed by index
+            if isinstance(coefficients, dict):
+                coefficients = [coefficients[key] for key in sorted(coefficients, key=int)]
+            return cls(coefficients, curve['clamp_z'], curve['clamp_buffer'])
+
+        return cls(*curve)
+
+    def evaluate(self, log_z):
+        """ Evaluates the curve's polynomial at log(z), as a fraction that is never below 0 """
+        buffer = 0.0
+        for coefficient in reversed(self.coefficients):
+            buffer = buffer * log_z + coefficient
+
+        return max(buffer / 100, 0.0)
+
+    def lookup(self, z):
+        if z > self.clamp_z:
+            return self.clamp_buffer
+
+        if z < self._MIN_Z:
+            return self.evaluate(ln(z))
+
+        position = (ln(z) - self._log_min_z) / self._step
+        index = int(position)
+        if index >= self._SIZE - 1:
+            return self._table[-1]
+
+        lower = self._table[index]
+        return lower + (self._table[index + 1] - lower) * (position - index)
+
+
+class RollingWindowStats:
+    """ Keeps the mean, sample standard deviation and exponentially weighted average of a sliding window of values,
+    updating them in O(1) for every value that is appended. The weighted average gives the newest value a weight of
+    damping_factor, the one before it damping_factor * (1 - damping_factor) and so on """
+
+    # How many appends we do before recomputing everything from the window, to stop rounding errors building up
+    _RESYNC_INTERVAL = 512
+
+    def __init__(self, window_size, damping_factor=0.6):
+        self.window_size = window_size
+        self.damping_factor = damping_factor
+
+        self.window = deque([], window_size)
+
+        # The weights of the window from oldest to newest, and the weight the oldest value has when it drops out
+        self._weights = np.array([damping_factor * (1 - damping_factor) ** (window_size - 1 - i)
+                                  for i in range(window_size)])
+        self._dropped_weight = damping_factor * (1 - damping_factor) ** window_size
+
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._weighted_sum = 0.0
+        self._appends_since_resync = 0
+
+        # How many times in a row the same value has been appended
+        self._run_length = 0
+
+    def __len__(self):
+        return len(self.window)
+
+    def __iter__(self):
+        return iter(self.window)
+
+    def append(self, value):
+        value = float(value)
+        d = self.damping_factor
+
+        if len(self.window) < self.window_size:
+            # The window is still filling up, so this is a normal running mean and variance (Welford)
+            self.window.append(value)
+            delta = value - self._mean
+            self._mean += delta / len(self.window)
+            self._m2 += delta * (value - self._mean)
+            self._weighted_sum = d * value + (1 - d) * self._weighted_sum
+
+        else:
+            # Slide the window along, swapping the oldest value for the new one
+            oldest = self.window[0]
+            self.window.append(value)
+            old_mean = self._mean
+            self._mean += (value - oldest) / self.window_size
+            self._m2 += (value - oldest) * (value - self._mean + oldest - old_mean)
+            self._weighted_sum = d * value + (1 - d) * self._weighted_sum - self._dropped_weight * oldest
+
+        self._run_length = self._run_length + 1 if len(self.window) > 1 and value == self.window[-2] else 1
+
+        # If the window is full of the same value (eg. 0.01 when we have no PV), its variance is exactly 0. We make sure
+        # of that here so that rounding errors from earlier values don't give us a tiny standard deviation instead
+        if self._run_length >= len(self.window):
+            self._mean = value
+            self._m2 = 0.0
+
+        self._appends_since_resync += 1
+        if self._appends_since_resync >= self._RESYNC_INTERVAL:
+            self.resync()
+
+    def resync(self):
+        """ Recomputes our statistics from the values in the window """
+        values = np.array(self.window)
+        self._mean = float(values.mean()) if len(values) else 0.0
+        self._m2 = float(((values - self._mean) ** 2).sum())
+        self._weighted_sum = float(np.dot(values, self._weights[self.window_size - len(values):]))
+        self._appends_since_resync = 0
+
+    def mean(self):
+        return self._mean
+
+    def variance(self):
+        """ The sample variance of the window (0 if there are less than 2 values) """
+        if len(self.window) < 2:
+            return 0.0
+
+        return max(self._m2, 0.0) / (len(self.window) - 1)
+
+    def stdev(self):
+        return self.variance() ** 0.5
+
+    def weighted_average(self):
+        return self._weighted_sum
 
 
 class AnalyseMethods:
@@ -84,10 +241,20 @@ class AnalyseMethods:
         # Do we want to log? Only log when we are testing standalone modes
         self._LOG = True
 
+        # Our open analytics log file
+        self.log_writers = LogWriters()
+
+        # The optional SQLite store that our analytics rows also go to (see historystore)
+        self.history_store = None
+
         self._CALIBRATE_DONE = False
 
-        # Create a deque of length windowsize. Will allow us to automatically pop and insert values
-        self.pv_window = deque([], self._WINDOWSIZE)
+        # The dynamic buffer curve of every buffer aggressiveness setting, precomputed into tables. Firebase can add
+        # new ones through buffer_aggro_mode
+        self.buffer_tables = dict((name, BufferTable.from_curve(curve)) for name, curve in BUFFER_CURVES.items())
+
+        # Create a rolling window of length windowsize. It keeps the window's statistics up to date as we insert values
+        self.pv_window = RollingWindowStats(self._WINDOWSIZE, damping_factor=0.6)
 
         # Todo: Implement load balancing when winding down
         self.charging_wind_down_dict = dict()
@@ -113,64 +280,58 @@ class AnalyseMethods:
 
     @staticmethod
     def condition_data(data):
-        inverter_data_temp = data[0]
-
+        # data is a ModbusSample of raw register values
         final_data = dict()
-        final_data['ac1v'] = inverter_data_temp['ac1_voltage'] / 10
-        final_data['ac1c'] = inverter_data_temp['ac1_current'] / 100
-        final_data['ac1p'] = inverter_data_temp['ac1_power']
+        final_data['ac1v'] = data.ac1_voltage / 10
+        final_data['ac1c'] = data.ac1_current / 100
+        final_data['ac1p'] = float(data.ac1_power)
 
-        final_data['ac2v'] = inverter_data_temp['ac2_voltage'] / 10
-        final_data['ac2c'] = inverter_data_temp['ac2_current'] / 100
-        final_data['ac2p'] = inverter_data_temp['ac2_power']
+        final_data['ac2v'] = data.ac2_voltage / 10
+        final_data['ac2c'] = data.ac2_current / 100
+        final_data['ac2p'] = float(data.ac2_power)
 
-        final_data['dc1v'] = inverter_data_temp['dc1_voltage'] / 10
-        final_data['dc1c'] = inverter_data_temp['dc1_current'] / 100
-        final_data['dc1p'] = inverter_data_temp['dc1_power']
+        final_data['dc1v'] = data.dc1_voltage / 10
+        final_data['dc1c'] = data.dc1_current / 100
+        final_data['dc1p'] = float(data.dc1_power)
 
-        final_data['dc2v'] = inverter_data_temp['dc2_voltage'] / 10
-        final_data['dc2c'] = inverter_data_temp['dc2_current'] / 100
-        final_data['dc2p'] = inverter_data_temp['dc2_power']
-        final_data['inverter_op_mode'] = inverter_data_temp['inverter_op_mode']
-        final_data['inverter_status'] = inverter_data_temp['inverter_status']
+        final_data['dc2v'] = data.dc2_voltage / 10
+        final_data['dc2c'] = data.dc2_current / 100
+        final_data['dc2p'] = float(data.dc2_power)
+        final_data['inverter_op_mode'] = data.operation_mode
+        final_data['inverter_status'] = data.status
 
-        final_data['btsoc'] = data[1]['bt_soc'] / 10
+        final_data['btsoc'] = data.bt_soc / 10
 
-        final_data['bt_module1_temp_max'] = data[1]['bt_module1_temp_max'] / 10
+        final_data['bt_module1_temp_max'] = data.bt_module1_temp_max / 10
 
         return final_data
 
-    @staticmethod
-    def take_weighted_average(window, window_size, damping_factor):
-        # Create an array out of the deque
-        window = np.array(list(window))
-        # Create an array for the weights
-        weights = np.empty(window_size)
-        for i in range(window_size):
-            weights[i] = damping_factor * (1 - damping_factor) ** i
-
-        return sum(np.multiply(window, np.flip(weights, 0)))
-
     def log_data(self, data, approx_dc_current, pv_window_mean, z_stats):
         # Logging code
         if self._LOG:
             current_time = datetime.now()
             _LOG_FILE_NAME = current_time.strftime('%Y-%m-%d')
-            with open('../data/analytics_logs/' + _LOG_FILE_NAME + '.csv', 'a') as f:
-                writer = csv.writer(f)
-                writer.writerow(
-                    [current_time.strftime('%Y-%M-%d %H:%M:%S'), str(data['dc1p']), str(data['dc2p']),
-                     str(data['dc1v']), str(data['dc2v']), str(data['dc1c']), str(data['dc2c']), str(approx_dc_current),
-                     str(pv_window_mean), z_stats[0], z_stats[1], str(self._BUFFER),
-                     str(self._CURRENT_CHARGE_RATE), str(floor(self._CURRENT_CHARGE_RATE))
-                     ])
+            self.log_writers.writerow(
+                'analytics', '../data/analytics_logs/' + _LOG_FILE_NAME + '.csv',
+                [current_time.strftime('%Y-%M-%d %H:%M:%S'), str(data['dc1p']), str(data['dc2p']),
+                 str(data['dc1v']), str(data['dc2v']), str(data['dc1c']), str(data['dc2c']), str(approx_dc_current),
+                 str(pv_window_mean), z_stats[0], z_stats[1], str(self._BUFFER),
+                 str(self._CURRENT_CHARGE_RATE), str(floor(self._CURRENT_CHARGE_RATE))
+                 ])
+
+            if self.history_store is not None:
+                self.history_store.insert_analytics_row(
+                    current_time.timestamp(),
+                    (data['dc1p'], data['dc2p'], data['dc1v'], data['dc2v'], data['dc1c'], data['dc2c'],
+                     approx_dc_current, pv_window_mean, z_stats[0], z_stats[1], self._BUFFER,
+                     self._CURRENT_CHARGE_RATE, floor(self._CURRENT_CHARGE_RATE)))
 
     def get_standalone_buffer(self):
         """ This method calculates the buffer for the charge rate when the inverter is in standalone mode """
 
         # Take the coefficient of variance
-        sd = stdev(self.pv_window)
-        z = sd / mean(self.pv_window)
+        sd = self.pv_window.stdev()
+        z = sd / self.pv_window.mean()
 
         # Add this here so we never divide by 0
         if z == 0:
@@ -187,41 +348,21 @@ class AnalyseMethods:
         """ This method calculates a dynamic buffer for the charge rate in PV_with_BT mode """
 
         # Take the coefficient of variance
-        sd = stdev(self.pv_window)
-        z = sd / mean(self.pv_window)
+        sd = self.pv_window.stdev()
+        z = sd / self.pv_window.mean()
 
         # Add this here so we never divide by 0
         if z == 0:
             z = 0.001
 
-        if not standalone_mode:
-            if self._BUFFER_AGGRESSIVENESS == "Aggressive":
-                self._BUFFER = (np.polynomial.polynomial.polyval(np.log(z),
-                                                                 np.array([17.5, 3.64807365, 0.1886117]))) / 100
-                if z > 0.1:
-                    self._BUFFER = 0.1
-
-            if self._BUFFER_AGGRESSIVENESS == "Balanced":
-                self._BUFFER = (np.polynomial.polynomial.polyval(np.log(z),
-                                                                 np.array([35.25, 7.70872705, 0.42437632]))) / 100
-                if z > 0.1:
-                    self._BUFFER = 0.20
-
-            elif self._BUFFER_AGGRESSIVENESS == "Conservative":
-                self._BUFFER = (np.polynomial.polynomial.polyval(np.log(z),
-                                                                 np.array([49.25, 6.53613195, 0.14145877]))) / 100
-                if z > 0.1:
-                    self._BUFFER = 0.35
-
+        if standalone_mode:
+            buffer_table = self.buffer_tables['Standalone']
         else:
-            self._BUFFER = (np.polynomial.polynomial.polyval(np.log(z),
-                                                             np.array([49.25, 6.53613195, 0.14145877]))) / 100
-            if z > 0.1:
-                self._BUFFER = 0.35
+            buffer_table = self.buffer_tables.get(self._BUFFER_AGGRESSIVENESS)
 
-        # Make sure buffer is not below 0
-        if self._BUFFER < 0:
-            self._BUFFER = 0
+        # The tables never give a buffer below 0
+        if buffer_table is not None:
+            self._BUFFER = buffer_table.lookup(z)
 
         return sd, z
 
@@ -258,7 +399,7 @@ class AnalyseMethods:
         # log('Our current window is: ', list(self.pv_window))
 
         # Take the weighted average of the current window
-        pv_window_mean = self.take_weighted_average(self.pv_window, self._WINDOWSIZE, damping_factor=0.6)
+        pv_window_mean = self.pv_window.weighted_average()
 
         # Apply the buffer to the weighted average if we are in standalone mode
         if data['inverter_status'] == "Stand Alone":
@@ -500,7 +641,7 @@ class AnalyseMethods:
                 # ******************************************************************************************************
 
                 # Take the weighted average of the current window
-                pv_window_mean = self.take_weighted_average(self.pv_window, self._WINDOWSIZE, damping_factor=0.6)
+                pv_window_mean = self.pv_window.weighted_average()
 
                 # Apply the buffer to the weighted average if we are in standalone mode
                 if inverter_status == "Stand Alone":
@@ -642,7 +783,7 @@ class AnalyseMethods:
                     # log('Our current window is: ', list(self.pv_window))
 
                     # Take the weighted average of the current window
-                    pv_window_mean = self.take_weighted_average(self.pv_window, self._WINDOWSIZE, damping_factor=0.6)
+                    pv_window_mean = self.pv_window.weighted_average()
 
                     # Apply the buffer to our PV window
                     pv_window_mean = pv_window_mean * (1 - self._BUFFER)
@@ -892,6 +1033,22 @@ class AnalyseMethods:
         # log('Charge Rate Increase', self._CHARGE_RATE_INCREASE)
         # log('Charge Rate Decrease', self._CHARGE_RATE_DECREASE)
 
+    def change_buffer_aggressiveness(self, buffer_aggro_mode):
+        """ Changes the buffer aggressiveness setting. buffer_aggro_mode is either the name of a setting, or a custom
+        curve: a dictionary with a name, coefficients, clamp_z and clamp_buffer (see BufferTable.from_curve). A custom
+        curve is precomputed into a table here and replaces any earlier table with the same name """
+        if isinstance(buffer_aggro_mode, dict):
+            try:
+                name = str(buffer_aggro_mode.get('name', 'Custom'))
+                self.buffer_tables[name] = BufferTable.from_curve(buffer_aggro_mode)
+            except (KeyError, ValueError, TypeError) as error:
+                log('Invalid buffer curve', buffer_aggro_mode, error)
+                return
+            buffer_aggro_mode = name
+
+        log('Buffer aggressiveness changed to', buffer_aggro_mode)
+        self._BUFFER_AGGRESSIVENESS = buffer_aggro_mode
+
     def make_decision(self, modbus_data):
 
         # Check for any new data from Firebase/OCPP WS
@@ -913,8 +1070,7 @@ class AnalyseMethods:
 
             # If our purpose it to change the buffer aggressiveness mode, we just update the variable
             elif purpose == "buffer_aggro_change":
-                log('Buffer aggressiveness changed to', payload['buffer_aggro_mode'])
-                self._BUFFER_AGGRESSIVENESS = payload['buffer_aggro_mode']
+                self.change_buffer_aggressiveness(payload['buffer_aggro_mode'])
 
             elif purpose == "metervalue_current":
                 temp_charger_id = payload['chargerID']
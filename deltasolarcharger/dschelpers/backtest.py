@@ -0,0 +1,218 @@
+import glob
+import time
+from queue import Queue
+
+import analysemethods
+from analysemethods import AnalyseMethods
+from daystore import iter_log_rows
+from modbussample import ModbusSample, csv_row_to_registers, UNLOGGED_REGISTERS, OPERATION_MODES, INVERTER_STATUSES
+
+
+def load_day_log(log_path, inverter_status=2):
+    """ Yields a ModbusSample for every row of one of our day logs (csv or day file). Registers that we don't log are
+    filled in from UNLOGGED_REGISTERS, apart from the inverter status which can be chosen (2 is On Grid, 6 is Stand
+    Alone) """
+
+    defaults = dict(UNLOGGED_REGISTERS)
+    defaults['inverter_status'] = inverter_status
+
+    for timestamp, row in iter_log_rows(log_path):
+        try:
+            registers = dict(defaults)
+            registers.update(csv_row_to_registers(row))
+        except (ValueError, TypeError, KeyError):
+            # Skip any corrupted rows
+            continue
+
+        yield ModbusSample.from_registers(timestamp, registers)
+
+
+class BacktestAnalyseMethods(AnalyseMethods):
+    """ AnalyseMethods with some of its parameters pinned. update_algorithm_variables sets the thresholds and charge
+    rate steps on every decision, so we put our overrides back after it has run """
+
+    def __init__(self, overrides=None):
+        self.overrides = dict(overrides) if overrides else dict()
+        super().__init__(Queue(), Queue())
+        self._LOG = False
+        self.apply_overrides()
+
+    def apply_overrides(self):
+        for name, value in self.overrides.items():
+            setattr(self, name, value)
+
+    def update_algorithm_variables(self, inverter_status):
+        super().update_algorithm_variables(inverter_status)
+        self.apply_overrides()
+
+
+class Backtest:
+    """ Replays day logs through AnalyseMethods.make_decision as fast as we can, with a number of simulated chargers
+    that are always plugged in and charging. Each decision is applied for the time until the next row of the log.
+
+    Energy model: the simulated chargers draw rate * AC2 voltage. They are fed from the logged PV first, then from the
+    battery (up to max_battery_power) and then from the grid. In Stand Alone there is no grid, so anything left over is
+    counted as unserved. The battery SOC and temperatures that the algorithm sees are the logged ones, so the battery
+    doesn't respond to what the simulated chargers draw """
+
+    # Our day logs have one row every 2 seconds. If there is a bigger gap than _MAX_ROW_GAP between two rows (the
+    # system was off), we only count _ROW_PERIOD worth of energy for the row before it
+    _ROW_PERIOD = 2
+    _MAX_ROW_GAP = 10
+
+    # The throttle flags of AnalyseMethods that we count the activations of
+    _THROTTLE_FLAGS = ('_TEMP_THROTTLED', '_BTSOC_THROTTLED', '_DRAIN_MODE_ACTIVATED')
+
+    def __init__(self, num_chargers=1, charging_mode='PV_with_BT', buffer_aggressiveness='Balanced',
+                 inverter_status=2, max_battery_power=13.5 * 240, overrides=None):
+        self.num_chargers = num_chargers
+        self.inverter_status = inverter_status
+        self.max_battery_power = max_battery_power
+
+        self.analyse_methods = BacktestAnalyseMethods(overrides)
+        self.analyse_methods._CHARGING_MODE = charging_mode
+        self.analyse_methods._BUFFER_AGGRESSIVENESS = buffer_aggressiveness
+        self.analyse_methods.charger_list = dict(('SIM-' + str(i + 1), {'charging': True}) for i in range(num_chargers))
+
+        # The operation mode that the algorithm has asked the inverter to be in
+        self.op_mode = UNLOGGED_REGISTERS['inverter_op_mode']
+        self._op_mode_numbers = dict((name, number) for number, name in OPERATION_MODES.items())
+
+        self.results = {
+            'rows': 0,
+            'hours': 0.0,
+            'pv_kwh': 0.0,
+            'delivered_kwh': 0.0,
+            'from_pv_kwh': 0.0,
+            'from_battery_kwh': 0.0,
+            'grid_import_kwh': 0.0,
+            'unserved_kwh': 0.0,
+            'stopped_decisions': 0,
+            'op_mode_changes': 0,
+            'throttle_events': dict((flag.strip('_').lower(), 0) for flag in self._THROTTLE_FLAGS),
+        }
+
+    def run(self, log_paths):
+        """ Replays every day log in log_paths, in order. Returns our results """
+        for log_path in log_paths:
+            self.run_day(log_path)
+
+        return self.results
+
+    def run_day(self, log_path):
+        previous_sample = None
+        previous_decision = None
+        for sample in load_day_log(log_path, self.inverter_status):
+            # Apply the inverter operation mode that the algorithm asked for on the last row
+            sample = sample._replace(inverter_op_mode=self.op_mode)
+
+            if previous_sample is not None:
+                self.account(previous_sample, previous_decision, sample.time - previous_sample.time)
+
+            previous_decision = self.decide(sample)
+            previous_sample = sample
+
+        if previous_sample is not None:
+            self.account(previous_sample, previous_decision, self._ROW_PERIOD)
+
+    def decide(self, sample):
+        """ Runs the algorithm on a sample and keeps track of the state changes that it makes """
+        analyse_methods = self.analyse_methods
+        flags_before = [getattr(analyse_methods, flag) for flag in self._THROTTLE_FLAGS]
+
+        decision = analyse_methods.make_decision(sample)
+
+        for flag, before in zip(self._THROTTLE_FLAGS, flags_before):
+            if getattr(analyse_methods, flag) and not before:
+                self.results['throttle_events'][flag.strip('_').lower()] += 1
+
+        while not analyse_methods.analyze_to_modbus_queue.empty():
+            payload = analyse_methods.analyze_to_modbus_queue.get()
+            op_mode = self._op_mode_numbers.get(payload['inverter_op_mode'], self.op_mode)
+            if op_mode != self.op_mode:
+                self.op_mode = op_mode
+                self.results['op_mode_changes'] += 1
+
+        return decision
+
+    def account(self, sample, decision, duration):
+        """ Adds up the energy flows of a decision that was in force for duration seconds """
+        if not 0 < duration <= self._MAX_ROW_GAP:
+            duration = self._ROW_PERIOD
+        hours = duration / 3600
+
+        results = self.results
+        results['rows'] += 1
+        results['hours'] += hours
+
+        pv_power = float(sample.dc1_power + sample.dc2_power)
+        results['pv_kwh'] += pv_power * hours / 1000
+
+        charge_power = 0.0
+        if decision == 'stop' or not isinstance(decision, dict):
+            results['stopped_decisions'] += 1
+        else:
+            for rate in decision['charge_rates'].values():
+                if rate == 'stop':
+                    results['stopped_decisions'] += 1
+                else:
+                    charge_power += rate * sample.ac2_voltage / 10
+
+        from_pv = min(charge_power, pv_power)
+        from_battery = min(charge_power - from_pv, self.max_battery_power) if sample.bt_soc > 0 else 0.0
+        shortfall = charge_power - from_pv - from_battery
+
+        results['delivered_kwh'] += charge_power * hours / 1000
+        results['from_pv_kwh'] += from_pv * hours / 1000
+        results['from_battery_kwh'] += from_battery * hours / 1000
+        if INVERTER_STATUSES.get(sample.inverter_status) == 'Stand Alone':
+            results['unserved_kwh'] += shortfall * hours / 1000
+            results['delivered_kwh'] -= shortfall * hours / 1000
+        else:
+            results['grid_import_kwh'] += shortfall * hours / 1000
+
+
+def parse_override(text):
+    """ Converts NAME=VALUE into (NAME, value), where value is a number if it looks like one """
+    name, value = text.split('=', 1)
+    try:
+        value = float(value)
+    except ValueError:
+        pass
+
+    return name, value
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replay day logs through the charge rate algorithm')
+    parser.add_argument('logs', nargs='*', help='day logs to replay (default: every log in ../data/logs)')
+    parser.add_argument('--chargers', type=int, default=1, help='number of simulated chargers')
+    parser.add_argument('--mode', default='PV_with_BT', help='charging mode')
+    parser.add_argument('--aggressiveness', default='Balanced', help='buffer aggressiveness')
+    parser.add_argument('--standalone', action='store_true', help='replay as if the inverter was in Stand Alone')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override an AnalyseMethods parameter, e.g. --set _CHARGE_RATE_INCREASE=1.1')
+    args = parser.parse_args()
+
+    paths = args.logs or sorted(glob.glob('../data/logs/*.csv'))
+    if not paths:
+        sys.exit('No day logs to replay')
+
+    # The algorithm logs on most decisions, which would take longer than the decisions themselves
+    analysemethods.log = lambda *_args, **_kwargs: None
+
+    backtest = Backtest(num_chargers=args.chargers, charging_mode=args.mode,
+                        buffer_aggressiveness=args.aggressiveness, inverter_status=6 if args.standalone else 2,
+                        overrides=dict(parse_override(item) for item in args.set))
+
+    start_time = time.perf_counter()
+    results = backtest.run(paths)
+    elapsed = time.perf_counter() - start_time
+
+    for key, value in results.items():
+        print(key + ':', round(value, 3) if isinstance(value, float) else value)
+    print('Replayed', round(results['hours'], 1), 'hours in', round(elapsed, 1), 'seconds (' +
+          str(round(results['hours'] * 3600 / max(elapsed, 1e-9))) + 'x real time)')
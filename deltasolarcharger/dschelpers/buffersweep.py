@@ -0,0 +1,266 @@
+import glob
+import itertools
+
+import numpy as np
+
+from analysemethods import BUFFER_CURVES
+from backtest import Backtest
+from daystore import read_day, iter_log_rows
+
+
+def load_pv_traces(log_paths):
+    """ Loads the rows of our day logs (csv or day files) that the PV tracking algorithm needs. Returns a dictionary of
+    (days, rows) arrays: dc_current (the approximate PV current that AnalyseMethods puts in its window), pv_power,
+    ac2_voltage and duration (how long each row lasts, in seconds). Shorter days are padded with rows that have no
+    duration """
+
+    days = list()
+    for log_path in log_paths:
+        if log_path.endswith('.day'):
+            # Day files can be used as they are
+            records = read_day(log_path)
+            records = records[records['ac2v'] > 0]
+            times = records['time']
+            pv_power = records['dc1p'].astype(float) + records['dc2p']
+            ac2_voltage = records['ac2v'].astype(float)
+
+        else:
+            times, pv_power, ac2_voltage = list(), list(), list()
+            for time_value, row in iter_log_rows(log_path):
+                try:
+                    pv = float(row['dc1p']) + float(row['dc2p'])
+                    voltage = float(row['ac2v'])
+                except (ValueError, TypeError, KeyError):
+                    # Skip any corrupted rows
+                    continue
+
+                # AnalyseMethods can't make a decision without an AC2 voltage
+                if voltage <= 0:
+                    continue
+
+                times.append(time_value)
+                pv_power.append(pv)
+                ac2_voltage.append(voltage)
+
+        if len(times):
+            # Each row lasts until the next one, unless the system was off in between (see Backtest.account)
+            duration = np.append(np.diff(times), Backtest._ROW_PERIOD)
+            duration[(duration <= 0) | (duration > Backtest._MAX_ROW_GAP)] = Backtest._ROW_PERIOD
+            days.append((np.array(pv_power), np.array(ac2_voltage), duration))
+
+    rows = max(len(day[0]) for day in days) if days else 0
+    traces = {'pv_power': np.zeros((len(days), rows)), 'ac2_voltage': np.full((len(days), rows), 240.0),
+              'duration': np.zeros((len(days), rows))}
+    for i, (pv_power, ac2_voltage, duration) in enumerate(days):
+        traces['pv_power'][i, :len(pv_power)] = pv_power
+        traces['ac2_voltage'][i, :len(pv_power)] = ac2_voltage
+        traces['duration'][i, :len(pv_power)] = duration
+
+    dc_current = traces['pv_power'] / traces['ac2_voltage']
+    dc_current[dc_current == 0] = 0.01
+    traces['dc_current'] = dc_current
+
+    return traces
+
+
+def window_statistics(x, window_size, damping_factor=0.6):
+    """ Calculates what RollingWindowStats would give for the window ending at every column of x, for every row of x
+    at once. Returns (weighted_average, z) where z is the coefficient of variation (sd / mean, or 0.001 for a window
+    with no variation) as used by AnalyseMethods.update_dynamic_buffer. Columns before the window has filled are nan """
+
+    days, rows = x.shape
+    weighted_average = np.full((days, rows), np.nan)
+    z = np.full((days, rows), np.nan)
+    if rows < window_size:
+        return weighted_average, z
+
+    # Every window as window_size shifted views of x, newest first
+    filled = rows - window_size + 1
+    lags = [x[:, window_size - 1 - k:window_size - 1 - k + filled] for k in range(window_size)]
+
+    mean = sum(lags) / window_size
+    variance = sum((lag - mean) ** 2 for lag in lags) / (window_size - 1)
+
+    # A window of identical values has no variation, even if the mean has a rounding error in it
+    constant = np.all([lag == lags[0] for lag in lags], axis=0)
+    variance[constant] = 0
+
+    window_z = np.sqrt(variance) / mean
+    window_z[window_z == 0] = 0.001
+    z[:, window_size - 1:] = window_z
+
+    weighted_average[:, window_size - 1:] = sum(damping_factor * (1 - damping_factor) ** k * lag
+                                                for k, lag in enumerate(lags))
+
+    return weighted_average, z
+
+
+def make_grid(curves, window_sizes, upper_thresholds, lower_thresholds, increases, decreases):
+    """ Returns every combination of the given parameters as a dictionary of equal length lists. curves is a dictionary
+    of named buffer curves in the form used by BUFFER_CURVES """
+    names = ('curve', 'window_size', 'upper_threshold', 'lower_threshold', 'increase', 'decrease')
+    combinations = list(itertools.product(sorted(curves), window_sizes, upper_thresholds, lower_thresholds, increases,
+                                          decreases))
+    grid = dict((name, [combination[i] for combination in combinations]) for i, name in enumerate(names))
+    grid['curves'] = dict(curves)
+    return grid
+
+
+def sweep(traces, grid, base_charge_rate=6, min_charge_rate=6, damping_factor=0.6, chunk_days=16):
+    """ Runs the grid connected PV_with_BT solar tracking of AnalyseMethods.calculate_charge_rate for every parameter
+    set in the grid over every day in traces, with one simulated charger. Returns (delivered, battery_draw) arrays in
+    kWh with one entry per parameter set. Battery draw is the charging energy that PV didn't cover.
+
+    The window statistics and buffers are calculated for every row at once. The charge rate is a state machine (each
+    step depends on the last), so we step through the rows once, updating every (day, parameter set) pair at the same
+    time. Each day starts from scratch, calibrating on its first window of rows like AnalyseMethods does """
+
+    num_sets = len(grid['curve'])
+    window_sizes = sorted(set(grid['window_size']))
+
+    # Per parameter set values, as arrays
+    window_index = np.array([window_sizes.index(size) for size in grid['window_size']])
+    window_size = np.array(grid['window_size'])
+    coefficients = np.array([grid['curves'][name][0] for name in grid['curve']], dtype=float)
+    clamp_z = np.array([grid['curves'][name][1] for name in grid['curve']], dtype=float)
+    clamp_buffer = np.array([grid['curves'][name][2] for name in grid['curve']], dtype=float)
+    upper = 1 + np.array(grid['upper_threshold'], dtype=float)
+    lower = 1 - np.array(grid['lower_threshold'], dtype=float)
+    increase = np.array(grid['increase'], dtype=float)
+    decrease = np.array(grid['decrease'], dtype=float)
+
+    delivered = np.zeros(num_sets)
+    battery_draw = np.zeros(num_sets)
+
+    total_days = traces['dc_current'].shape[0]
+    for first_day in range(0, total_days, chunk_days):
+        days = slice(first_day, min(first_day + chunk_days, total_days))
+        dc_current = traces['dc_current'][days]
+        num_days, rows = dc_current.shape
+
+        # The window statistics of every window size, arranged so each row's values are contiguous:
+        # (rows, window sizes, days)
+        statistics = [window_statistics(dc_current, size, damping_factor) for size in window_sizes]
+        weighted_average = np.ascontiguousarray(np.stack([s[0] for s in statistics], axis=0).transpose(2, 0, 1))
+        z = np.ascontiguousarray(np.stack([s[1] for s in statistics], axis=0).transpose(2, 0, 1))
+
+        # Lanes are (day, parameter set) pairs, day major
+        day_of_lane = np.repeat(np.arange(num_days), num_sets)
+        set_of_lane = np.tile(np.arange(num_sets), num_days)
+        statistic_of_lane = window_index[set_of_lane] * num_days + day_of_lane
+
+        lane_c0, lane_c1, lane_c2 = (np.ascontiguousarray(coefficients[set_of_lane, i]) / 100 for i in range(3))
+        lane_clamp_z = clamp_z[set_of_lane]
+        lane_clamp_buffer = clamp_buffer[set_of_lane]
+        lane_upper = upper[set_of_lane]
+        lane_lower = lower[set_of_lane]
+        lane_increase = increase[set_of_lane]
+        lane_decrease = decrease[set_of_lane]
+        lane_first_row = window_size[set_of_lane]
+
+        dc_by_row = np.ascontiguousarray(dc_current.T)
+        pv_by_row = np.ascontiguousarray(traces['pv_power'][days].T)
+        voltage_by_row = np.ascontiguousarray(traces['ac2_voltage'][days].T)
+        duration_by_row = np.ascontiguousarray(traces['duration'][days].T)
+
+        rate = np.full(len(day_of_lane), float(base_charge_rate))
+        lane_delivered = np.zeros(len(day_of_lane))
+        lane_draw = np.zeros(len(day_of_lane))
+
+        for row in range(rows):
+            active = lane_first_row <= row
+            if not active.any():
+                continue
+
+            row_z = z[row].ravel()[statistic_of_lane]
+            row_average = weighted_average[row].ravel()[statistic_of_lane]
+
+            # The dynamic buffer (update_dynamic_buffer)
+            log_z = np.log(np.where(active, row_z, 1))
+            buffer = lane_c0 + log_z * (lane_c1 + log_z * lane_c2)
+            buffer = np.where(row_z > lane_clamp_z, lane_clamp_buffer, buffer)
+            np.maximum(buffer, 0, out=buffer)
+
+            # Track the solar (calculate_charge_rate). Below 1A of PV the charge rate drops to 1A
+            pv_window_mean = row_average * (1 - buffer)
+            tracked = np.where(pv_window_mean > rate * lane_upper, rate * lane_increase,
+                               np.where(pv_window_mean < rate * lane_lower, rate * lane_decrease, rate))
+            tracked = np.where(dc_by_row[row][day_of_lane] > 1, tracked, 1)
+            rate = np.where(active, tracked, rate)
+
+            # When grid connected the charger never goes below the minimum charge rate
+            charge_power = np.maximum(np.floor(rate), min_charge_rate) * voltage_by_row[row][day_of_lane]
+            energy = np.where(active, duration_by_row[row][day_of_lane], 0) / 3600000
+            lane_delivered += charge_power * energy
+            lane_draw += np.maximum(charge_power - pv_by_row[row][day_of_lane], 0) * energy
+
+        delivered += lane_delivered.reshape(num_days, num_sets).sum(axis=0)
+        battery_draw += lane_draw.reshape(num_days, num_sets).sum(axis=0)
+
+    return delivered, battery_draw
+
+
+def pareto_front(delivered, battery_draw):
+    """ Returns the indices of the parameter sets that no other set beats on both delivered energy (more is better)
+    and battery draw (less is better), in order of increasing battery draw """
+    order = np.lexsort((-delivered, battery_draw))
+    front = list()
+    best_delivered = -np.inf
+    for index in order:
+        if delivered[index] > best_delivered:
+            front.append(index)
+            best_delivered = delivered[index]
+
+    return front
+
+
+def scaled_curves(names, scales):
+    """ Returns variations of the named BUFFER_CURVES with their polynomial scaled by each of the scales """
+    curves = dict()
+    for name in names:
+        coefficients, clamp_z, clamp_buffer = BUFFER_CURVES[name]
+        for scale in scales:
+            curves[name + ' x' + str(scale)] = (tuple(c * scale for c in coefficients), clamp_z, clamp_buffer * scale)
+
+    return curves
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import argparse
+
+    def number_list(text):
+        return [float(value) for value in text.split(',')]
+
+    parser = argparse.ArgumentParser(description='Sweep the PV tracking parameters over day logs')
+    parser.add_argument('logs', nargs='*', help='day logs to sweep over (default: every log in ../data/logs)')
+    parser.add_argument('--curves', default='Aggressive,Balanced,Conservative', help='buffer curves to start from')
+    parser.add_argument('--scales', type=number_list, default=[0.5, 0.75, 1, 1.25, 1.5],
+                        help='scales to apply to each buffer curve')
+    parser.add_argument('--windows', type=number_list, default=[4, 8, 16], help='window sizes')
+    parser.add_argument('--upper', type=number_list, default=[0.03, 0.07], help='upper thresholds')
+    parser.add_argument('--lower', type=number_list, default=[0.04, 0.08], help='lower thresholds')
+    parser.add_argument('--increase', type=number_list, default=[1.05, 1.15], help='charge rate increases')
+    parser.add_argument('--decrease', type=number_list, default=[0.80, 0.95], help='charge rate decreases')
+    args = parser.parse_args()
+
+    paths = args.logs or sorted(glob.glob('../data/logs/*.csv'))
+    if not paths:
+        sys.exit('No day logs to sweep over')
+
+    start_time = time.perf_counter()
+    pv_traces = load_pv_traces(paths)
+    parameter_grid = make_grid(scaled_curves(args.curves.split(','), args.scales),
+                               [int(size) for size in args.windows], args.upper, args.lower, args.increase,
+                               args.decrease)
+    delivered_kwh, battery_draw_kwh = sweep(pv_traces, parameter_grid)
+    elapsed = time.perf_counter() - start_time
+
+    print('Swept', len(delivered_kwh), 'parameter sets over', pv_traces['dc_current'].shape[0], 'days in',
+          round(elapsed, 1), 'seconds')
+    print('delivered_kwh, battery_draw_kwh, curve, window_size, upper_threshold, lower_threshold, increase, decrease')
+    for i in pareto_front(delivered_kwh, battery_draw_kwh):
+        print(round(delivered_kwh[i], 2), round(battery_draw_kwh[i], 2), parameter_grid['curve'][i],
+              parameter_grid['window_size'][i], parameter_grid['upper_threshold'][i],
+              parameter_grid['lower_threshold'][i], parameter_grid['increase'][i], parameter_grid['decrease'][i])
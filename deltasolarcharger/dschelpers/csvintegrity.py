@@ -0,0 +1,76 @@
+import os
+import mmap
+
+from utils import log
+
+# Where we keep how far into each day log we have already checked
+_CHECKPOINT_DIR = '../data/checkpoints/'
+
+
+def verified_offset_path(csv_path):
+    return _CHECKPOINT_DIR + os.path.basename(csv_path) + '.verified'
+
+
+def load_verified_offset(csv_path):
+    """ Returns how many bytes at the start of a day log are known to be free of NULL bytes """
+    try:
+        with open(verified_offset_path(csv_path), 'r') as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def save_verified_offset(csv_path, offset):
+    """ Records how far into a day log we have checked. The record is replaced atomically """
+    path = verified_offset_path(csv_path)
+    try:
+        os.makedirs(_CHECKPOINT_DIR, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(offset))
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        log('Could not save verified offset of', csv_path, e)
+
+
+def repair_csv_tail(csv_path):
+    """ Makes sure that a day log has no NULL bytes in it. A power cut can leave a run of NULL bytes at the end of the
+    file, so we memory map the file and only scan what was written after the last time we checked it. If we find NULL
+    bytes, we remove them (and any rows that they leave empty) from the unchecked part of the file, in place.
+
+    Returns True if the file had to be repaired. Raises FileNotFoundError if the file doesn't exist """
+
+    size = os.path.getsize(csv_path)
+    verified = load_verified_offset(csv_path)
+
+    # If the file is smaller than what we checked then it has been replaced, so start again
+    if verified > size:
+        verified = 0
+
+    if verified == size:
+        return False
+
+    with open(csv_path, 'r+b') as f:
+        with mmap.mmap(f.fileno(), 0) as mapped:
+            if mapped.find(b'\0', verified) == -1:
+                # Only count complete rows as checked, the last row may still be being written
+                save_verified_offset(csv_path, mapped.rfind(b'\n', verified) + 1 or verified)
+                return False
+
+            tail = mapped[verified:]
+
+        log('We found a null byte in', csv_path, 'after byte', verified, ', lets fix it')
+
+        # Take the NULL bytes out and drop any rows that end up empty
+        lines = tail.replace(b'\0', b'').split(b'\n')
+        cleaned = b'\n'.join(line for line in lines[:-1] if line.strip(b'\r'))
+        if cleaned:
+            cleaned += b'\n'
+        cleaned += lines[-1]
+
+        f.seek(verified)
+        f.write(cleaned)
+        f.truncate()
+
+    save_verified_offset(csv_path, verified + cleaned.rfind(b'\n') + 1)
+    log('Fixed the csv file!!')
+    return True
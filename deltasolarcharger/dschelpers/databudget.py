@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import calendar
+from math import ceil
+from threading import Lock
+from datetime import datetime
+
+from utils import log
+
+
+class DataBudget:
+    """ Shares a monthly data budget (for a SIM on a data plan) between our scheduled uploads: the live database,
+    history and analytics. Each one is given an interval, in samples, between uploads.
+
+    We record how many bytes we actually send and receive (over HTTP and FTP) as we go. Every time we update, the budget
+    that is left is spread over the rest of the month, the traffic that we don't schedule (status updates, charging
+    sessions, FTP) is taken off, and every interval is stretched by the same factor until what is left covers our
+    scheduled uploads. So we upload as often as we like while we are under budget, and back off as we near the cap.
+
+    streams maps a stream name to (fastest, slowest, optional): the shortest and longest interval that it can have. An
+    optional stream is switched off (its interval is None) rather than going slower than slowest. Payload sizes are
+    recorded per stream with record_payload, and each upload is charged request_overhead bytes on top of its payload.
+    Measured bytes are multiplied by overhead to allow for the TCP/IP and TLS framing that we can't see.
+
+    How much of the month's budget we have used is saved to state_path, so it carries over a restart """
+
+    def __init__(self, monthly_bytes, streams, state_path='../data/checkpoints/databudget.json', request_overhead=700,
+                 overhead=1.15, reserve=0.05):
+        self.monthly_bytes = monthly_bytes
+        self.streams = streams
+        self.state_path = state_path
+        self.request_overhead = request_overhead
+        self.overhead = overhead
+        self.reserve = reserve
+
+        self._lock = Lock()
+
+        # Bytes used this month, by category
+        self.month = datetime.now().strftime('%Y-%m')
+        self.used = dict()
+
+        # The average payload of each stream
+        self.payloads = {name: 0 for name in streams}
+
+        # Our current intervals, and how much traffic we expected them and everything else to use
+        self.intervals = {name: fastest for name, (fastest, slowest, optional) in streams.items()}
+        self.other_rate = 0
+        self._last_update = None
+        self._used_at_last_update = 0
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if state.get('month') == self.month:
+            self.used = state.get('used', dict())
+
+    def save(self):
+        """ Saves how much we have used this month. The file is replaced atomically """
+        with self._lock:
+            state = {'month': self.month, 'used': dict(self.used)}
+
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(self.state_path + '.tmp', self.state_path)
+        except OSError as e:
+            log('Could not save data budget', e)
+
+    def record(self, category, num_bytes):
+        """ Records bytes that we sent or received, e.g. record('ftp', 2048) """
+        with self._lock:
+            self.roll_month()
+            self.used[category] = self.used.get(category, 0) + num_bytes * self.overhead
+
+    def record_payload(self, stream, num_bytes):
+        """ Records the size of an upload of one of our streams """
+        with self._lock:
+            average = self.payloads[stream]
+            self.payloads[stream] = num_bytes if not average else 0.9 * average + 0.1 * num_bytes
+
+    def roll_month(self):
+        month = datetime.now().strftime('%Y-%m')
+        if month != self.month:
+            log('New month, resetting our data budget. Last month we used', self.used)
+            self.month = month
+            self.used = dict()
+            self._used_at_last_update = 0
+
+    def total_used(self):
+        with self._lock:
+            return sum(self.used.values())
+
+    def scheduled_rate(self, intervals):
+        """ Returns the bytes per second that our streams would use at intervals (in samples, roughly seconds) """
+        return sum((self.payloads[name] + self.request_overhead) / interval
+                   for name, interval in intervals.items() if interval is not None)
+
+    def stretched(self, factor):
+        """ Returns our intervals with each stream's fastest interval stretched by factor """
+        intervals = dict()
+        for name, (fastest, slowest, optional) in self.streams.items():
+            interval = fastest * factor
+            if interval > slowest:
+                interval = None if optional else slowest
+            intervals[name] = interval
+        return intervals
+
+    def update(self):
+        """ Works out new intervals from what is left of the month's budget. Returns them as {stream: interval}, where
+        an interval of None means that the stream is switched off """
+        now = time.time()
+        with self._lock:
+            self.roll_month()
+        used = self.total_used()
+
+        # Whatever we used since the last update that wasn't our streams is traffic that we can't schedule
+        if self._last_update is not None and now > self._last_update:
+            measured_rate = (used - self._used_at_last_update) / (now - self._last_update)
+            other_rate = max(0, measured_rate - self.scheduled_rate(self.intervals))
+            self.other_rate = 0.8 * self.other_rate + 0.2 * other_rate
+        self._last_update = now
+        self._used_at_last_update = used
+
+        # Spread what is left over the rest of the month
+        current = datetime.now()
+        month_end = datetime(current.year, current.month, calendar.monthrange(current.year, current.month)[1], 23, 59,
+                             59).timestamp()
+        remaining = self.monthly_bytes * (1 - self.reserve) - used
+        allowed_rate = max(0, remaining) / max(1, month_end - now) - self.other_rate
+
+        # Find the smallest stretch that fits our streams into the rate that we are allowed
+        low, high = 1, 1
+        while self.scheduled_rate(self.stretched(high)) > allowed_rate and high < 1e6:
+            low, high = high, high * 2
+
+        if high > 1:
+            for _ in range(30):
+                middle = (low + high) / 2
+                if self.scheduled_rate(self.stretched(middle)) > allowed_rate:
+                    low = middle
+                else:
+                    high = middle
+
+        self.intervals = {name: None if interval is None else max(1, ceil(interval))
+                          for name, interval in self.stretched(high).items()}
+        return self.intervals
+
+    def stats(self):
+        with self._lock:
+            used = sum(self.used.values())
+        return {'month': self.month, 'used_mb': round(used / 1e6, 2), 'budget_mb': round(self.monthly_bytes / 1e6, 2),
+                'intervals': self.intervals, 'other_rate': round(self.other_rate, 1)}
@@ -0,0 +1,145 @@
+import os
+import csv
+import struct
+from datetime import datetime
+
+import numpy as np
+
+# The columns of our day logs after the time, in the order that FirebaseMethods.log_data writes them
+DAY_LOG_FIELDS = ('ac1p', 'ac1v', 'ac1c', 'ac2p', 'ac2v', 'ac2c', 'dc1p', 'dc1v', 'dc1c', 'dc2p', 'dc2v', 'dc2c',
+                  'btp', 'btv', 'btc', 'btsoc', 'utility_p', 'utility_c', 'bt_module1_max_temp', 'bt_module1_min_temp',
+                  'ac1_freq')
+
+# A day file is a 64 byte header followed by fixed width records: a POSIX timestamp and a float32 for every field.
+# Records can be read straight out of the file with np.memmap(..., dtype=DAY_DTYPE, offset=HEADER_SIZE)
+DAY_DTYPE = np.dtype([('time', '<f8')] + [(name, '<f4') for name in DAY_LOG_FIELDS])
+HEADER_SIZE = 64
+
+_MAGIC = b'DSCDAY\x00\x00'
+_VERSION = 1
+
+# magic, version, number of fields, record size, then reserved space up to HEADER_SIZE
+_HEADER = struct.Struct('<8sHHI48x')
+_RECORD = struct.Struct('<d' + 'f' * len(DAY_LOG_FIELDS))
+
+# Where we keep our day files. They are kept out of ../data/logs, which only has the csv files that we upload
+DAY_STORE_DIR = '../data/daystore/'
+
+
+def day_store_path(date_string):
+    """ Returns the path of the day file for a date in the form YYYY-MM-DD """
+    return DAY_STORE_DIR + date_string + '.day'
+
+
+def parse_log_time(value):
+    """ Converts the time column of a day log (str(datetime.now())) into a POSIX timestamp. This is done by hand as
+    strptime takes longer than the rest of the row put together """
+    date, clock = value.split(' ')
+    hours, minutes, seconds = clock.split(':')
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(hours), int(minutes)).timestamp() + \
+        float(seconds)
+
+
+def read_header(f):
+    """ Checks the header of an open day file and leaves the file positioned at the first record """
+    header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE:
+        raise ValueError('Day file has no header')
+
+    magic, version, num_fields, record_size = _HEADER.unpack(header)
+    if magic != _MAGIC or version != _VERSION or num_fields != len(DAY_LOG_FIELDS) or \
+            record_size != DAY_DTYPE.itemsize:
+        raise ValueError('Day file has an unknown format')
+
+
+def append_record(path, timestamp, values):
+    """ Appends one record to a day file, creating it if needed. values are in the order of DAY_LOG_FIELDS """
+    record = _RECORD.pack(timestamp, *values)
+
+    with open(path, 'ab') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size < HEADER_SIZE:
+            # New (or cut off before the header was finished) file
+            f.truncate(0)
+            f.write(_HEADER.pack(_MAGIC, _VERSION, len(DAY_LOG_FIELDS), DAY_DTYPE.itemsize))
+
+        elif (size - HEADER_SIZE) % DAY_DTYPE.itemsize:
+            # A power cut left half a record on the end, so drop it
+            f.truncate(size - (size - HEADER_SIZE) % DAY_DTYPE.itemsize)
+
+        f.write(record)
+
+
+def read_day(path):
+    """ Returns the records of a day file as a read only structured array, without parsing anything. A half written
+    record at the end of the file is ignored """
+    with open(path, 'rb') as f:
+        read_header(f)
+
+    count = (os.path.getsize(path) - HEADER_SIZE) // DAY_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=DAY_DTYPE)
+
+    return np.memmap(path, dtype=DAY_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def iter_log_rows(path):
+    """ Yields (timestamp, row) for every row of a day log, which can be either a csv file or a day file. Each row can
+    be indexed by the names in DAY_LOG_FIELDS. Corrupted csv rows are skipped """
+    if path.endswith('.day'):
+        for record in read_day(path):
+            yield float(record['time']), record
+        return
+
+    with open(path, 'r') as f:
+        for row in csv.DictReader(f):
+            try:
+                timestamp = parse_log_time(row['time'])
+            except (ValueError, TypeError, AttributeError):
+                continue
+            yield timestamp, row
+
+
+def format_value(value):
+    # float32 only has about 7 significant digits, so don't print any more than that
+    return '%.7g' % value
+
+
+def export_csv(path, csv_path):
+    """ Writes a day file out as a csv file in the format of our day logs """
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('time',) + DAY_LOG_FIELDS)
+        for record in read_day(path):
+            writer.writerow([str(datetime.fromtimestamp(float(record['time'])))] +
+                            [format_value(record[name]) for name in DAY_LOG_FIELDS])
+
+
+def import_csv(csv_path, path):
+    """ Converts a csv day log into a day file. Returns the number of rows converted """
+    records = list()
+    for timestamp, row in iter_log_rows(csv_path):
+        try:
+            records.append(_RECORD.pack(timestamp, *(float(row[name]) for name in DAY_LOG_FIELDS)))
+        except (ValueError, TypeError, KeyError):
+            continue
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(DAY_LOG_FIELDS), DAY_DTYPE.itemsize))
+        f.write(b''.join(records))
+
+    return len(records)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Usage: python3 daystore.py export <day file> <csv file>
+    #        python3 daystore.py import <csv file> <day file>
+    if len(sys.argv) != 4 or sys.argv[1] not in ('export', 'import'):
+        sys.exit('Usage: daystore.py export|import <from> <to>')
+
+    if sys.argv[1] == 'export':
+        export_csv(sys.argv[2], sys.argv[3])
+    else:
+        print('Converted', import_csv(sys.argv[2], sys.argv[3]), 'rows')
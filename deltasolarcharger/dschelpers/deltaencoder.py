@@ -0,0 +1,78 @@
+import time
+
+
+def flatten(document, prefix=''):
+    """ Turns a nested dict into {'path/to/leaf': value} """
+    leaves = dict()
+    for key, value in document.items():
+        if isinstance(value, dict) and value:
+            leaves.update(flatten(value, prefix + key + '/'))
+        else:
+            leaves[prefix + key] = value
+    return leaves
+
+
+class DeltaEncoder:
+    """ Cuts a document that we update in Firebase over and over (like live_database) down to the fields that have
+    changed since we last sent it. encode returns a multi-path update of just those fields, e.g.
+    {'inverter_data/AC1 Voltage/value': 241.3, 'timestamp': ...}.
+
+    deadbands maps a field name (the key above the leaf, e.g. 'AC1 Voltage', or the leaf's own key) to how far its
+    value can move from the value that we last sent before we send it again. Fields without a deadband are sent
+    whenever they change. Every keyframe_interval seconds (and after reset) the whole document is sent, so anything
+    that went missing is put right """
+
+    def __init__(self, deadbands=None, keyframe_interval=60):
+        self.deadbands = deadbands if deadbands is not None else dict()
+        self.keyframe_interval = keyframe_interval
+
+        # The value of every field as we last sent it
+        self._sent = dict()
+        self._next_keyframe = None
+
+        self.keyframes = 0
+        self.fields_sent = 0
+        self.fields_total = 0
+
+    def reset(self):
+        """ Makes the next update a keyframe """
+        self._next_keyframe = None
+
+    def deadband(self, path):
+        parts = path.split('/')
+        for name in reversed(parts[-2:]):
+            if name in self.deadbands:
+                return self.deadbands[name]
+        return None
+
+    def changed(self, path, value):
+        if path not in self._sent:
+            return True
+
+        last = self._sent[path]
+        band = self.deadband(path)
+        if band is not None and isinstance(value, (int, float)) and isinstance(last, (int, float)):
+            return abs(value - last) > band
+
+        return value != last
+
+    def encode(self, document):
+        """ Returns the update to send for the latest version of document """
+        leaves = flatten(document)
+        self.fields_total += len(leaves)
+
+        now = time.monotonic()
+        if self._next_keyframe is None or now >= self._next_keyframe:
+            self._next_keyframe = now + self.keyframe_interval
+            self._sent = leaves
+            self.keyframes += 1
+            self.fields_sent += len(leaves)
+            return document
+
+        delta = {path: value for path, value in leaves.items() if self.changed(path, value)}
+        self._sent.update(delta)
+        self.fields_sent += len(delta)
+        return delta
+
+    def stats(self):
+        return {'keyframes': self.keyframes, 'fields_sent': self.fields_sent, 'fields_total': self.fields_total}
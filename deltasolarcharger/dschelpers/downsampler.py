@@ -0,0 +1,79 @@
+class WindowDownsampler:
+    """ Turns a stream of records (dicts of numbers, like our history records) into one record per window, in constant
+    memory. Records are added one at a time with add, and emit returns the aggregate of everything added since the
+    last emit.
+
+    modes maps a field to how it is aggregated: 'mean', 'min', 'max', 'last', or 'range', which is the mean under the
+    field's own key along with the window's extremes under <field>_min and <field>_max, so short dips and spikes still
+    show up. Fields that aren't in modes use default, and fields that aren't numbers always use 'last'. A field's mean
+    is over the records that had it, and means are rounded to digits decimal places to keep the record small """
+
+    _MODES = ('mean', 'min', 'max', 'last', 'range')
+
+    def __init__(self, modes=None, default='mean', digits=2):
+        self.modes = modes if modes is not None else dict()
+        self.default = default
+        self.digits = digits
+
+        for mode in list(self.modes.values()) + [default]:
+            if mode not in self._MODES:
+                raise ValueError('Unknown downsampling mode ' + str(mode))
+
+        self._count = 0
+        self._counts = dict()
+        self._sums = dict()
+        self._mins = dict()
+        self._maxs = dict()
+        self._lasts = dict()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, record):
+        self._count += 1
+        for field, value in record.items():
+            self._lasts[field] = value
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+
+            if field in self._sums:
+                self._counts[field] += 1
+                self._sums[field] += value
+                if value < self._mins[field]:
+                    self._mins[field] = value
+                if value > self._maxs[field]:
+                    self._maxs[field] = value
+            else:
+                self._counts[field] = 1
+                self._sums[field] = value
+                self._mins[field] = value
+                self._maxs[field] = value
+
+    def emit(self):
+        """ Returns the aggregate record of the window and starts a new one, or None if nothing was added """
+        if not self._count:
+            return None
+
+        record = dict()
+        for field, last in self._lasts.items():
+            mode = self.modes.get(field, self.default)
+            if field not in self._sums or mode == 'last':
+                record[field] = last
+            elif mode == 'min':
+                record[field] = self._mins[field]
+            elif mode == 'max':
+                record[field] = self._maxs[field]
+            else:
+                record[field] = round(self._sums[field] / self._counts[field], self.digits)
+                if mode == 'range':
+                    record[field + '_min'] = self._mins[field]
+                    record[field + '_max'] = self._maxs[field]
+
+        self._count = 0
+        self._counts.clear()
+        self._sums.clear()
+        self._mins.clear()
+        self._maxs.clear()
+        self._lasts.clear()
+
+        return record
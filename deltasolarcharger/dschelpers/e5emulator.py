@@ -0,0 +1,265 @@
+import os
+import tty
+import csv
+import glob
+import random
+import select
+import threading
+import time
+
+from utils import log
+
+from modbusmethods import E5_REGISTER_MAP, _PAGE_SELECT_REGISTER
+from modbussample import csv_row_to_registers, UNLOGGED_REGISTERS
+
+
+def crc16(frame):
+    """ Calculates the Modbus RTU CRC of a frame, returned as the two bytes that go on the end of the frame """
+    crc = 0xFFFF
+    for byte in frame:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+
+    return bytes([crc & 0xFF, crc >> 8])
+
+
+class E5Emulator:
+    """ Emulates an E5 inverter as a Modbus RTU slave on a pseudo terminal. ModbusMethods can use the emulator by
+    opening its port instead of /dev/serial0. Register values are replayed from one of our day logs """
+
+    # Writing to this register changes the operation mode, which then shows up in the operation mode input register
+    # (1551). The E5 uses different codes for the two, so we translate the modes that ModbusMethods writes (Charge
+    # First, Self Consumption and Without BT) into the codes that it reads back
+    _OP_MODE_REGISTER = 25626
+    _OP_MODE_READ_CODES = {4: 3, 1: 1, 6: 5}
+
+    # Our day logs have one row every 2 seconds
+    _ROW_PERIOD = 2
+
+    def __init__(self, log_path=None, slave_id=1, speed=1, latency=0, baudrate=19200, faults=None,
+                 reject_gaps=False):
+        self.slave_id = slave_id
+
+        # How many times faster than real time we replay the day log
+        self.speed = speed
+
+        # Extra time we wait before replying to each request, on top of the time the frames would take on the wire
+        self.latency = latency
+        self.baudrate = baudrate
+
+        # The probability of each fault happening on a request: 'timeout' (no reply), 'crc' (corrupt reply) and
+        # 'exception' (slave device failure)
+        self.faults = dict(faults) if faults else dict()
+
+        # The real E5 may refuse reads that cover registers it doesn't know about
+        self.reject_gaps = reject_gaps
+
+        self.rows = self.load_rows(log_path)
+
+        # Work out where every register lives. Paged registers are keyed by (page, address)
+        self._paged = dict()
+        self._unpaged = dict()
+        for register in E5_REGISTER_MAP:
+            if register.page is None:
+                self._unpaged[register.address] = register.name
+            else:
+                self._paged[(register.page, register.address)] = register.name
+
+        self.holding_registers = {_PAGE_SELECT_REGISTER: 0, self._OP_MODE_REGISTER: 1}
+        self.op_mode = UNLOGGED_REGISTERS['inverter_op_mode']
+
+        self.request_count = 0
+        self.fault_count = 0
+
+        self._master_fd = None
+        self._slave_fd = None
+        self.port = None
+
+        self._start_time = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def load_rows(log_path=None):
+        """ Loads the register values from a day log. If no path is given, we use the latest day log in ../data/logs """
+        if log_path is None:
+            logs = sorted(glob.glob('../data/logs/*.csv'))
+            log_path = logs[-1] if logs else None
+
+        rows = list()
+        if log_path is not None and os.path.isfile(log_path):
+            with open(log_path, 'r') as f:
+                for row in csv.DictReader(f):
+                    try:
+                        rows.append(csv_row_to_registers(row))
+                    except (ValueError, TypeError, KeyError):
+                        # Skip any corrupted rows
+                        continue
+
+        if rows:
+            log('E5 emulator loaded', len(rows), 'rows from', log_path)
+        else:
+            # Without a day log we just serve an idle system
+            log('E5 emulator could not find a day log, serving static values')
+            rows.append(dict((register.name, 0) for register in E5_REGISTER_MAP))
+
+        return rows
+
+    def start(self):
+        """ Opens our pseudo terminal and starts serving requests on it """
+        self._master_fd, self._slave_fd = os.openpty()
+        tty.setraw(self._master_fd)
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+
+        self._start_time = time.monotonic()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+
+        log('E5 emulator serving on', self.port)
+        return self.port
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        for fd in (self._master_fd, self._slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self._master_fd = self._slave_fd = None
+
+    def current_registers(self):
+        """ Returns the register values of the day log row that we are currently replaying """
+        elapsed = (time.monotonic() - self._start_time) * self.speed
+        registers = dict(UNLOGGED_REGISTERS)
+        registers.update(self.rows[int(elapsed // self._ROW_PERIOD) % len(self.rows)])
+        registers['inverter_op_mode'] = self.op_mode
+        return registers
+
+    def read_register(self, address, registers):
+        """ Returns the value of a single input register, or None if the E5 doesn't have one at that address """
+        page = self.holding_registers[_PAGE_SELECT_REGISTER]
+        name = self._paged.get((page, address), self._unpaged.get(address))
+        if name is None:
+            return None
+
+        return registers[name]
+
+    def serve(self):
+        buffer = b''
+        while not self._stop_event.is_set():
+            ready, _, _ = select.select([self._master_fd], [], [], 0.1)
+            if not ready:
+                # A gap in the traffic means the end of a frame, so throw away anything that we couldn't parse
+                buffer = b''
+                continue
+
+            buffer += os.read(self._master_fd, 256)
+
+            # Every request that we support (functions 3, 4 and 6) is 8 bytes long
+            while len(buffer) >= 8:
+                frame, buffer = buffer[:8], buffer[8:]
+                if crc16(frame[:6]) != frame[6:]:
+                    # Corrupted request, so wait for the line to go quiet and start again
+                    buffer = b''
+                    break
+
+                response = self.handle_request(frame)
+                if response is not None:
+                    self.reply(response)
+
+    def reply(self, response):
+        # Wait for the time it would take to receive the request and send the reply (10 bits per byte)
+        time.sleep(self.latency + (8 + len(response)) * 10 / self.baudrate)
+        os.write(self._master_fd, response)
+
+    def handle_request(self, frame):
+        """ Returns the response to a Modbus request, or None if we shouldn't respond """
+        slave_id, function_code = frame[0], frame[1]
+        address = (frame[2] << 8) | frame[3]
+        value = (frame[4] << 8) | frame[5]
+
+        if slave_id != self.slave_id:
+            return None
+
+        self.request_count += 1
+
+        # Inject our faults
+        fault = self.pick_fault()
+        if fault == 'timeout':
+            return None
+        elif fault == 'exception':
+            return self.exception_response(function_code, 4)
+
+        if function_code in (3, 4):
+            if not 1 <= value <= 125:
+                return self.exception_response(function_code, 3)
+
+            registers = self.current_registers()
+            values = list()
+            for register_address in range(address, address + value):
+                if function_code == 3:
+                    register_value = self.holding_registers.get(register_address)
+                else:
+                    register_value = self.read_register(register_address, registers)
+
+                if register_value is None:
+                    if self.reject_gaps:
+                        return self.exception_response(function_code, 2)
+                    register_value = 0
+                values.append(register_value)
+
+            payload = bytes([slave_id, function_code, 2 * len(values)])
+            for register_value in values:
+                payload += bytes([(register_value >> 8) & 0xFF, register_value & 0xFF])
+
+        elif function_code == 6:
+            self.holding_registers[address] = value
+            if address == self._OP_MODE_REGISTER:
+                self.op_mode = self._OP_MODE_READ_CODES.get(value, self.op_mode)
+            payload = frame[:6]
+
+        else:
+            return self.exception_response(function_code, 1)
+
+        response = payload + crc16(payload)
+        if fault == 'crc':
+            response = response[:-1] + bytes([response[-1] ^ 0xFF])
+
+        return response
+
+    def exception_response(self, function_code, exception_code):
+        payload = bytes([self.slave_id, function_code | 0x80, exception_code])
+        return payload + crc16(payload)
+
+    def pick_fault(self):
+        """ Randomly picks which fault (if any) to inject into this request """
+        draw = random.random()
+        for fault in ('timeout', 'crc', 'exception'):
+            draw -= self.faults.get(fault, 0)
+            if draw < 0:
+                self.fault_count += 1
+                return fault
+
+        return None
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Usage: python3 e5emulator.py [day log csv]
+    e5_emulator = E5Emulator(sys.argv[1] if len(sys.argv) > 1 else None)
+    print('E5 emulator serving on', e5_emulator.start())
+    try:
+        while True:
+            time.sleep(10)
+            print('Requests:', e5_emulator.request_count, 'Faults:', e5_emulator.fault_count)
+    except KeyboardInterrupt:
+        e5_emulator.stop()
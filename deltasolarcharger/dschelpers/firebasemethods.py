@@ -5,6 +5,7 @@ import json
 import os
 import random
 import sqlite3
+import struct
 import time
 import requests
 from datetime import datetime, timedelta
@@ -19,6 +20,16 @@ import pyrebase
 import websocket
 
 from utils import log
+from csvintegrity import repair_csv_tail
+from daystore import append_record, day_store_path, parse_log_time, DAY_STORE_DIR
+from databudget import DataBudget
+from deltaencoder import DeltaEncoder
+from downsampler import WindowDownsampler
+from firebaseoutbox import FirebaseOutbox
+from firebaseuploader import FirebaseUploader
+from httpsession import PooledSession
+from historystore import HistoryStore
+from logwriter import LogWriters
 
 
 class FactoryResetNotifier(Thread):
@@ -210,6 +221,33 @@ class OCPPDataBridge(Thread):
 
 
 class FirebaseMethods:
+    # The headers of our inverter day logs and charging session logs
+    _INVERTER_LOG_HEADER = ['time', 'ac1p', 'ac1v', 'ac1c', 'ac2p', 'ac2v', 'ac2c', 'dc1p', 'dc1v', 'dc1c', 'dc2p',
+                            'dc2v', 'dc2c', 'btp', 'btv', 'btc', 'btsoc', 'utility_p', 'utility_c',
+                            'bt_module1_max_temp', 'bt_module1_min_temp', 'ac1_freq']
+    _CHARGE_SESSION_LOG_HEADER = ['time', 'voltage', 'current_import', 'power_import', 'energy_import', 'solar_power',
+                                  'battery_power', 'battery_soc', 'battery_temp', 'grid_power']
+
+    # How far each field of live_database can move before we send it again (see DeltaEncoder)
+    _LIVE_DATABASE_DEADBANDS = {'AC1 Voltage': 0.5, 'AC2 Voltage': 0.5, 'DC1 Voltage': 0.5, 'DC2 Voltage': 0.5,
+                                'Battery Voltage': 0.5,
+                                'AC1 Current': 0.05, 'AC2 Current': 0.05, 'DC1 Current': 0.05, 'DC2 Current': 0.05,
+                                'Battery Current': 0.05, 'Utility AC Current': 0.05,
+                                'AC1 Power': 5, 'AC2 Power': 5, 'DC1 Power': 5, 'DC2 Power': 5, 'Battery Wattage': 5,
+                                'Utility AC Power': 5,
+                                'AC1 Frequency': 0.05, 'AC2 Frequency': 0.05,
+                                'Battery Module 1 Max Temp': 0.5, 'Battery Module 1 Min Temp': 0.5}
+
+    # The shortest and longest intervals (in samples) between our scheduled uploads, and whether they can be switched
+    # off, when we have a data budget (see DataBudget)
+    _DATA_BUDGET_STREAMS = {'live': (1, 60, True), 'history': (2, 900, False), 'analytics': (20, 3600, False)}
+
+    # How each field of a history record is aggregated over the samples between uploads (see WindowDownsampler). The
+    # rest are averaged
+    _HISTORY_DOWNSAMPLING = {'ac1p': 'range', 'ac2p': 'range', 'dc1p': 'range', 'dc2p': 'range', 'dctp': 'range',
+                             'btp': 'range', 'utility_p': 'range', 'btsoc': 'last', 'bt_module1_temp_max': 'max',
+                             'bt_module1_temp_min': 'min'}
+
     def __init__(self, firebase_to_analyse_queue, stdin_payload):
         super().__init__()
 
@@ -264,6 +302,18 @@ class FirebaseMethods:
 
         self.log_counter_max = 2
 
+        # We update the live database every live_counter_max samples, or not at all if it is None
+        self.live_counter = 0
+        self.live_counter_max = None if self._LIMIT_DATA else 1
+
+        # If we have been given a monthly data budget (in bytes), our upload intervals are worked out from it instead
+        self._http_bytes_recorded = 0
+        self._next_data_budget_update = time.monotonic() + 60
+        if stdin_payload.get('DATA_BUDGET') is not None:
+            self.data_budget = DataBudget(streams=self._DATA_BUDGET_STREAMS, **stdin_payload['DATA_BUDGET'])
+        else:
+            self.data_budget = None
+
         # Define parameters for logging charge sessions
         self._charger_status_list = dict()
 
@@ -293,11 +343,30 @@ class FirebaseMethods:
         # Define our logging flag
         self._LOG = True
 
+        # Do we also log our inverter data into binary day files (see daystore)?
+        self._LOG_DAY_STORE = True
+
+        # Our open log files. Rows are flushed every 15 rows or 30 seconds
+        self.log_writers = LogWriters(flush_rows=15, flush_interval=30)
+
+        # We can also keep our history in an SQLite store (see historystore). The csv logs are still written, as they
+        # are what we upload to the FTP server
+        if stdin_payload.get('HISTORY_STORE') is not None:
+            self.history_store = HistoryStore(**stdin_payload['HISTORY_STORE'])
+        else:
+            self.history_store = None
+
+        # When our files were last checked against the FTP server (see handle_inverter_database)
+        self._last_inverter_sync = None
+        self._last_charging_sync = None
+
         # Check if we have the folders logs/ and charging_logs/
         if not os.path.exists('../data/logs/'):
             os.makedirs('../data/logs', exist_ok=True)
         if not os.path.exists('../data/charging_logs/'):
             os.makedirs('../data/charging_logs/', exist_ok=True)
+        if not os.path.exists(DAY_STORE_DIR):
+            os.makedirs(DAY_STORE_DIR, exist_ok=True)
 
         _LOG_FILE_NAME = datetime.now().strftime('%Y-%m-%d')
         self.log_data(location='../data/logs/' + _LOG_FILE_NAME, purpose='log_inverter_data', initial_run=True)
@@ -312,6 +381,18 @@ class FirebaseMethods:
         # Define the function that will see if we are online or not
         self.internet_checker_thread = None
 
+        # The thread that sends our Firebase writes. It is made when we authenticate and started in our own process
+        self.uploader = None
+
+        # The pool of connections that our pyrebase requests are made through
+        self.http_session = None
+
+        # We only send the fields of live_database that have changed, with the whole thing once a minute
+        self.live_database_encoder = DeltaEncoder(self._LIVE_DATABASE_DEADBANDS, keyframe_interval=60)
+
+        # Every sample goes into the history record that we upload next, rather than just the one that we upload
+        self.history_downsampler = WindowDownsampler(self._HISTORY_DOWNSAMPLING)
+
         # We only want to authenticate when we are online
         if self._ONLINE:
             for _ in range(10):
@@ -373,6 +454,11 @@ class FirebaseMethods:
         # Now that we recovered, we must synchronise charger statuses and perform file integrity check
         self.synchronise_charger_status()
         self.refresh_tokens()
+
+        # Start sending our Firebase writes again, along with the ones that we kept while we were offline
+        if self.uploader is not None:
+            self.uploader.resume()
+        self.live_database_encoder.reset()
         self.perform_file_integrity_check(full_check=False)
 
         log('\nWe are OUT of internet_checker thread\n')
@@ -389,125 +475,122 @@ class FirebaseMethods:
 
     @staticmethod
     def condition_data(modbus_data):
-        # The structure of modbus_data is: # (inverter_data, bt_data, dpm_data)
-        # Now extract them one by one to make it easier to work with:
-
-        inverter_data_temp = modbus_data[0]
+        # modbus_data is a ModbusSample of raw register values that we need to scale
+        fw_dsp, fw_red, fw_disp = modbus_data.firmware_versions
         inverter_data = {
-            'AC1 Voltage': {'value': inverter_data_temp['ac1_voltage'] / 10,
+            'AC1 Voltage': {'value': modbus_data.ac1_voltage / 10,
                             # 'unit': 'V',
                             # 'name': 'AC1 Voltage'
                             },
-            'AC1 Current': {'value': inverter_data_temp['ac1_current'] / 100,
+            'AC1 Current': {'value': modbus_data.ac1_current / 100,
                             # 'unit': 'A',
                             # 'name': 'AC1 Current'
                             },
-            'AC1 Power': {'value': inverter_data_temp['ac1_power'],
+            'AC1 Power': {'value': float(modbus_data.ac1_power),
                           # 'unit': 'W',
                           # 'name': 'AC1 Power'
                           },
-            'AC1 Frequency': {'value': inverter_data_temp['ac1_freq'] / 100,
+            'AC1 Frequency': {'value': modbus_data.ac1_freq / 100,
                               # 'unit': 'Hz',
                               # 'name': 'AC1 Frequency'
                               },
 
-            'AC2 Voltage': {'value': inverter_data_temp['ac2_voltage'] / 10,
+            'AC2 Voltage': {'value': modbus_data.ac2_voltage / 10,
                             # 'unit': 'V',
                             # 'name': 'AC2 Voltage'
                             },
-            'AC2 Current': {'value': inverter_data_temp['ac2_current'] / 100,
+            'AC2 Current': {'value': modbus_data.ac2_current / 100,
                             # 'unit': 'A',
                             # 'name': 'AC2 Current'
                             },
-            'AC2 Power': {'value': inverter_data_temp['ac2_power'],
+            'AC2 Power': {'value': float(modbus_data.ac2_power),
                           # 'unit': 'W',
                           # 'name': 'AC2 Power'
                           },
-            'AC2 Frequency': {'value': inverter_data_temp['ac2_freq'] / 100,
+            'AC2 Frequency': {'value': modbus_data.ac2_freq / 100,
                               # 'unit': 'Hz',
                               # 'name': 'AC2 Frequency'
                               },
 
-            'DC1 Voltage': {'value': inverter_data_temp['dc1_voltage'] / 10,
+            'DC1 Voltage': {'value': modbus_data.dc1_voltage / 10,
                             # 'unit': 'V',
                             # 'name': 'DC1 Voltage'
                             },
-            'DC1 Current': {'value': inverter_data_temp['dc1_current'] / 100,
+            'DC1 Current': {'value': modbus_data.dc1_current / 100,
                             # 'unit': 'A',
                             # 'name': 'DC1 Current'
                             },
-            'DC1 Power': {'value': inverter_data_temp['dc1_power'],
+            'DC1 Power': {'value': float(modbus_data.dc1_power),
                           # 'unit': 'W',
                           # 'name': 'DC1 Power'
                           },
 
-            'DC2 Voltage': {'value': inverter_data_temp['dc2_voltage'] / 10,
+            'DC2 Voltage': {'value': modbus_data.dc2_voltage / 10,
                             # 'unit': 'V',
                             # 'name': 'DC2 Voltage'
                             },
-            'DC2 Current': {'value': inverter_data_temp['dc2_current'] / 100,
+            'DC2 Current': {'value': modbus_data.dc2_current / 100,
                             # 'unit': 'A',
                             # 'name': 'DC2 Current'
                             },
-            'DC2 Power': {'value': inverter_data_temp['dc2_power'],
+            'DC2 Power': {'value': float(modbus_data.dc2_power),
                           # 'unit': 'W',
                           # 'name': 'DC2 Power'
                           },
-            'Operation Mode': {'value': inverter_data_temp['inverter_op_mode'],
+            'Operation Mode': {'value': modbus_data.operation_mode,
                                # 'name': 'Operation Mode'
                                },
-            'Inverter Status': {'value': inverter_data_temp['inverter_status']},
-            'DSP FW': {'value': inverter_data_temp['fw_dsp'],
+            'Inverter Status': {'value': modbus_data.status},
+            'DSP FW': {'value': fw_dsp,
                        },
-            'RED FW': {'value': inverter_data_temp['fw_red'],
+            'RED FW': {'value': fw_red,
                        },
-            'DISP FW': {'value': inverter_data_temp['fw_disp'],
+            'DISP FW': {'value': fw_disp,
                         }
         }
 
-        bt_data_temp = modbus_data[1]
         bt_data = {
-            'Battery SOC': {'value': bt_data_temp['bt_soc'] / 10,
+            'Battery SOC': {'value': modbus_data.bt_soc / 10,
                             'unit': '%',
                             # 'name': 'Battery SOC'
                             },
 
-            'Battery Voltage': {'value': bt_data_temp['bt_voltage'] / 10,
+            'Battery Voltage': {'value': modbus_data.bt_voltage / 10,
                                 # 'unit': 'V',
                                 # 'name': 'Battery Voltage'
                                 },
-            'Battery Current': {'value': -1 * bt_data_temp['bt_current'] / 100,
+            'Battery Current': {'value': -1 * modbus_data.bt_current / 100,
                                 # 'unit': 'A',
                                 # 'name': 'Battery Current'
                                 },
-            'Battery Wattage': {'value': float(-1 * bt_data_temp['bt_wattage']),
+            'Battery Wattage': {'value': float(-1 * modbus_data.bt_wattage),
                                 # 'unit': 'W',
                                 # 'name': 'Battery Wattage'
                                 },
 
-            'Utility AC Current': {'value': bt_data_temp['utility_current'] / 100,
+            'Utility AC Current': {'value': modbus_data.utility_current / 100,
                                    # 'unit': 'A',
                                    # 'name': 'Utility AC Current'
                                    },
-            'Utility AC Power': {'value': bt_data_temp['utility_power'],
+            'Utility AC Power': {'value': float(modbus_data.utility_power),
                                  # 'unit': 'W',
                                  # 'name': 'Utility AC Power'
                                  },
 
-            'Battery Capacity': {'value': bt_data_temp['bt_capacity'] * 100,
+            'Battery Capacity': {'value': modbus_data.bt_capacity * 100,
                                  # 'unit': "Wh",
                                  # 'name': 'Battery Capacity'
                                  },
 
-            'Battery Operation Mode': {'value': bt_data_temp['bt_op_mode'],
+            'Battery Operation Mode': {'value': modbus_data.operation_mode,
                                        # 'unit': None,
                                        # 'name': 'Battery Operation Mode'
                                        },
-            'Battery Module 1 Max Temp': {'value': bt_data_temp['bt_module1_temp_max'] / 10,
+            'Battery Module 1 Max Temp': {'value': modbus_data.bt_module1_temp_max / 10,
                                           # 'unit': None,
                                           # 'name': 'Battery Module 1 Max Temp'
                                           },
-            'Battery Module 1 Min Temp': {'value': bt_data_temp['bt_module1_temp_min'] / 10,
+            'Battery Module 1 Min Temp': {'value': modbus_data.bt_module1_temp_min / 10,
                                           # 'unit': None,
                                           # 'name': 'Battery Module 1 Min Temp'
                                           },
@@ -532,40 +615,40 @@ class FirebaseMethods:
         # history_dict is a dictionary that will be uploaded to history in Firebase
         history_dict = {
             'time': current_time.strftime("%H%M%S"),
-            'ac1p': inverter_data_temp['ac1_power'],
-            'ac1v': inverter_data_temp['ac1_voltage'] / 10,
-            'ac1c': inverter_data_temp['ac1_current'] / 100,
+            'ac1p': float(modbus_data.ac1_power),
+            'ac1v': modbus_data.ac1_voltage / 10,
+            'ac1c': modbus_data.ac1_current / 100,
 
-            'ac2p': inverter_data_temp['ac2_power'],
-            'ac2v': inverter_data_temp['ac2_voltage'] / 10,
-            'ac2c': inverter_data_temp['ac2_current'] / 100,
+            'ac2p': float(modbus_data.ac2_power),
+            'ac2v': modbus_data.ac2_voltage / 10,
+            'ac2c': modbus_data.ac2_current / 100,
 
-            'dc1p': inverter_data_temp['dc1_power'],
-            'dc1v': inverter_data_temp['dc1_voltage'] / 10,
-            'dc1c': inverter_data_temp['dc1_current'] / 100,
+            'dc1p': float(modbus_data.dc1_power),
+            'dc1v': modbus_data.dc1_voltage / 10,
+            'dc1c': modbus_data.dc1_current / 100,
 
-            'dc2p': inverter_data_temp['dc2_power'],
-            'dc2v': inverter_data_temp['dc2_voltage'] / 10,
-            'dc2c': inverter_data_temp['dc2_current'] / 100,
+            'dc2p': float(modbus_data.dc2_power),
+            'dc2v': modbus_data.dc2_voltage / 10,
+            'dc2c': modbus_data.dc2_current / 100,
 
-            'dctp': inverter_data_temp['dc2_power'] + inverter_data_temp['dc1_power'],
+            'dctp': float(modbus_data.dc2_power + modbus_data.dc1_power),
 
-            # 'dsp_fw': inverter_data_temp['fw_dsp'],
-            # 'red_fw': inverter_data_temp['fw_red'],
-            # 'disp_fw': inverter_data_temp['fw_disp'],
+            # 'dsp_fw': fw_dsp,
+            # 'red_fw': fw_red,
+            # 'disp_fw': fw_disp,
 
-            'btp': float(-1 * bt_data_temp['bt_wattage']),
-            'btv': bt_data_temp['bt_voltage'] / 10,
-            'btc': bt_data_temp['bt_current'] / 100,
-            'btsoc': bt_data_temp['bt_soc'] / 10,
+            'btp': float(-1 * modbus_data.bt_wattage),
+            'btv': modbus_data.bt_voltage / 10,
+            'btc': modbus_data.bt_current / 100,
+            'btsoc': modbus_data.bt_soc / 10,
 
-            'utility_p': bt_data_temp['utility_power'],
-            'utility_c': bt_data_temp['utility_current'] / 100,
+            'utility_p': float(modbus_data.utility_power),
+            'utility_c': modbus_data.utility_current / 100,
 
-            'bt_module1_temp_min': bt_data_temp['bt_module1_temp_min'] / 10,
-            'bt_module1_temp_max': bt_data_temp['bt_module1_temp_max'] / 10,
+            'bt_module1_temp_min': modbus_data.bt_module1_temp_min / 10,
+            'bt_module1_temp_max': modbus_data.bt_module1_temp_max / 10,
 
-            'ac1_freq': inverter_data_temp['ac1_freq'] / 100
+            'ac1_freq': modbus_data.ac1_freq / 100
         }
 
         return final_data, history_dict
@@ -582,69 +665,70 @@ class FirebaseMethods:
             if self._LOG and not os.path.isfile(location + '.csv'):
                 with open(location + '.csv', 'a') as f:
                     writer = csv.writer(f)
-                    writer.writerow(
-                        ['time', 'ac1p', 'ac1v', 'ac1c', 'ac2p', 'ac2v', 'ac2c', 'dc1p', 'dc1v', 'dc1c', 'dc2p', 'dc2v',
-                         'dc2c', 'btp', 'btv', 'btc', 'btsoc', 'utility_p', 'utility_c', 'bt_module1_max_temp',
-                         'bt_module1_min_temp', 'ac1_freq'])
+                    writer.writerow(self._INVERTER_LOG_HEADER)
 
             # Log the data without header if initial_run is False and we have enabled logging
             if self._LOG and not initial_run:
                 current_time = datetime.now()
-                with open(location + '.csv', 'a') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(
-                        [str(current_time),
-                         data['inverter_data']['AC1 Power']['value'],
-                         data['inverter_data']['AC1 Voltage']['value'],
-                         data['inverter_data']['AC1 Current']['value'],
+                row = [data['inverter_data']['AC1 Power']['value'],
+                       data['inverter_data']['AC1 Voltage']['value'],
+                       data['inverter_data']['AC1 Current']['value'],
+
+                       data['inverter_data']['AC2 Power']['value'],
+                       data['inverter_data']['AC2 Voltage']['value'],
+                       data['inverter_data']['AC2 Current']['value'],
+
+                       data['inverter_data']['DC1 Power']['value'],
+                       data['inverter_data']['DC1 Voltage']['value'],
+                       data['inverter_data']['DC1 Current']['value'],
 
-                         data['inverter_data']['AC2 Power']['value'],
-                         data['inverter_data']['AC2 Voltage']['value'],
-                         data['inverter_data']['AC2 Current']['value'],
+                       data['inverter_data']['DC2 Power']['value'],
+                       data['inverter_data']['DC2 Voltage']['value'],
+                       data['inverter_data']['DC2 Current']['value'],
 
-                         data['inverter_data']['DC1 Power']['value'],
-                         data['inverter_data']['DC1 Voltage']['value'],
-                         data['inverter_data']['DC1 Current']['value'],
+                       data['bt_data']['Battery Wattage']['value'],
+                       data['bt_data']['Battery Voltage']['value'],
+                       data['bt_data']['Battery Current']['value'],
 
-                         data['inverter_data']['DC2 Power']['value'],
-                         data['inverter_data']['DC2 Voltage']['value'],
-                         data['inverter_data']['DC2 Current']['value'],
+                       data['bt_data']['Battery SOC']['value'],
 
-                         data['bt_data']['Battery Wattage']['value'],
-                         data['bt_data']['Battery Voltage']['value'],
-                         data['bt_data']['Battery Current']['value'],
+                       data['bt_data']['Utility AC Power']['value'],
+                       data['bt_data']['Utility AC Current']['value'],
 
-                         data['bt_data']['Battery SOC']['value'],
+                       data['bt_data']['Battery Module 1 Max Temp']['value'],
+                       data['bt_data']['Battery Module 1 Min Temp']['value'],
 
-                         data['bt_data']['Utility AC Power']['value'],
-                         data['bt_data']['Utility AC Current']['value'],
+                       data['inverter_data']['AC1 Frequency']['value']
+                       ]
 
-                         data['bt_data']['Battery Module 1 Max Temp']['value'],
-                         data['bt_data']['Battery Module 1 Min Temp']['value'],
+                self.log_writers.writerow('inverter_data', location + '.csv', [str(current_time)] + row,
+                                          header=self._INVERTER_LOG_HEADER)
+
+                # Also keep the row in our binary day file, which can be read back without parsing it
+                if self._LOG_DAY_STORE:
+                    try:
+                        append_record(day_store_path(current_time.strftime('%Y-%m-%d')), current_time.timestamp(),
+                                      row)
+                    except (OSError, struct.error) as e:
+                        log('Could not append to day store', e)
 
-                         data['inverter_data']['AC1 Frequency']['value']
-                         ])
+                if self.history_store is not None:
+                    self.history_store.insert_inverter_row(current_time.timestamp(), row)
 
         elif purpose == "log_charge_session":
             # If logging is turned on
             if self._LOG:
-                # Check if the folder for the charger exists
-                if not os.path.isdir('../data/charging_logs/' + location.split('/')[3]):
-                    os.makedirs('../data/charging_logs/' + location.split('/')[3])
-
-                # First check if there is a file for the log file we are opening
-                if not os.path.isfile(location + '.csv'):
-                    # If there isn't then, we create a new file to write the headers
-                    with open(location + '.csv', 'a') as f:
-                        writer = csv.writer(f)
-                        writer.writerow(
-                            ['time', 'voltage', 'current_import', 'power_import', 'energy_import', 'solar_power',
-                             'battery_power', 'battery_soc', 'battery_temp', 'grid_power'])
-
-                # Log the data that we got from the MeterValues message
-                with open(location + '.csv', 'a') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(data)
+                # Log the data that we got from the MeterValues message. Each charger has its own stream, so the file
+                # of a charger's last session is closed when its next session starts
+                self.log_writers.writerow('charge_session/' + location.split('/')[3], location + '.csv', data,
+                                          header=self._CHARGE_SESSION_LOG_HEADER)
+
+                if self.history_store is not None:
+                    try:
+                        self.history_store.insert_charge_session_row(location.split('/')[3], location.split('/')[4],
+                                                                     parse_log_time(data[0]), data[1:])
+                    except ValueError as e:
+                        log('Could not add charge session row to history store', e)
 
     def authenticate(self):
         log('Attempting to authenticate with Firebase')
@@ -657,6 +741,11 @@ class FirebaseMethods:
 
         self.firebase = pyrebase.initialize_app(config)
 
+        # Make all of our pyrebase requests through one pool of kept alive connections, so that we don't need a new TCP
+        # and TLS handshake for every request
+        self.http_session = PooledSession(max_connections=4)
+        self.firebase.requests = self.http_session
+
         # Get a reference to the auth service
         self.auth = self.firebase.auth()
 
@@ -686,6 +775,11 @@ class FirebaseMethods:
 
             self.db = self.firebase.database(timeout_length=5)
 
+            # Our uploader gets its own database object as it runs on its own thread. Writes that fail while we are
+            # offline are kept in our outbox until we are back online
+            self.uploader = FirebaseUploader(self.firebase.database(timeout_length=5), lambda: self.idToken,
+                                             self.handle_internet_check, outbox=FirebaseOutbox())
+
             # The first thing we need to do is to make sure all of the values we need to stream for are there
             self.initialize_firebase_db_values()
 
@@ -1093,22 +1187,14 @@ class FirebaseMethods:
                     if new_data_charging_status is True and temp_charging_timestamp:
                         log('The charging timestamp received is', temp_charging_timestamp, 'continuing...')
 
-                        try:
-                            # If we are online in general then we need to update our evc_inputs charging status
-                            self.db.child("users").child(self.uid).child("evc_inputs/charging").update(
-                                {temp_chargerID: new_data_charging_status}, self.idToken)
-                        except OSError as e:
-                            log('charging status - charging time out', e)
-                            self.handle_internet_check()
+                        # If we are online in general then we need to update our evc_inputs charging status
+                        self.uploader.update('users/' + self.uid + '/evc_inputs/charging',
+                                             {temp_chargerID: new_data_charging_status})
 
                     elif new_data_charging_status is False or new_data_charging_status == "plugged":
-                        try:
-                            # If we are online in general then we need to update our evc_inputs charging status
-                            self.db.child("users").child(self.uid).child("evc_inputs/charging").update(
-                                {temp_chargerID: new_data_charging_status}, self.idToken)
-                        except OSError as e:
-                            log('charging status - not charging time out', e)
-                            self.handle_internet_check()
+                        # If we are online in general then we need to update our evc_inputs charging status
+                        self.uploader.update('users/' + self.uid + '/evc_inputs/charging',
+                                             {temp_chargerID: new_data_charging_status})
 
             elif new[0] == "transaction_alert":
                 """ If there is a StartTransaction or StopTransaction message """
@@ -1143,14 +1229,8 @@ class FirebaseMethods:
 
                     # (Online) Update charging history keys
                     if self._ONLINE:
-                        try:
-                            self.db.child("users").child(self.uid).child("charging_history_keys").child(
-                                temp_chargerID).child(charging_timestamp.split(' ')[0]).update(
-                                {charging_timestamp.split(' ')[1]: True}, self.idToken)
-                        except OSError:
-                            log('transaction_alert - start charging history keys time out')
-                            self.handle_internet_check()
-                            # Todo: put this in the once-online to do queue
+                        self.uploader.update('users/' + self.uid + '/charging_history_keys/' + temp_chargerID + '/' +
+                                             charging_timestamp.split(' ')[0], {charging_timestamp.split(' ')[1]: True})
 
                 # If we got a StopTransaction message
                 elif is_start_transaction_message is False:
@@ -1168,37 +1248,17 @@ class FirebaseMethods:
 
                             log('We have a stop transaction, total charge duration is', total_charge_duration)
                             # Upload our analytics to analytics->charging_history_analytics->chargerID->date->time
-                            try:
-                                self.db.child("users").child(self.uid).child(
-                                    "analytics/charging_history_analytics").child(
-                                    temp_chargerID).child(
-                                    self._charger_status_list[temp_chargerID]['charging_timestamp'].split(' ')[
-                                        0]).child(
-                                    self._charger_status_list[temp_chargerID]['charging_timestamp'].split(' ')[
-                                        1]).update(
-                                    {'energy': total_energy_charged, 'duration_seconds': total_charge_duration},
-                                    self.idToken)
-
-                                # If 'charging' is False then we need to update our charging database
-                                upload_thread = Thread(target=self.ftp_upload_charge_session(temp_chargerID,
-                                                                                             self._charger_status_list[
-                                                                                                 temp_chargerID][
-                                                                                                 'charging_timestamp']))
-                                upload_thread.daemon = True
-                                upload_thread.start()
-
-                                # Delete the charging history record
-                                self.db.child("users").child(self.uid).child("charging_history").child(
-                                    temp_chargerID).child(
-                                    self._charger_status_list[temp_chargerID]['charging_timestamp']).remove(
-                                    self.idToken)
-
-                            except OSError as e:
-                                log(e)
-                                log('transation alert - stop, charging history analytics time out')
-                                log('transation alert - stop upload charge session time out')
-                                self.handle_internet_check()
-                                # Todo: Make sure we add this to the once-online todo queue
+                            charging_timestamp = self._charger_status_list[temp_chargerID]['charging_timestamp']
+                            self.uploader.update(
+                                'users/' + self.uid + '/analytics/charging_history_analytics/' + temp_chargerID + '/' +
+                                charging_timestamp.split(' ')[0] + '/' + charging_timestamp.split(' ')[1],
+                                {'energy': total_energy_charged, 'duration_seconds': total_charge_duration})
+
+                            # If 'charging' is False then we need to update our charging database
+                            upload_thread = Thread(target=self.close_charge_session,
+                                                   args=(temp_chargerID, charging_timestamp))
+                            upload_thread.daemon = True
+                            upload_thread.start()
 
                         except TypeError as e:
                             # If we get a TypeError it is because our OCPP server crashed. For now, remove all traces
@@ -1212,13 +1272,9 @@ class FirebaseMethods:
 
                 # (Online) Update evc_inputs charging status for that chargerID now that everything is set up
                 if self._ONLINE:
-                    try:
-                        # Update our evc_inputs charging status
-                        self.db.child("users").child(self.uid).child("evc_inputs/charging").update(
-                            {temp_chargerID: is_start_transaction_message}, self.idToken)
-                    except OSError as e:
-                        log('translation alert end time out', e)
-                        self.handle_internet_check()
+                    # Update our evc_inputs charging status
+                    self.uploader.update('users/' + self.uid + '/evc_inputs/charging',
+                                         {temp_chargerID: is_start_transaction_message})
 
                 log("Finished our a Transaction message, new charger list:", self._charger_status_list)
 
@@ -1273,13 +1329,9 @@ class FirebaseMethods:
 
                 # (If we are online) We update the information about our charger in Firebase
                 if self._ONLINE:
-                    try:
-                        log('Uploading', temp_charger_info, 'to Firebase for', temp_chargerID)
-                        self.db.child("users").child(self.uid).child("evc_inputs").child(temp_chargerID).update(
-                            {"charger_info": temp_charger_info}, self.idToken)
-                    except OSError as e:
-                        log('new charger info timeout', e)
-                        self.handle_internet_check()
+                    log('Uploading', temp_charger_info, 'to Firebase for', temp_chargerID)
+                    self.uploader.update('users/' + self.uid + '/evc_inputs/' + temp_chargerID,
+                                         {"charger_info": temp_charger_info})
 
             # Alive is received AFTER EVERY OCPP MESSAGE TO A CHARGE POINT
             elif new[0] == "alive":
@@ -1290,17 +1342,11 @@ class FirebaseMethods:
 
                 # Update our alive value for that charger in Firebase
                 if self._ONLINE:
-                    try:
-                        # Post our alive status to evc_inputs in Firebase
-                        self.db.child("users").child(self.uid).child("evc_inputs").child(temp_chargerID).update(
-                            {"alive": new[1]}, self.idToken)
+                    # Post our alive status to evc_inputs in Firebase
+                    self.uploader.update('users/' + self.uid + '/evc_inputs/' + temp_chargerID, {"alive": new[1]})
 
-                        # Post our charger to ev_chargers in Firebase
-                        self.db.child("users").child(self.uid).child('ev_chargers').update({temp_chargerID: True},
-                                                                                           self.idToken)
-                    except OSError as e:
-                        log('evc_inputs alive true timeout', e)
-                        self.handle_internet_check()
+                    # Post our charger to ev_chargers in Firebase
+                    self.uploader.update('users/' + self.uid + '/ev_chargers', {temp_chargerID: True})
 
                 # If alive is True...
                 if temp_alive:
@@ -1325,13 +1371,8 @@ class FirebaseMethods:
 
                     # We also have to update the evc_inputs charging status
                     if self._ONLINE:
-                        try:
-                            # Todo: make sure this is what we want - especially if we are in the middle of charging
-                            self.db.child('users').child(self.uid).child('evc_inputs').child(temp_chargerID).update(
-                                {'alive': False}, self.idToken)
-                        except OSError as e:
-                            log('evc_inputs alive false timeout', e)
-                            self.handle_internet_check()
+                        # Todo: make sure this is what we want - especially if we are in the middle of charging
+                        self.uploader.update('users/' + self.uid + '/evc_inputs/' + temp_chargerID, {'alive': False})
 
                 log('*****************************************************************')
                 log(datetime.now().strftime('%H:%M:%S'), 'Update on our charger status list:')
@@ -1415,23 +1456,19 @@ class FirebaseMethods:
                                 data=temp_metervalue_entry)
 
                             if self._ONLINE:
-                                try:
-                                    # (If we are online) Update our charge history
-                                    self.db.child("users").child(self.uid).child("charging_history").child(
-                                        temp_chargerID).child(
-                                        self._charger_status_list[temp_chargerID]['charging_timestamp']).push(
-                                        {"Time": temp_metervalue_entry[0], "Voltage": temp_metervalue_entry[1],
-                                         "Current_Import": temp_metervalue_entry[2],
-                                         "Power_Import": temp_metervalue_entry[3],
-                                         "Energy_Import_Aggregate": temp_metervalue_entry[4],
-                                         "Solar_Power": temp_metervalue_entry[5],
-                                         'Battery_Power': temp_metervalue_entry[6],
-                                         'Battery_SOC': temp_metervalue_entry[7],
-                                         'Battery_Temperature': temp_metervalue_entry[8],
-                                         'Grid_Power': temp_metervalue_entry[9]}, self.idToken)
-                                except OSError as e:
-                                    log('Meter value timed out', e)
-                                    self.handle_internet_check()
+                                # (If we are online) Update our charge history
+                                self.uploader.push(
+                                    'users/' + self.uid + '/charging_history/' + temp_chargerID + '/' +
+                                    self._charger_status_list[temp_chargerID]['charging_timestamp'],
+                                    {"Time": temp_metervalue_entry[0], "Voltage": temp_metervalue_entry[1],
+                                     "Current_Import": temp_metervalue_entry[2],
+                                     "Power_Import": temp_metervalue_entry[3],
+                                     "Energy_Import_Aggregate": temp_metervalue_entry[4],
+                                     "Solar_Power": temp_metervalue_entry[5],
+                                     'Battery_Power': temp_metervalue_entry[6],
+                                     'Battery_SOC': temp_metervalue_entry[7],
+                                     'Battery_Temperature': temp_metervalue_entry[8],
+                                     'Grid_Power': temp_metervalue_entry[9]})
 
                 except KeyError as e:
                     log('charger ID does not exist in charger list yet', e)
@@ -1639,6 +1676,7 @@ class FirebaseMethods:
                 filename = charging_timestamp + '.csv'
                 with open('../data/charging_logs/' + charger_id + '/' + filename, 'rb') as file:
                     ftp.storbinary('STOR ' + filename, file)
+                    self.record_ftp_upload(file)
 
         except FileNotFoundError:
             log('Tried to upload but we got a FileNotFound Error!')
@@ -1648,10 +1686,43 @@ class FirebaseMethods:
             charge_time = charging_timestamp.split(' ')[1]
 
             # Delete our Firebase history key
-            self.db.child("users").child(self.uid).child('charging_history_keys').child(charger_id).child(
-                charge_date).child(charge_time).remove(self.idToken)
-            self.db.child("users").child(self.uid).child('analytics').child('charging_history_analytics').child(
-                charger_id).child(charge_date).child(charge_time).remove(self.idToken)
+            self.uploader.remove('users/' + self.uid + '/charging_history_keys/' + charger_id + '/' + charge_date +
+                                 '/' + charge_time)
+            self.uploader.remove('users/' + self.uid + '/analytics/charging_history_analytics/' + charger_id + '/' +
+                                 charge_date + '/' + charge_time)
+
+    def close_charge_session(self, charger_id, charging_timestamp):
+        """ Uploads a finished charging session to the FTP server and then deletes its live charging history """
+        try:
+            self.ftp_upload_charge_session(charger_id, charging_timestamp)
+        except (OSError, error_perm) as e:
+            log('transation alert - stop upload charge session time out', e)
+            self.handle_internet_check()
+            return
+
+        # Delete the charging history record
+        self.uploader.remove('users/' + self.uid + '/charging_history/' + charger_id + '/' + charging_timestamp)
+
+    def record_ftp_upload(self, file):
+        """ Charges a file that we have just uploaded to our data budget """
+        if self.data_budget is not None:
+            self.data_budget.record('ftp', file.tell())
+
+    def apply_data_budget(self):
+        """ Charges what we have sent and received through Firebase since last time to our data budget, then sets our
+        upload intervals from what is left of it """
+        if self.http_session is not None:
+            http_bytes = self.http_session.bytes_sent + self.http_session.bytes_received
+            self.data_budget.record('firebase', http_bytes - self._http_bytes_recorded)
+            self._http_bytes_recorded = http_bytes
+
+        intervals = self.data_budget.update()
+        self.live_counter_max = intervals['live']
+        self.history_counter_max = intervals['history']
+        self.webanalytics_counter_max = intervals['analytics']
+        self.data_budget.save()
+
+        log('Data budget:', self.data_budget.stats())
 
     def perform_file_integrity_check(self, full_check=True):
         self.handle_charging_database(full_check)
@@ -1663,6 +1734,13 @@ class FirebaseMethods:
 
         local_charging_folder_list = os.listdir('../data/charging_logs/')
 
+        # If we have a history store, an incremental check only looks at the sessions that changed since the last one
+        sync_time = time.time()
+        changed_sessions = None
+        if self.history_store is not None and not full_check and self._last_charging_sync is not None:
+            self.history_store.commit()
+            changed_sessions = self.history_store.charge_sessions_since(self._last_charging_sync)
+
         with FTP(host=self._FTP_HOST) as ftp:
             ftp.login(user=self._FTP_USER, passwd=self._FTP_PW)
 
@@ -1681,6 +1759,11 @@ class FirebaseMethods:
                 if full_check:
                     final_local_csv_list = local_csv_list
 
+                # If we know which sessions have changed, we only take those
+                elif changed_sessions is not None:
+                    final_local_csv_list = [filename for filename in local_csv_list
+                                            if (charger_id, filename.split('.csv')[0]) in changed_sessions]
+
                 # If we aren't doing a full check, we take 10 of our latest csv files
                 else:
                     final_local_csv_list = sorted(local_csv_list, reverse=True)[:5]
@@ -1711,6 +1794,7 @@ class FirebaseMethods:
                             log('local and ftp are not the same, updating ftp')
                             with open('../data/charging_logs/' + charger_id + '/' + filename, 'rb') as file:
                                 ftp.storbinary('STOR ' + filename, file)
+                                self.record_ftp_upload(file)
                         else:
                             # File sizes are the same. Don't need to do anything
                             log('File sizes are the same. Moving to the next date...')
@@ -1724,6 +1808,7 @@ class FirebaseMethods:
                             log(filename, 'does not exist on ftp server, upload it now')
                             with open('../data/charging_logs/' + charger_id + '/' + filename, 'rb') as file:
                                 ftp.storbinary('STOR ' + filename, file)
+                                self.record_ftp_upload(file)
 
                 ########################################################################################################
                 # Now we need to make sure that the FTP server does not have any files that local does not have
@@ -1832,45 +1917,13 @@ class FirebaseMethods:
                 # Now make sure that Firebase charging_history_analytics contains analytics for every session in keys
                 ########################################################################################################
 
+        self._last_charging_sync = sync_time
+
     @staticmethod
     def analyze_csv_integrity(csv_filename):
-        """ This function analyzes the csv file and makes sure that there are no NULL bytes """
-
-        def fix_nulls(s):
-            """ This function takes a generator that replaces NULL bytes with blank """
-            for line in s:
-                yield line.replace('\0', '')
-
+        """ This function makes sure that the csv file has no NULL bytes in it """
         try:
-            fixed_csv_list = None
-
-            with open('../data/logs/' + csv_filename) as csvfile:
-                if '\0' in csvfile.read():
-                    log('We found a null byte, lets fix it')
-
-                    # Reset our csv iterator
-                    csvfile.seek(0)
-
-                    # Remove the NULL bytes from the csv file
-                    fixed_csv = csv.reader(fix_nulls(csvfile))
-                    fixed_csv_list = list()
-
-                    # Now save the rows to a list
-                    for row in fixed_csv:
-                        fixed_csv_list.append(row)
-
-            # If a list exists then we know that there was something wrong so we need to rewrite the csv file
-            if fixed_csv_list:
-                # Open the corrupt csv
-                with open('../data/logs/' + csv_filename, mode='w', newline='') as f:
-                    writer = csv.writer(f)
-
-                    # Write the uncorrupt rows to it and replace the file
-                    for row in fixed_csv_list:
-                        if len(row) != 0:
-                            writer.writerow(row)
-
-                log('Fixed the csv file!!')
+            repair_csv_tail('../data/logs/' + csv_filename)
 
         except FileNotFoundError as e:
             log('File doesnt exist! Skipping integrity check')
@@ -1879,6 +1932,11 @@ class FirebaseMethods:
         """ This ensures that all of the local csv files are in the FTP server """
         log('\nChecking our inverter_logs database now...')
 
+        # Make sure that the history store has every row that we have logged up to now
+        sync_time = time.time()
+        if self.history_store is not None:
+            self.history_store.commit()
+
         # Post the current date to history_keys
         self.db.child("users").child(self.uid).child("history_keys").update(
             {datetime.now().strftime("%Y-%m-%d"): True}, self.idToken)
@@ -1933,6 +1991,12 @@ class FirebaseMethods:
             if full_check:
                 final_local_csv_list = local_csv_list
 
+            # If we have a history store, we only take the days that have changed since the last check
+            elif self.history_store is not None and self._last_inverter_sync is not None:
+                changed_days = self.history_store.inverter_days_since(self._last_inverter_sync)
+                final_local_csv_list = [filename for filename in local_csv_list
+                                        if filename.split('.')[0] in changed_days]
+
             # If we aren't doing a full check, we take 10 of our latest csv files
             else:
                 final_local_csv_list = sorted(local_csv_list, reverse=True)[:5]
@@ -1953,6 +2017,7 @@ class FirebaseMethods:
                             log('local and ftp are not the same, updating ftp')
                             with open('../data/logs/' + filename, 'rb') as file:
                                 ftp.storbinary('STOR ' + filename, file)
+                                self.record_ftp_upload(file)
                         else:
                             # File sizes are the same. Don't need to do anything
                             log('File sizes are the same. Moving to the next date...')
@@ -1962,6 +2027,7 @@ class FirebaseMethods:
                         log(filename, 'does not exist on ftp server, upload it now')
                         with open('../data/logs/' + filename, 'rb') as file:
                             ftp.storbinary('STOR ' + filename, file)
+                            self.record_ftp_upload(file)
 
             ############################################################################################################
             # Now make sure that the server does not have any files that local does not have
@@ -2027,6 +2093,8 @@ class FirebaseMethods:
         firebase_csv_name = (datetime.now() - timedelta(2)).strftime("%Y-%m-%d")
         self.db.child("users").child(self.uid).child("history").child(firebase_csv_name).remove(self.idToken)
 
+        self._last_inverter_sync = sync_time
+
         # # Finally we need to delete the unnecessary entries in history to save space
         # for firebase_csv_name in firebase_csv_list:
         #     log('Checking:', firebase_csv_name, 'from history')
@@ -2076,24 +2144,32 @@ class FirebaseMethods:
 
             self.log_counter += 1
 
+            # Once a minute we work out how often we can upload from our data budget
+            if self.data_budget is not None and time.monotonic() >= self._next_data_budget_update:
+                self._next_data_budget_update = time.monotonic() + 60
+                self.apply_data_budget()
+
             if self._ONLINE:
                 # (If we are online) Now push it to the live database - more for debug purposes (not limiting data)
-                if not self._LIMIT_DATA:
-                    try:
-                        self.db.child("users").child(self.uid).child("live_database").update(firebase_ready_data,
-                                                                                             self.idToken)
-                    except OSError as e:
-                        log('update_firebase live database timed out', e)
-                        self.handle_internet_check()
-
-                # (If we are online) Push data to history so we can bring it up in the future
-                if self.history_counter == self.history_counter_max:
-                    try:
-                        self.db.child("users").child(self.uid).child("history").child(
-                            current_time.strftime("%Y-%m-%d")).push(history_ready_data, self.idToken)
-                    except OSError as e:
-                        log('update_firebase history timed out', e)
-                        self.handle_internet_check()
+                if self.live_counter_max is not None and self.live_counter >= self.live_counter_max:
+                    live_update = self.live_database_encoder.encode(firebase_ready_data)
+                    self.uploader.update('users/' + self.uid + '/live_database', live_update)
+                    if self.data_budget is not None:
+                        self.data_budget.record_payload('live', len(json.dumps(live_update)))
+
+                    self.live_counter = 0
+
+                self.live_counter += 1
+
+                # (If we are online) Push data to history so we can bring it up in the future. Each record sums up
+                # the samples since the last one
+                self.history_downsampler.add(history_ready_data)
+                if self.history_counter >= self.history_counter_max:
+                    history_record = self.history_downsampler.emit()
+                    self.uploader.push('users/' + self.uid + '/history/' + current_time.strftime("%Y-%m-%d"),
+                                       history_record)
+                    if self.data_budget is not None:
+                        self.data_budget.record_payload('history', len(json.dumps(history_record)))
 
                     self.history_counter = 0
 
@@ -2158,28 +2234,20 @@ class FirebaseMethods:
             log('Updating the charge mode from analyze_to_firebase queue')
             # (If we are online) then we update our charge mode in Firebase
             if self._ONLINE:
-                try:
-                    self.db.child("users").child(self.uid).child('evc_inputs/charging_modes').update(
-                        {'single_charging_mode': new_charge_mode}, self.idToken)
-                    log('Updated charge mode in Firebase - check if web interface is showing this change')
-                except OSError as e:
-                    log('update_firebase update charge mode timed out', e)
-                    self.handle_internet_check()
+                self.uploader.update('users/' + self.uid + '/evc_inputs/charging_modes',
+                                     {'single_charging_mode': new_charge_mode})
 
         # Updating analytics requires us to be online
         elif self._ONLINE and label == "analytics_data":
             payload.update({'time': str(current_time)})
 
             # We will update analytics data every "webanalytics_counter_max" seconds
-            if self.webanalytics_counter == self.webanalytics_counter_max:
+            if self.webanalytics_counter >= self.webanalytics_counter_max:
                 log('updating analytics')
 
-                try:
-                    self.db.child("users").child(self.uid).child("analytics/live_analytics").update(payload,
-                                                                                                    self.idToken)
-                except OSError as e:
-                    log('update_firebase live analytics timed out', e)
-                    self.handle_internet_check()
+                self.uploader.update('users/' + self.uid + '/analytics/live_analytics', payload)
+                if self.data_budget is not None:
+                    self.data_budget.record_payload('analytics', len(json.dumps(payload)))
 
                 self.webanalytics_counter = 0
 
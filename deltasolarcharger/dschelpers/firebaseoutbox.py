@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import sqlite3
+
+from utils import log
+
+
+def overlaps(path, other_path):
+    """ Returns True if one of the paths is the same as or inside the other """
+    return path == other_path or path.startswith(other_path + '/') or other_path.startswith(path + '/')
+
+
+def can_merge(update, data):
+    """ Returns True if the keys of data can be merged into update. A key can replace the same key, but not one that is
+    inside it or that it is inside (eg. a live_database keyframe and a delta of it), as Firebase won't take an update
+    with both and merging them would lose their order """
+    keys = {key.strip('/') for key in update}
+    parents = {key.rsplit('/', i)[0] for key in keys for i in range(1, key.count('/') + 1)}
+
+    for key in data:
+        key = key.strip('/')
+        if key in parents or any(key.rsplit('/', i)[0] in keys for i in range(1, key.count('/') + 1)):
+            return False
+    return True
+
+
+class FirebaseOutbox:
+    """ A journal on disk of the Firebase writes that we couldn't send, so that they survive an outage (or a restart)
+    and can be sent once we are back online.
+
+    Writes are kept as (method, path, data) in the order that they were made. Every write that we journal is idempotent
+    (pushes are turned into updates under a push key before they get here), so a write that gets sent twice does no
+    harm. The connection is opened on first use, and the outbox should only be used from one thread.
+
+    The outbox holds at most max_pending writes (about 9 hours of them at our usual rate), and past that the oldest are
+    dropped to make room so that a long outage can't fill the SD card. Writes that Firebase rejects are moved to a
+    dead_letters table, which keeps the latest max_dead_letters of them, so that we can see what went wrong """
+
+    def __init__(self, path='../data/outbox.sqlite', max_pending=100000, max_dead_letters=1000):
+        self.path = path
+        self.max_pending = max_pending
+        self.max_dead_letters = max_dead_letters
+        self._connection = None
+
+        # The number of writes waiting to be sent
+        self.pending = 0
+
+        # The number of writes that we dropped because the outbox was full
+        self.dropped = 0
+
+    def connection(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'method TEXT NOT NULL, path TEXT NOT NULL, data TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'time REAL NOT NULL, method TEXT NOT NULL, path TEXT NOT NULL, data TEXT, reason TEXT)')
+            connection.commit()
+
+            self.pending = connection.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+            self._connection = connection
+
+        return self._connection
+
+    def open(self):
+        """ Opens the outbox and returns how many writes are waiting in it """
+        try:
+            self.connection()
+        except sqlite3.Error as e:
+            log('Could not open Firebase outbox', e)
+        return self.pending
+
+    def add(self, writes):
+        """ Journals a list of (method, path, data) writes. Returns False if they couldn't be saved """
+        try:
+            connection = self.connection()
+            with connection:
+                connection.executemany('INSERT INTO outbox (method, path, data) VALUES (?, ?, ?)',
+                                       [(method, path, json.dumps(data)) for method, path, data in writes])
+
+                overflow = self.pending + len(writes) - self.max_pending
+                if overflow > 0:
+                    connection.execute('DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)',
+                                       (overflow,))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            log('Could not save', len(writes), 'writes to Firebase outbox', e)
+            return False
+
+        self.pending += len(writes)
+        if overflow > 0:
+            if not self.dropped:
+                log('Firebase outbox is full, dropping the oldest writes')
+            self.pending -= overflow
+            self.dropped += overflow
+        return True
+
+    def dead_letter(self, write, reason):
+        """ Keeps a write that Firebase rejected, along with why, in place of sending it """
+        method, path, data = write
+        try:
+            connection = self.connection()
+            with connection:
+                connection.execute('INSERT INTO dead_letters (time, method, path, data, reason) VALUES (?, ?, ?, ?, ?)',
+                                   (time.time(), method, path, json.dumps(data), str(reason)))
+                connection.execute('DELETE FROM dead_letters WHERE id <= (SELECT MAX(id) FROM dead_letters) - ?',
+                                   (self.max_dead_letters,))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            log('Could not save rejected', method, 'of', path, 'to Firebase outbox', e)
+
+    def dead_letters(self):
+        """ Returns the writes that Firebase rejected as (method, path, data, reason), oldest first """
+        try:
+            rows = self.connection().execute('SELECT method, path, data, reason FROM dead_letters '
+                                             'ORDER BY id').fetchall()
+        except sqlite3.Error as e:
+            log('Could not read Firebase dead letters', e)
+            return list()
+        return [(method, path, json.loads(data), reason) for method, path, data, reason in rows]
+
+    def batch(self, max_writes=5, max_rows=500):
+        """ Reads the oldest writes in the outbox and coalesces them, so that a run of updates to the same path is sent
+        as one update (unless their keys overlap, see can_merge). Returns up to max_writes coalesced writes along with
+        the id of the last row that they cover, to be passed to discard once they have been sent """
+        try:
+            rows = self.connection().execute('SELECT id, method, path, data FROM outbox ORDER BY id LIMIT ?',
+                                             (max_rows,)).fetchall()
+        except sqlite3.Error as e:
+            log('Could not read Firebase outbox', e)
+            return list(), None
+
+        if not rows:
+            self.pending = 0
+
+        writes = list()
+        last_id = None
+
+        # The updates in writes that later updates to the same path can still be merged into
+        updates = dict()
+
+        for row_id, method, path, data in rows:
+            data = json.loads(data)
+
+            if method == 'update' and path in updates and can_merge(updates[path], data):
+                updates[path].update(data)
+
+            else:
+                if len(writes) == max_writes:
+                    break
+
+                # Merging a later update into one from before this write would reorder them, so an update that
+                # overlaps this write can't be merged into any more
+                for update_path in [update_path for update_path in updates if overlaps(update_path, path)]:
+                    del updates[update_path]
+
+                if method == 'update':
+                    updates[path] = dict(data)
+                    writes.append((method, path, updates[path]))
+                else:
+                    writes.append((method, path, data))
+
+            last_id = row_id
+
+        return writes, last_id
+
+    def discard(self, last_id):
+        """ Removes the writes up to and including last_id, once they have been sent """
+        try:
+            connection = self.connection()
+            with connection:
+                connection.execute('DELETE FROM outbox WHERE id <= ?', (last_id,))
+            self.pending = connection.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        except sqlite3.Error as e:
+            log('Could not discard from Firebase outbox', e)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,368 @@
+import time
+import random
+from collections import deque
+from threading import Thread, Condition
+
+from utils import log
+
+# The characters of a Firebase push key, in the order that they sort in
+_PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+# 4xx statuses that don't mean the write itself is bad, so we try it again later
+_RETRY_STATUSES = (408, 429)
+
+
+def rejected_status(error):
+    """ Returns the HTTP status if error means that Firebase rejected our write (a 4xx), or None if we just couldn't
+    get it there (no connection, a timeout or a 5xx), in which case it is worth sending again once we are back online.
+    pyrebase raises requests' HTTPError with the original one, which has the response, as its first argument """
+    for candidate in (error,) + error.args[:1]:
+        status = getattr(getattr(candidate, 'response', None), 'status_code', None)
+        if status is not None:
+            return status if 400 <= status < 500 and status not in _RETRY_STATUSES else None
+    return None
+
+
+def merge_writes(writes):
+    """ Turns a list of (method, path, data) writes into as few multi-path updates as we can, each of which is sent as
+    a single PATCH. Every write is flattened into the locations that it changes (an update changes each of its keys, a
+    set or remove changes its path) and these are collected under the deepest path that they have in common.
+
+    Firebase won't take a multi-path update where one location is inside another, and the order of the writes would be
+    lost if we merged them, so a location that overlaps one that is already in the update starts a new update. This
+    holds for the locations of a single write too, so a write can be split over two updates. A later write to the same
+    location just replaces the earlier value, as it would if they were sent one after the other.
+
+    Returns a list of (path, data, writes) for each update, where writes are the writes that it covers (a write that is
+    split is covered by the last update that it is in) """
+
+    updates = list()
+    locations = dict()
+    parents = set()
+    covered = list()
+
+    for write in writes:
+        method, path, data = write
+        base = tuple(part for part in path.split('/') if part)
+
+        if method == 'update':
+            changes = [(base + tuple(part for part in key.split('/') if part), value) for key, value in data.items()]
+        elif method == 'set':
+            changes = [(base, data)]
+        elif method == 'remove':
+            changes = [(base, None)]
+        else:
+            raise ValueError('Unknown Firebase method ' + method)
+
+        for location, value in changes:
+            if location in parents or any(location[:i] in locations for i in range(len(location))):
+                updates.append(_multi_path_update(locations, covered))
+                locations, parents, covered = dict(), set(), list()
+
+            locations[location] = value
+            parents.update(location[:i] for i in range(len(location)))
+        covered.append(write)
+
+    if covered:
+        updates.append(_multi_path_update(locations, covered))
+
+    return updates
+
+
+def _multi_path_update(locations, covered):
+    # Find the deepest path that all of our locations are below
+    root = list()
+    if locations:
+        shortest = min(len(location) for location in locations)
+        for i in range(shortest - 1):
+            parts = {location[i] for location in locations}
+            if len(parts) != 1:
+                break
+            root.append(parts.pop())
+
+    data = {'/'.join(location[len(root):]): value for location, value in locations.items()}
+    return '/'.join(root), data, covered
+
+
+class FirebaseUploader(Thread):
+    """ Sends our Firebase writes (live data, history, analytics and charging status) on a thread of its own, so that a
+    slow request over 3G never holds up the charge rates that we send to the chargers.
+
+    Writes are queued as (method, path, data), where method is 'update', 'set' or 'remove' and path is relative to the
+    root of the database. They are held until tick is called (once around our main loop), and then everything that was
+    queued since the last tick is sent in order as one multi-path update (see merge_writes) rather than a request each.
+    The queue holds at most maxsize writes, and when it is full we drop the oldest one to make room. Pushes get their
+    key here rather than from Firebase, so every write can safely be sent more than once.
+
+    If we have an outbox (see firebaseoutbox), a write that fails is journaled in it instead of being lost, and so is
+    every write after it until resume is called to say that we are back online. The outbox is then replayed, at most
+    replay_writes coalesced writes every replay_interval seconds, and new writes are added to the end of it until it is
+    empty so that everything still reaches Firebase in order.
+
+    Only a lost connection, a timeout or a 5xx puts us offline. A write that Firebase rejects with a 4xx would be
+    rejected again however often we sent it, so it is logged and dead lettered in the outbox (see rejected_status) and
+    we carry on with the next one. A 401 is also what an expired idToken gets, so we go offline (which gets us a new
+    token) for the first max_auth_failures of them in a row, and only after that treat it as a rejection.
+
+    The uploader has its own pyrebase database object, as a database object keeps the path that child() builds up and
+    so can't be shared between threads. get_token is called before every write so that we always use the latest
+    idToken, and on_error is called when a write fails because we lost our connection """
+
+    def __init__(self, database, get_token, on_error=None, maxsize=256, outbox=None, replay_writes=100,
+                 replay_interval=2, max_auth_failures=3):
+        super().__init__()
+        self.name = 'FirebaseUploader'
+        self.daemon = True
+
+        self.database = database
+        self.get_token = get_token
+        self.on_error = on_error
+        self.maxsize = maxsize
+
+        self.outbox = outbox
+        self.replay_writes = replay_writes
+        self.replay_interval = replay_interval
+        self.max_auth_failures = max_auth_failures
+
+        self._queue = deque()
+        self._condition = Condition()
+        self._stopping = False
+
+        # Has tick been called since we last sent our writes?
+        self._ticked = False
+
+        # Are we sending our writes, or journaling them until we are back online?
+        self.online = True
+        self._next_replay = 0
+
+        # The number of 401s that we have had since we last got through a whole tick or replay batch. Earlier updates in
+        # a batch may well go through before the one that keeps failing, so a single success doesn't reset it
+        self._auth_failures = 0
+
+        self._last_push_time = 0
+        self._last_push_random = [0] * 12
+
+        self.sent = 0
+        self.requests = 0
+        self.failed = 0
+        self.dropped = 0
+        self.journaled = 0
+        self.replayed = 0
+        self.rejected = 0
+
+    def update(self, path, data):
+        self.submit('update', path, data)
+
+    def push(self, path, data):
+        """ Adds data under a new push key at path """
+        with self._condition:
+            key = self.push_key()
+        self.submit('update', path, {key: data})
+
+    def set(self, path, data):
+        self.submit('set', path, data)
+
+    def remove(self, path):
+        self.submit('remove', path)
+
+    def submit(self, method, path, data=None):
+        """ Queues a write. This never blocks """
+        with self._condition:
+            if len(self._queue) >= self.maxsize:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((method, path, data))
+
+    def tick(self):
+        """ Sends everything that has been queued since the last tick """
+        with self._condition:
+            self._ticked = True
+            self._condition.notify()
+
+    def push_key(self):
+        """ Makes a key in the same form as the ones that Firebase makes for a push: the time in milliseconds followed
+        by 72 random bits, so keys sort in the order that they were made """
+        now = int(time.time() * 1000)
+        if now == self._last_push_time:
+            # Two keys in the same millisecond, so add one to the last random part so that they still sort in order
+            for i in range(11, -1, -1):
+                if self._last_push_random[i] < 63:
+                    self._last_push_random[i] += 1
+                    break
+                self._last_push_random[i] = 0
+        else:
+            self._last_push_random = [random.randrange(64) for _ in range(12)]
+        self._last_push_time = now
+
+        time_chars = ''
+        for _ in range(8):
+            time_chars = _PUSH_CHARS[now % 64] + time_chars
+            now //= 64
+
+        return time_chars + ''.join(_PUSH_CHARS[i] for i in self._last_push_random)
+
+    def resume(self):
+        """ Called once we are back online, to start sending our writes again """
+        with self._condition:
+            if not self.online:
+                log('Firebase uploader is back online,', self.outbox.pending if self.outbox else 0, 'writes to replay')
+            self.online = True
+            # Give the main thread a moment to pick up the idToken that was refreshed when we came back online
+            self._next_replay = time.monotonic() + self.replay_interval
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {'queued': len(self._queue), 'sent': self.sent, 'requests': self.requests, 'failed': self.failed,
+                    'dropped': self.dropped + (self.outbox.dropped if self.outbox is not None else 0),
+                    'journaled': self.journaled, 'replayed': self.replayed, 'rejected': self.rejected,
+                    'outbox': self.outbox.pending if self.outbox is not None else 0}
+
+    def stop(self, timeout=5):
+        """ Stops the thread. Writes that are still queued are journaled if we have an outbox, otherwise we try to send
+        them for up to timeout seconds """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join(timeout)
+
+    def _replay_wait(self):
+        """ Returns how long until we should replay the outbox, or None if there is nothing to replay """
+        if not self.online or self.outbox is None or not self.outbox.pending:
+            return None
+        return max(0, self._next_replay - time.monotonic())
+
+    def run(self):
+        if self.outbox is not None and self.outbox.open():
+            log('Firebase outbox has', self.outbox.pending, 'writes waiting')
+
+        while True:
+            with self._condition:
+                while not (self._ticked and self._queue) and not self._stopping and self._replay_wait() != 0:
+                    self._condition.wait(self._replay_wait())
+
+                if self._stopping and (self.outbox is not None or not self._queue):
+                    writes = list(self._queue)
+                    self._queue.clear()
+                    break
+
+                if self._ticked or self._stopping:
+                    writes = list(self._queue)
+                    self._queue.clear()
+                    self._ticked = False
+                else:
+                    writes = list()
+
+            if not writes:
+                self.replay()
+            elif self.outbox is not None and (not self.online or self.outbox.pending):
+                # Our writes have to reach Firebase in order, so while there are older ones in the outbox, new ones go
+                # in behind them
+                self.journal(writes)
+            else:
+                self.send_writes(writes)
+
+        # Keep whatever we haven't sent for next time
+        if writes:
+            self.journal(writes)
+        if self.outbox is not None:
+            self.outbox.close()
+
+    def send_writes(self, writes):
+        updates = merge_writes(writes)
+        for i, (path, data, covered) in enumerate(updates):
+            unsent = self.send_update(path, data, covered)
+            if unsent is not None:
+                self.failed += 1
+                if self.outbox is not None:
+                    self.journal(unsent + [write for _, _, covered in updates[i + 1:] for write in covered])
+                return
+        self._auth_failures = 0
+
+    def send_update(self, path, data, covered):
+        """ Sends a multi-path update from merge_writes. If Firebase rejects it, the writes that it covers are sent one
+        at a time so that only the ones that it won't take are dead lettered. Returns None once everything has been
+        dealt with, or the writes that still have to be sent if we went offline """
+        try:
+            self.send('update', path, data)
+            self.sent += len(covered)
+            return None
+        except OSError as e:
+            # requests' exceptions are all OSErrors, so this covers timeouts and HTTP errors as well
+            log('Firebase update of', path, 'failed', e)
+            if not self.is_rejection(e):
+                return list(covered)
+
+        for i, write in enumerate(covered):
+            try:
+                self.send(*write)
+                self.sent += 1
+            except OSError as e:
+                if not self.is_rejection(e):
+                    return covered[i:]
+                self.reject(write, e)
+        return None
+
+    def is_rejection(self, error):
+        """ Returns True if Firebase rejected a write with error. Otherwise we have lost our connection, so we go
+        offline """
+        status = rejected_status(error)
+        if status == 401 and self._auth_failures < self.max_auth_failures:
+            self._auth_failures += 1
+            status = None
+
+        if status is None:
+            self.went_offline()
+            return False
+        return True
+
+    def reject(self, write, error):
+        method, path, data = write
+        log('Firebase rejected', method, 'of', path, data, error)
+        self.rejected += 1
+        if self.outbox is not None:
+            self.outbox.dead_letter(write, error)
+
+    def went_offline(self):
+        with self._condition:
+            was_online = self.online
+            if self.outbox is not None:
+                self.online = False
+        if was_online and self.on_error is not None:
+            self.on_error()
+
+    def journal(self, writes):
+        if self.outbox.add(writes):
+            self.journaled += len(writes)
+        else:
+            self.dropped += len(writes)
+
+    def replay(self):
+        """ Sends the next batch of writes from our outbox """
+        self._next_replay = time.monotonic() + self.replay_interval
+
+        writes, last_id = self.outbox.batch(self.replay_writes)
+        for path, data, covered in merge_writes(writes):
+            if self.send_update(path, data, covered) is not None:
+                # The rows stay in the outbox. Anything we did send will be sent again, which does no harm
+                return
+
+        self._auth_failures = 0
+        if last_id is not None:
+            self.outbox.discard(last_id)
+            self.replayed += len(writes)
+            if not self.outbox.pending:
+                log('Firebase outbox has been replayed')
+
+    def send(self, method, path, data=None):
+        self.requests += 1
+        reference = self.database.child(path)
+        if method == 'update':
+            reference.update(data, self.get_token())
+        elif method == 'set':
+            reference.set(data, self.get_token())
+        elif method == 'remove':
+            reference.remove(self.get_token())
+        else:
+            raise ValueError('Unknown Firebase method ' + method)
@@ -0,0 +1,156 @@
+import os
+import time
+import sqlite3
+from threading import Lock
+from datetime import datetime
+
+from utils import log
+from daystore import DAY_LOG_FIELDS
+
+# The columns of a charging session row after the time, in the order that FirebaseMethods logs them
+CHARGE_SESSION_FIELDS = ('voltage', 'current_import', 'power_import', 'energy_import', 'solar_power', 'battery_power',
+                         'battery_soc', 'battery_temp', 'grid_power')
+
+# The columns of an AnalyseMethods.log_data row after the time
+ANALYTICS_FIELDS = ('dc1p', 'dc2p', 'dc1v', 'dc2v', 'dc1c', 'dc2c', 'available_current', 'pv_window_mean', 'sd',
+                    'coeff_var', 'buffer', 'charge_rate', 'floored_charge_rate')
+
+
+class HistoryStore:
+    """ An optional SQLite store for our inverter history, charging session MeterValues and analytics, kept alongside
+    the csv logs. The database is in WAL mode and each table is indexed by time, so "rows since T" is a cheap query.
+
+    Rows are buffered in memory and inserted in one transaction every commit_interval seconds, so a crash loses at
+    most that much and never leaves a half written row behind. The connection is opened on first use, so a store can
+    be created before the process that uses it is started """
+
+    def __init__(self, path='../data/history.sqlite', commit_interval=10):
+        self.path = path
+        self.commit_interval = commit_interval
+
+        self._connection = None
+        self._pending = {'inverter_history': list(), 'charge_sessions': list(), 'analytics': list()}
+        self._last_commit = time.monotonic()
+
+        # Rows may be logged from more than one thread
+        self._lock = Lock()
+
+    def connection(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+
+            connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+
+            connection.execute('CREATE TABLE IF NOT EXISTS inverter_history (time REAL NOT NULL, ' +
+                               ', '.join(name + ' REAL' for name in DAY_LOG_FIELDS) + ')')
+            connection.execute('CREATE INDEX IF NOT EXISTS inverter_history_time ON inverter_history (time)')
+
+            connection.execute('CREATE TABLE IF NOT EXISTS charge_sessions (charger_id TEXT NOT NULL, '
+                               'session TEXT NOT NULL, time REAL NOT NULL, ' +
+                               ', '.join(name + ' REAL' for name in CHARGE_SESSION_FIELDS) + ')')
+            connection.execute('CREATE INDEX IF NOT EXISTS charge_sessions_time ON charge_sessions (time)')
+            connection.execute('CREATE INDEX IF NOT EXISTS charge_sessions_session ON charge_sessions '
+                               '(charger_id, session, time)')
+
+            connection.execute('CREATE TABLE IF NOT EXISTS analytics (time REAL NOT NULL, ' +
+                               ', '.join(name + ' REAL' for name in ANALYTICS_FIELDS) + ')')
+            connection.execute('CREATE INDEX IF NOT EXISTS analytics_time ON analytics (time)')
+            connection.commit()
+
+            self._connection = connection
+
+        return self._connection
+
+    def insert_inverter_row(self, timestamp, values):
+        """ Adds a day log row. values are in the order of DAY_LOG_FIELDS """
+        self._insert('inverter_history', (timestamp,) + tuple(values))
+
+    def insert_charge_session_row(self, charger_id, session, timestamp, values):
+        """ Adds a charging session row. values are in the order of CHARGE_SESSION_FIELDS """
+        self._insert('charge_sessions', (charger_id, session, timestamp) + tuple(values[:len(CHARGE_SESSION_FIELDS)]))
+
+    def insert_analytics_row(self, timestamp, values):
+        """ Adds an analytics row. values are in the order of ANALYTICS_FIELDS """
+        self._insert('analytics', (timestamp,) + tuple(values))
+
+    def _insert(self, table, row):
+        with self._lock:
+            self._pending[table].append(row)
+        self.commit_due()
+
+    def commit_due(self):
+        """ Commits our buffered rows if commit_interval has passed since the last commit """
+        if time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            self._last_commit = time.monotonic()
+            if not any(self._pending.values()):
+                return
+
+            try:
+                connection = self.connection()
+                with connection:
+                    for table, rows in self._pending.items():
+                        if rows:
+                            placeholders = ', '.join('?' * len(rows[0]))
+                            connection.executemany('INSERT INTO ' + table + ' VALUES (' + placeholders + ')', rows)
+
+            except sqlite3.Error as e:
+                # Keep the rows and try again next time
+                log('Could not commit to history store', e)
+                return
+
+            for rows in self._pending.values():
+                del rows[:]
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _query(self, sql, parameters):
+        with self._lock:
+            return self.connection().execute(sql, parameters).fetchall()
+
+    def inverter_rows(self, start, end=None):
+        """ Returns the (time, DAY_LOG_FIELDS...) rows from start up to (but not including) end, oldest first """
+        if end is None:
+            end = float('inf')
+        return self._query('SELECT * FROM inverter_history WHERE time >= ? AND time < ? ORDER BY time', (start, end))
+
+    def charge_session_rows(self, charger_id, session, start=0):
+        """ Returns the (time, CHARGE_SESSION_FIELDS...) rows of a charging session from start onwards """
+        return self._query('SELECT time, ' + ', '.join(CHARGE_SESSION_FIELDS) + ' FROM charge_sessions WHERE '
+                           'charger_id = ? AND session = ? AND time >= ? ORDER BY time', (charger_id, session, start))
+
+    def analytics_rows(self, start, end=None):
+        if end is None:
+            end = float('inf')
+        return self._query('SELECT * FROM analytics WHERE time >= ? AND time < ? ORDER BY time', (start, end))
+
+    def inverter_days_since(self, start):
+        """ Returns the dates (YYYY-MM-DD) that have inverter rows from start onwards """
+        rows = self._query('SELECT MIN(time), MAX(time) FROM inverter_history WHERE time >= ?', (start,))
+        first, last = rows[0]
+        if first is None:
+            return set()
+
+        days = set()
+        day = datetime.fromtimestamp(first).date()
+        while day <= datetime.fromtimestamp(last).date():
+            days.add(day.strftime('%Y-%m-%d'))
+            day = day.fromordinal(day.toordinal() + 1)
+
+        return days
+
+    def charge_sessions_since(self, start):
+        """ Returns the (charger_id, session) of every charging session that has rows from start onwards """
+        return set(self._query('SELECT DISTINCT charger_id, session FROM charge_sessions WHERE time >= ?', (start,)))
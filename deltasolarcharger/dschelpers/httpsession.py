@@ -0,0 +1,143 @@
+import time
+import socket
+from collections import deque
+from threading import Lock, BoundedSemaphore
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+
+
+def header_size(headers):
+    # Each header line is "name: value\r\n"
+    return sum(len(name) + len(value) + 4 for name, value in headers.items())
+
+
+def keepalive_socket_options(idle=30, interval=10, count=3):
+    """ Returns socket options that turn on TCP keepalive. The probes keep the connection's entry in the carrier's NAT
+    table fresh over 3G, so an idle connection in our pool is still usable the next time we want it """
+    options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    # These are only available on Linux
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)]
+
+    return options
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """ An HTTPAdapter whose connections use TCP keepalive """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', keepalive_socket_options())
+        super().init_poolmanager(*args, **kwargs)
+
+
+class PooledSession(requests.Session):
+    """ A requests session for our pyrebase calls that keeps at most max_connections connections to each host open and
+    reuses them, so that most requests don't have to pay for a TCP and TLS handshake. No more than max_connections
+    requests are made at once; any more wait for a connection to be free.
+
+    Requests that are made without a timeout get a timeout of timeout seconds. The number of requests, how many new
+    connections they needed, how long they took and how many bytes of HTTP they sent and received are kept, see
+    stats """
+
+    def __init__(self, max_connections=4, timeout=10, retries=3):
+        super().__init__()
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+
+        self._in_flight = BoundedSemaphore(max_connections)
+        self._lock = Lock()
+
+        self.num_requests = 0
+        self.num_errors = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self._latencies = deque(maxlen=100)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        # The connections made by adapters that have since been replaced
+        self._old_connections = 0
+
+        self.mount_adapters()
+
+    def mount_adapters(self):
+        for scheme in ('http://', 'https://'):
+            self.mount(scheme, KeepAliveAdapter(pool_connections=4, pool_maxsize=self.max_connections,
+                                                pool_block=True, max_retries=self.retries))
+
+    def after_fork(self):
+        """ Leaves the connections that we inherited to our parent process and starts a new pool. Two processes using
+        the same connection would mix up their requests """
+        with self._lock:
+            self._old_connections += self.new_connections()
+        self.mount_adapters()
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        with self._in_flight:
+            start = time.monotonic()
+            try:
+                response = super().request(method, url, **kwargs)
+                self.count_bytes(response, kwargs.get('stream', False))
+                return response
+
+            except requests.RequestException:
+                with self._lock:
+                    self.num_errors += 1
+                raise
+
+            finally:
+                latency = time.monotonic() - start
+                with self._lock:
+                    self.num_requests += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                    self._latencies.append(latency)
+
+    def count_bytes(self, response, stream=False):
+        request = response.request
+        sent = len(request.method) + len(request.url) + 12 + header_size(request.headers)
+        if request.body is not None:
+            sent += len(request.body)
+
+        received = 16 + len(response.reason or '') + header_size(response.headers)
+        if not stream:
+            received += len(response.content)
+
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def new_connections(self):
+        """ Returns how many connections our current adapters have had to make """
+        connections = 0
+        for adapter in set(self.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+        return connections
+
+    def stats(self):
+        """ Returns our request count, how many of our requests reused a connection and their latency in seconds """
+        with self._lock:
+            new_connections = self._old_connections + self.new_connections()
+            latencies = sorted(self._latencies)
+
+            return {'requests': self.num_requests,
+                    'errors': self.num_errors,
+                    'new_connections': new_connections,
+                    'reused': round(max(0, self.num_requests - new_connections) / self.num_requests, 3)
+                    if self.num_requests else None,
+                    'mean_latency': round(self.total_latency / self.num_requests, 3) if self.num_requests else None,
+                    'median_latency': round(latencies[len(latencies) // 2], 3) if latencies else None,
+                    'max_latency': round(self.max_latency, 3),
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_received': self.bytes_received}
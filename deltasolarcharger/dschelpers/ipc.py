@@ -0,0 +1,302 @@
+import os
+import ctypes
+import pickle
+import multiprocessing
+from multiprocessing import Lock
+from multiprocessing.connection import wait as connection_wait
+from multiprocessing.sharedctypes import RawArray, RawValue
+from queue import Empty
+
+from modbussample import ModbusSample
+
+# Flags that can be attached to a sample in a SampleRing
+PUBLISH = 1
+
+# The policies that a Channel can have (see Channel)
+LOSSLESS = 'lossless'
+LATEST = 'latest'
+FIFO = 'fifo'
+
+
+def wait(channels, timeout=None):
+    """ Sleeps until at least one of the channels (or ring readers) has something for us, or until the timeout runs
+    out. Returns the channels that are ready """
+    return connection_wait(channels, timeout)
+
+
+class Doorbell:
+    """ A non-blocking pipe that a producer rings to wake a consumer up. The consumer waits on the read end, so it uses
+    no CPU while it is asleep. Doorbells must be created before the processes that use them are started """
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        return self._read_fd
+
+    def ring(self):
+        try:
+            os.write(self._write_fd, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the doorbell has already been rung
+            pass
+
+    def clear(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+class Channel:
+    """ A channel between two processes that the consumer can wait on. It has the same put/get/empty interface as the
+    queues it replaces, but does not go through a manager process. Each channel has one of these policies:
+
+    LOSSLESS - every item is delivered, in order. For control messages
+    LATEST - only the newest item is kept, so a slow consumer only ever sees current data. For live data and control
+             inputs where a newer value replaces an older one
+    FIFO - every item is delivered in order, but only the newest capacity items are kept. For history
+
+    LATEST and FIFO channels live in a fixed amount of shared memory, so their memory stays flat however far behind the
+    consumer falls. Items are pickled into slots of max_item_size bytes.
+
+    A LOSSLESS channel is a multiprocessing.Queue, and we wait on the pipe that the queue reads from (Queue._reader).
+    That pipe is a CPython internal rather than part of Queue's interface, though every Queue from Python 3.4 (we run
+    3.5) up to at least 3.12 has one. We don't use a Pipe of our own instead, as a put would then block whenever the
+    consumer fell a pipe's worth behind, where the queue's feeder thread buffers the items for us """
+
+    def __init__(self, policy=LOSSLESS, capacity=1, max_item_size=4096):
+        self.policy = policy
+        self.capacity = 1 if policy == LATEST else capacity
+        self.max_item_size = max_item_size
+
+        # How many items have been put into the channel
+        self._puts = RawValue(ctypes.c_uint64, 0)
+
+        # Held while the channel's shared state is changed
+        self._lock = Lock()
+
+        if policy == LOSSLESS:
+            self._queue = multiprocessing.Queue()
+
+            # Find out now, rather than in the middle of a wait, if this Python's Queue doesn't have the pipe we need
+            if not callable(getattr(getattr(self._queue, '_reader', None), 'fileno', None)):
+                raise RuntimeError('multiprocessing.Queue has no _reader pipe for a LOSSLESS channel to wait on')
+            return
+
+        self._slots = RawArray(ctypes.c_char, self.capacity * max_item_size)
+        self._lengths = RawArray(ctypes.c_uint32, self.capacity)
+
+        # The sequence number of the next item to be put, and of the next item to be read. These are shared, so that
+        # the producer can drop the oldest item and both sides can see how deep the channel is
+        self._head = RawValue(ctypes.c_uint64, 0)
+        self._cursor = RawValue(ctypes.c_uint64, 0)
+        self._dropped = RawValue(ctypes.c_uint64, 0)
+
+        self._doorbell = Doorbell()
+
+    def fileno(self):
+        if self.policy == LOSSLESS:
+            # The queue's pipe becomes readable once the feeder thread has written an item to it, so it is our doorbell
+            return self._queue._reader.fileno()
+
+        return self._doorbell.fileno()
+
+    def put(self, item):
+        if self.policy == LOSSLESS:
+            with self._lock:
+                self._puts.value += 1
+            self._queue.put(item)
+            return
+
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_item_size:
+            raise ValueError('Item of ' + str(len(data)) + ' bytes is too big for this channel')
+
+        with self._lock:
+            sequence = self._head.value
+            slot = sequence % self.capacity
+            self._slots[slot * self.max_item_size:slot * self.max_item_size + len(data)] = data
+            self._lengths[slot] = len(data)
+            self._head.value = sequence + 1
+            self._puts.value += 1
+
+            # If the channel was full then we just overwrote the oldest item
+            if self._head.value - self._cursor.value > self.capacity:
+                self._dropped.value += self._head.value - self._cursor.value - self.capacity
+                self._cursor.value = self._head.value - self.capacity
+
+        self._doorbell.ring()
+
+    def get_nowait(self):
+        if self.policy == LOSSLESS:
+            return self._queue.get_nowait()
+
+        # Clear our doorbell before we look, so an item that is put after we look rings it again
+        self._doorbell.clear()
+        with self._lock:
+            sequence = self._cursor.value
+            if sequence >= self._head.value:
+                raise Empty
+
+            slot = sequence % self.capacity
+            data = self._slots[slot * self.max_item_size:slot * self.max_item_size + self._lengths[slot]]
+            self._cursor.value = sequence + 1
+
+        return pickle.loads(data)
+
+    def get(self, block=True, timeout=None):
+        if self.policy == LOSSLESS:
+            return self._queue.get(block, timeout)
+
+        if block and self.empty():
+            wait([self], timeout)
+
+        return self.get_nowait()
+
+    def empty(self):
+        if self.policy == LOSSLESS:
+            return self._queue.empty()
+
+        return self._cursor.value >= self._head.value
+
+    def get_all(self):
+        """ Returns every item that is waiting in the channel """
+        items = list()
+        while True:
+            try:
+                items.append(self.get_nowait())
+            except Empty:
+                return items
+
+    def stats(self):
+        """ Returns how many items are waiting in the channel, and how many have been put and dropped """
+        if self.policy == LOSSLESS:
+            return {'policy': self.policy, 'depth': self._queue.qsize(), 'puts': self._puts.value, 'dropped': 0}
+
+        return {'policy': self.policy, 'depth': self._head.value - self._cursor.value, 'puts': self._puts.value,
+                'dropped': self._dropped.value}
+
+
+class SampleRing:
+    """ A single producer, multiple consumer ring buffer of packed ModbusSamples in shared memory. The producer writes
+    each sample once and every consumer reads it through its own RingReader, so there is no manager process in the way
+    and no copy per consumer.
+
+    Every slot holds the sequence number of the sample in it, so a reader that falls more than a whole ring behind can
+    tell which samples it missed """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.record_size = ModbusSample._STRUCT.size
+
+        self._buffer = RawArray(ctypes.c_char, capacity * self.record_size)
+        self._sequences = RawArray(ctypes.c_uint64, capacity)
+        self._flags = RawArray(ctypes.c_uint8, capacity)
+
+        # The sequence number of the next sample that will be written
+        self._head = RawValue(ctypes.c_uint64, 0)
+
+        # Held while a slot is written or read, so readers never see half of a sample
+        self._lock = Lock()
+
+        # The (flags, doorbell) of every reader, so we can wake the readers that want a sample when we write it
+        self._doorbells = list()
+
+    def put(self, sample, flags=0):
+        data = sample.pack()
+        with self._lock:
+            sequence = self._head.value
+            slot = sequence % self.capacity
+            self._buffer[slot * self.record_size:(slot + 1) * self.record_size] = data
+            self._sequences[slot] = sequence
+            self._flags[slot] = flags
+            self._head.value = sequence + 1
+
+        for reader_flags, doorbell in self._doorbells:
+            if flags & reader_flags == reader_flags:
+                doorbell.ring()
+
+    def head(self):
+        return self._head.value
+
+    def read_slot(self, sequence):
+        """ Returns the (sample, flags) with the given sequence number, or None if it has been overwritten """
+        slot = sequence % self.capacity
+        with self._lock:
+            if self._sequences[slot] != sequence or sequence >= self._head.value:
+                return None
+            data = self._buffer[slot * self.record_size:(slot + 1) * self.record_size]
+            flags = self._flags[slot]
+
+        return ModbusSample.unpack(data), flags
+
+    def reader(self, flags=0):
+        """ Creates a reader that starts at the next sample to be written. If flags is given, the reader only returns
+        samples that were put with all of those flags. Readers must be created before the producer starts writing """
+        doorbell = Doorbell()
+        self._doorbells.append((flags, doorbell))
+        return RingReader(self, flags, doorbell)
+
+
+class RingReader:
+    """ One consumer's cursor into a SampleRing """
+
+    def __init__(self, ring, flags=0, doorbell=None):
+        self.ring = ring
+        self.flags = flags
+        self.doorbell = doorbell
+        self.cursor = ring.head()
+
+        # How many samples were overwritten before we got to them
+        self.dropped = 0
+
+    def fileno(self):
+        return self.doorbell.fileno()
+
+    def stats(self):
+        return {'depth': self.available(), 'dropped': self.dropped}
+
+    def available(self):
+        """ Returns how many samples have been written that we haven't looked at yet """
+        return self.ring.head() - self.cursor
+
+    def get(self):
+        """ Returns the next sample that we haven't read, or None if we have caught up """
+        # Clear our doorbell before we look for samples, so a sample written after we look rings it again
+        if self.doorbell is not None and self.cursor >= self.ring.head():
+            self.doorbell.clear()
+
+        while self.cursor < self.ring.head():
+            # If we have fallen more than a whole ring behind, skip to the oldest sample that is still there
+            oldest = self.ring.head() - self.ring.capacity
+            if self.cursor < oldest:
+                self.dropped += oldest - self.cursor
+                self.cursor = oldest
+
+            entry = self.ring.read_slot(self.cursor)
+            if entry is None:
+                # The producer overwrote this slot while we were looking at it
+                self.dropped += 1
+                self.cursor += 1
+                continue
+
+            self.cursor += 1
+            sample, flags = entry
+            if flags & self.flags == self.flags:
+                return sample
+
+        return None
+
+    def get_all(self):
+        """ Returns every sample that we haven't read yet """
+        samples = list()
+        sample = self.get()
+        while sample is not None:
+            samples.append(sample)
+            sample = self.get()
+
+        return samples
@@ -0,0 +1,113 @@
+import os
+import csv
+import time
+from threading import Lock
+from collections import OrderedDict
+
+from utils import log
+
+
+class LogWriter:
+    """ An open csv file that we append rows to. Rows are buffered in memory and written out when flush is called """
+
+    def __init__(self, path, header=None, buffer_size=65536):
+        self.path = path
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self._file = open(path, 'a', newline='', buffering=buffer_size)
+        self._writer = csv.writer(self._file)
+
+        # A new file gets the header first
+        if header is not None and self._file.tell() == 0:
+            self._writer.writerow(header)
+
+        self.pending_rows = 0
+        self.last_flush = time.monotonic()
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+        self.pending_rows += 1
+
+    def flush(self, fsync=False):
+        if self.pending_rows:
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+        self.pending_rows = 0
+        self.last_flush = time.monotonic()
+
+    def close(self, fsync=False):
+        self.flush(fsync)
+        self._file.close()
+
+
+class LogWriters:
+    """ Keeps one LogWriter open for each stream of rows that we log (e.g. the inverter day log, or one charger's
+    charging session), instead of opening and closing the file for every row.
+
+    Each row is written to a stream along with the path of the file it belongs in. When a stream's path changes (a new
+    day, or a new charging session) the old file is flushed and closed, so midnight rollover happens by itself. A
+    stream's rows are flushed once flush_rows of them are waiting or flush_interval seconds have passed, and fsynced
+    as well if fsync is set. At most max_open files are kept open """
+
+    def __init__(self, flush_rows=15, flush_interval=30, fsync=True, max_open=8):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_open = max_open
+
+        # Our writers keyed by stream, least recently used first
+        self._writers = OrderedDict()
+
+        # Rows may be logged from more than one thread
+        self._lock = Lock()
+
+    def writerow(self, stream, path, row, header=None):
+        """ Appends a row to the file at path. header is written first if the file is new """
+        with self._lock:
+            writer = self._writers.get(stream)
+            if writer is not None and writer.path != path:
+                self._close_writer(stream)
+                writer = None
+
+            if writer is None:
+                while len(self._writers) >= self.max_open:
+                    self._close_writer(next(iter(self._writers)))
+                writer = self._writers[stream] = LogWriter(path, header)
+            else:
+                self._writers.move_to_end(stream)
+
+            writer.writerow(row)
+            if writer.pending_rows >= self.flush_rows or \
+                    time.monotonic() - writer.last_flush >= self.flush_interval:
+                writer.flush(self.fsync)
+
+    def flush_due(self):
+        """ Flushes any stream whose rows have been waiting for longer than flush_interval. Call this regularly so
+        that rows don't sit in memory when a stream goes quiet """
+        now = time.monotonic()
+        with self._lock:
+            for writer in self._writers.values():
+                if writer.pending_rows and now - writer.last_flush >= self.flush_interval:
+                    writer.flush(self.fsync)
+
+    def flush(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer.flush(self.fsync)
+
+    def close(self):
+        """ Flushes and closes every file """
+        with self._lock:
+            for stream in list(self._writers):
+                self._close_writer(stream)
+
+    def _close_writer(self, stream):
+        writer = self._writers.pop(stream)
+        try:
+            writer.close(self.fsync)
+        except OSError as e:
+            log('Could not close log', writer.path, e)
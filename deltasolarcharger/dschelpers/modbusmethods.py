@@ -1,26 +1,244 @@
 import minimalmodbus
 import serial
-import numpy as np
 
 import time
-from datetime import datetime
+from collections import namedtuple
 
 from queue import Queue
 
-from utils import log
+from utils import log, Histogram
+
+from modbussample import ModbusSample
+
+# The serial port that the E5 is connected to
+_E5_PORT = '/dev/serial0'
+
+# Writing a page number to this holding register selects which page of data is mapped onto the 1056 register block
+_PAGE_SELECT_REGISTER = 799
+
+# A single input register on the E5. Registers with a page can only be read after the page has been selected.
+# group decides how often the register is polled (see ModbusMethods._POLL_PERIODS)
+Register = namedtuple('Register', ['name', 'group', 'page', 'address'])
+
+# A contiguous block read from the E5. page is the page to select before the read (None if no page is needed)
+RegisterBlock = namedtuple('RegisterBlock', ['page', 'start', 'count', 'registers'])
+
+# This is the register map of every field that we read from the E5
+E5_REGISTER_MAP = [
+    # AC1 (page 0)
+    Register('ac1_voltage', 'ac', 0, 1056),
+    Register('ac1_current', 'ac', 0, 1057),
+    Register('ac1_power', 'ac', 0, 1058),
+    Register('ac1_freq', 'ac', 0, 1059),
+
+    # AC2 (page 32)
+    Register('ac2_voltage', 'ac', 32, 1056),
+    Register('ac2_current', 'ac', 32, 1057),
+    Register('ac2_power', 'ac', 32, 1058),
+    Register('ac2_freq', 'ac', 32, 1059),
+
+    # DC1 (page 48)
+    Register('dc1_voltage', 'dc', 48, 1056),
+    Register('dc1_current', 'dc', 48, 1057),
+    Register('dc1_power', 'dc', 48, 1058),
+
+    # DC2 (page 49)
+    Register('dc2_voltage', 'dc', 49, 1056),
+    Register('dc2_current', 'dc', 49, 1057),
+    Register('dc2_power', 'dc', 49, 1058),
+
+    # Firmware versions and inverter status
+    Register('fw_dsp', 'firmware', None, 1039),
+    Register('fw_red', 'firmware', None, 1041),
+    Register('fw_disp', 'firmware', None, 1043),
+    Register('inverter_status', 'status', None, 1047),
+
+    # Inverter temperatures
+    Register('ambient_temp', 'temperature', None, 1079),
+    Register('boost_1_temp', 'temperature', None, 1080),
+    Register('boost_2_temp', 'temperature', None, 1081),
+    Register('inverter_temp', 'temperature', None, 1082),
+
+    # Battery block
+    Register('bt_soc', 'battery', None, 1537),
+    Register('utility_current', 'battery', None, 1546),
+    Register('utility_power', 'battery', None, 1547),
+    Register('bt_capacity', 'battery', None, 1548),
+    Register('inverter_op_mode', 'battery', None, 1551),
+    Register('bt_voltage', 'battery', None, 1564),
+    Register('bt_current', 'battery', None, 1565),
+    Register('bt_wattage', 'battery', None, 1566),
+
+    # Battery module temperatures
+    Register('bt_module1_temp_max', 'temperature', None, 1607),
+    Register('bt_module1_temp_min', 'temperature', None, 1608),
+]
+
+
+def plan_block_reads(registers, max_gap, max_block_size):
+    """ Merges a list of registers into the fewest contiguous block reads. Registers that are not paged are read along
+    with the first page that we select, since the page select only changes what is in the 1056 register block """
+
+    # Work out the order we are going to select our pages in
+    pages = list()
+    for register in registers:
+        if register.page is not None and register.page not in pages:
+            pages.append(register.page)
+
+    # Registers without a page get read along with our first page
+    host_page = pages[0] if pages else None
+    buckets = dict((page, list()) for page in pages)
+    buckets.setdefault(host_page, list())
+    for register in registers:
+        buckets[host_page if register.page is None else register.page].append(register)
+
+    plan = list()
+    for page in (pages if pages else [None]):
+        current = list()
+        for register in sorted(buckets[page], key=lambda r: r.address):
+            # Start a new block if this register is too far away from the block or would make the block too big
+            if current and (register.address - current[-1].address - 1 > max_gap or
+                            register.address - current[0].address + 1 > max_block_size):
+                plan.append(make_register_block(page, current))
+                current = list()
+
+            current.append(register)
+
+        if current:
+            plan.append(make_register_block(page, current))
+
+    return plan
+
+
+def make_register_block(page, registers):
+    """ Creates a RegisterBlock that covers all of the given registers (sorted by address) """
+
+    start = registers[0].address
+    count = registers[-1].address - start + 1
+
+    # We only need to select a page if there is actually a paged register in this block
+    if all(register.page is None for register in registers):
+        page = None
+
+    return RegisterBlock(page, start, count, tuple(registers))
+
+
+class PollingScheduler:
+    """ Keeps track of when each register group is next due to be polled. Groups with a period of None are only
+    polled after a reset (ie. when we connect to the E5) """
+
+    def __init__(self, periods):
+        self.periods = periods
+
+        # The fastest group decides how often we need to check for due groups
+        self.base_period = min(period for period in periods.values() if period is not None)
+
+        self.next_poll = dict()
+        self.reset()
+
+    def reset(self):
+        """ Makes every group (including the ones that we only read once) due straight away """
+        self.next_poll = dict((group, 0) for group in self.periods)
+
+    def due_groups(self, now):
+        """ Returns the set of groups that need to be polled at time now """
+        return frozenset(group for group, next_poll in self.next_poll.items() if
+                         next_poll is not None and next_poll <= now)
+
+    def mark_polled(self, groups, now):
+        """ Schedules the next poll for each of the groups that we just read """
+        for group in groups:
+            period = self.periods[group]
+            if period is None:
+                self.next_poll[group] = None
+
+            # Stay on our original schedule unless we have fallen more than a whole period behind
+            elif now - self.next_poll[group] < period:
+                self.next_poll[group] += period
+            else:
+                self.next_poll[group] = now + period
+
+
+class TransactionStats:
+    """ Latency and failure statistics of the Modbus transactions that we make, kept per transaction label """
+
+    # Upper bounds (in seconds) of the buckets in our latency histograms
+    _LATENCY_EDGES = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+
+    def __init__(self):
+        self.labels = dict()
+
+    def get(self, label):
+        if label not in self.labels:
+            self.labels[label] = {'latency': Histogram(self._LATENCY_EDGES),
+                                  'ok': 0,
+                                  'timeouts': 0,
+                                  'crc_errors': 0,
+                                  'slave_errors': 0,
+                                  'retries': 0}
+        return self.labels[label]
+
+    def record(self, label, latency, failure=None):
+        """ Records a single transaction. failure is the name of the counter to increment if it failed """
+        stats = self.get(label)
+        stats['latency'].add(latency)
+        stats[failure if failure is not None else 'ok'] += 1
+
+    def snapshot(self):
+        """ Returns a copy of our statistics that can be logged or sent to another process """
+        snapshot = dict()
+        for label, stats in self.labels.items():
+            snapshot[label] = dict(stats)
+            snapshot[label]['latency'] = stats['latency'].summary()
+        return snapshot
 
 
 class ModbusMethods:
-    def __init__(self, analyse_to_modbus_queue):
+    # The largest gap of unused registers we are happy to read through to save a transaction
+    _MAX_REGISTER_GAP = 24
+    # The maximum number of registers allowed in a single Modbus read
+    _MAX_BLOCK_SIZE = 125
+
+    # How many times we retry a transaction that timed out or came back corrupted before giving up
+    _TRANSACTION_RETRIES = 1
+
+    # How often (in seconds) we poll each register group. Firmware versions never change while we are running, so we
+    # only read them when we connect to the E5
+    _POLL_PERIODS = {'ac': 0.5,
+                     'dc': 0.5,
+                     'status': 0.5,
+                     'battery': 0.5,
+                     'temperature': 10,
+                     'firmware': None}
+
+    def __init__(self, analyse_to_modbus_queue, e5_port=_E5_PORT):
         self.E5 = None
         self.DPM = None
 
+        # The serial port we open the E5 on. This can be pointed at an E5Emulator instead of the real inverter
+        self.e5_port = e5_port
+
+        # The page that is currently selected on the E5 (None if we don't know)
+        self._current_page = None
+
+        # Block read plans for each combination of register groups that we have needed so far
+        self._plan_cache = dict()
+
+        # The scheduler decides which register groups need to be read in each cycle
+        self.poll_scheduler = PollingScheduler(self._POLL_PERIODS)
+
+        # The latest raw value of every register, so that groups we skip still have a value
+        self.latest_raw_data = dict()
+
+        # Timing and failure counts of every Modbus transaction
+        self.transaction_stats = TransactionStats()
+
         self.analyse_to_modbus_queue = analyse_to_modbus_queue
 
         self.initiate_parameters(1, 5)
 
     def initiate_parameters(self, e5_id, dpm_id):
-        self.E5 = minimalmodbus.Instrument('/dev/serial0', e5_id)  # port name, slave address (in decimal)
+        self.E5 = minimalmodbus.Instrument(self.e5_port, e5_id)  # port name, slave address (in decimal)
         self.E5.debug = False
         self.E5.baudrate = 19200
         self.E5.serial.bytesize = 8
@@ -42,82 +260,86 @@ class ModbusMethods:
         # self.DPM.mode = minimalmodbus.MODE_RTU
         # self.DPM.handle_local_echo = False
 
-        log('Modbus initialized!')
-
-    @staticmethod
-    def twos_comp(vals, bits):
-        """compute the 2's compliment of array of int values vals"""
-        vals[vals & (1 << (bits - 1)) != 0] -= (1 << bits)
-        return vals
+        # We have a new connection so we no longer know what page is selected, and we need to read every group again
+        self._current_page = None
+        self.poll_scheduler.reset()
 
-    @staticmethod
-    def bt_mode_database(modbus_input):
-        # Check the status
-        if modbus_input == 0:
-            status_output = "STAND_BY_MODE"
-        elif modbus_input == 1:
-            status_output = "SELF_CONSUMPTION_MODE_INTERNAL"
-        elif modbus_input == 2:
-            status_output = "PEAK_CUT_MODE"
-        elif modbus_input == 3:
-            status_output = "CHARGE_FIRST_MODE"
-        elif modbus_input == 4:
-            status_output = "DISCHARGE_FIRST_MODE"
-        elif modbus_input == 5:
-            status_output = "WITHOUT_BT_MODE"
-        elif modbus_input == 6:
-            status_output = "PV_CHARGE_BT_FIRST_MODE"
-        elif modbus_input == 11:
-            status_output = "STAND_BY_PAUSE_MODE"
-        elif modbus_input == 12:
-            status_output = "MAINTENANCE_MODE"
-        else:
-            status_output = "STAND_ALONE_MODE"
-
-        return status_output
+        log('Modbus initialized!')
 
-    @staticmethod
-    def lookup_inverter_status(status_int):
-        if status_int == 0:
-            return "Standby"
-        elif status_int == 1:
-            return "Countdown"
-        elif status_int == 2:
-            return "On Grid"
-        elif status_int == 3:
-            return "No DC"
-        elif status_int == 4:
-            return "Alarm"
-        elif status_int == 5:
-            return "Reserved"
-        elif status_int == 6:
-            return "Stand Alone"
-        else:
-            return "On"
+    def _transaction(self, label, method, *args):
+        """ Performs a single Modbus transaction on the E5, recording how long it took and how it failed. Timeouts and
+        corrupted responses are retried, but errors reported by the E5 itself are not """
+
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = method(*args)
+
+            except IOError:
+                self.transaction_stats.record(label, time.monotonic() - start, 'timeouts')
+                if attempt >= self._TRANSACTION_RETRIES:
+                    raise
+
+            except ValueError as error:
+                slave_error = 'slave is indicating an error' in str(error)
+                self.transaction_stats.record(label, time.monotonic() - start,
+                                              'slave_errors' if slave_error else 'crc_errors')
+                if slave_error or attempt >= self._TRANSACTION_RETRIES:
+                    raise
+
+            else:
+                self.transaction_stats.record(label, time.monotonic() - start)
+                return result
+
+            attempt += 1
+            self.transaction_stats.get(label)['retries'] += 1
+
+    def get_register_plan(self, groups):
+        """ Returns the block read plan for a set of register groups """
+
+        if groups not in self._plan_cache:
+            registers = [register for register in E5_REGISTER_MAP if register.group in groups]
+            self._plan_cache[groups] = plan_block_reads(registers, self._MAX_REGISTER_GAP, self._MAX_BLOCK_SIZE)
+
+        return self._plan_cache[groups]
+
+    def read_register_plan(self, plan, _debug=False):
+        """ Performs every block read in the plan and returns a dictionary of raw register values keyed by field name """
+
+        raw_data = dict()
+        for block in plan:
+            try:
+                # Only select the page if it isn't selected already
+                if block.page is not None and block.page != self._current_page:
+                    self._current_page = None
+                    self._transaction('page_select', self.E5.write_register, _PAGE_SELECT_REGISTER, block.page, 0, 6,
+                                      False)
+                    self._current_page = block.page
+
+                temp = self._transaction(self.block_label(block), self.E5.read_registers, block.start, block.count, 4)
+                _debug and log(block.page, block.start, temp)
+
+            except ValueError as error:
+                # The E5 may refuse to read through registers it doesn't know about. If it reports an error for a block
+                # with gaps in it, we halve the gap we are allowed to read through and let the caller retry
+                if 'slave is indicating an error' in str(error) and block.count > len(block.registers) and \
+                        self._MAX_REGISTER_GAP > 0:
+                    self._MAX_REGISTER_GAP //= 2
+                    log('Block read of', block.count, 'registers from', block.start, 'failed, reducing our register gap',
+                        'to', self._MAX_REGISTER_GAP)
+                    self._plan_cache = dict()
+                raise
+
+            for register in block.registers:
+                raw_data[register.name] = temp[register.address - block.start]
+
+        return raw_data
 
     @staticmethod
-    def lookup_operation_mode(opmode_int):
-        # Check the status
-        if opmode_int[0] == 0:
-            return "STAND_BY_MODE"
-        elif opmode_int[0] == 1:
-            return "SELF_CONSUMPTION_MODE_INTERNAL"
-        elif opmode_int[0] == 2:
-            return "PEAK_CUT_MODE"
-        elif opmode_int[0] == 3:
-            return "CHARGE_FIRST_MODE"
-        elif opmode_int[0] == 4:
-            return "DISCHARGE_FIRST_MODE"
-        elif opmode_int[0] == 5:
-            return "WITHOUT_BT_MODE"
-        elif opmode_int[0] == 6:
-            return "PV_CHARGE_BT_FIRST_MODE"
-        elif opmode_int[0] == 11:
-            return "STAND_BY_PAUSE_MODE"
-        elif opmode_int[0] == 12:
-            return "MAINTENANCE_MODE"
-        else:
-            return "STAND_ALONE_MODE"
+    def block_label(block):
+        """ Labels a block read by the register groups that it covers, eg. 'battery+temperature' """
+        return '+'.join(sorted(set(register.group for register in block.registers)))
 
     def get_modbus_data(self, _debug=False):
         # Check for any inputs from analyse methods
@@ -127,131 +349,24 @@ class ModbusMethods:
 
             if purpose == "inverter_op_mode":
                 if new_payload['inverter_op_mode'] == "CHARGE_FIRST_MODE":
-                    self.E5.write_register(25626, 4, 0, 6, False)
+                    self._transaction('op_mode', self.E5.write_register, 25626, 4, 0, 6, False)
                     log('Changed mode to Charge First Mode!')
                 elif new_payload['inverter_op_mode'] == "SELF_CONSUMPTION_MODE_INTERNAL":
-                    self.E5.write_register(25626, 1, 0, 6, False)
+                    self._transaction('op_mode', self.E5.write_register, 25626, 1, 0, 6, False)
                     log('Changed mode to Self Consumption Mode!')
                 elif new_payload['inverter_op_mode'] == "WITHOUTBTMODE":
-                    self.E5.write_register(25626, 6, 0, 6, False)
+                    self._transaction('op_mode', self.E5.write_register, 25626, 6, 0, 6, False)
                     log('Changed mode to Without BT Mode!')
 
-        # Grab all inverter_cont_data
-        inverter_data = dict()
-        # Write 0 to holding register 800 to read AC1 info
-        self.E5.write_register(799, 0, 0, 6, False)
-
-        inverter_data['time'] = str(datetime.now())
-
-        # Todo: AC1 Power needs to be twos compliment - CHECK THIS
-        # Read the relevant registers, store in "temp"
-        temp = self.E5.read_registers(1056, 4, 4)
-        _debug and log(temp)
-        inverter_data["ac1_voltage"] = float(temp[0])
-        inverter_data['ac1_current'] = float(temp[1])
-        inverter_data['ac1_power'] = float(temp[2])
-        inverter_data['ac1_freq'] = float(temp[3])
-
-        # Same as above
-        self.E5.write_register(799, 32, 0, 6, False)
-        temp = self.E5.read_registers(1056, 4, 4)
-        _debug and log(temp)
-        inverter_data["ac2_voltage"] = float(temp[0])
-        inverter_data['ac2_current'] = float(temp[1])
-        inverter_data['ac2_power'] = float(temp[2])
-        inverter_data['ac2_freq'] = float(temp[3])
-
-        self.E5.write_register(799, 48, 0, 6, False)
-        temp = self.E5.read_registers(1056, 4, 4)
-        _debug and log(temp)
-        inverter_data['dc1_voltage'] = float(temp[0])
-        inverter_data['dc1_current'] = float(temp[1])
-        inverter_data['dc1_power'] = float(temp[2])
-
-        self.E5.write_register(799, 49, 0, 6, False)
-        temp = self.E5.read_registers(1056, 4, 4)
-        _debug and log(temp)
-        inverter_data['dc2_voltage'] = float(temp[0])
-        inverter_data['dc2_current'] = float(temp[1])
-        inverter_data['dc2_power'] = float(temp[2])
-
-        temp = self.E5.read_registers(1079, 4, 4)
-        _debug and log(temp)
-        inverter_data['ambient_temp'] = str(temp[0])
-        inverter_data['boost_1_temp'] = str(temp[1])
-        inverter_data['boost_2_temp'] = str(temp[2])
-        inverter_data['inverter_temp'] = str(temp[3])
-
-        temp = self.E5.read_registers(1551, 1, 4)
-        _debug and log(temp)
-        operation_mode = self.lookup_operation_mode(temp)
-
-        inverter_data['inverter_op_mode'] = operation_mode
-
-        temp = self.E5.read_registers(1047, 1, 4)
-        _debug and log(temp)
-        inverter_data['inverter_status'] = self.lookup_inverter_status(temp[0])
-
-        # temp = self.E5.read_registers(1047, 1, 4)
-        # inverter_data['inverter_status'] = temp
-        #
-        temp = self.E5.read_registers(1039, 1, 4)
-        _debug and log(temp)
-        dsp = hex(int(temp[0]))
-        inverter_data['fw_dsp'] = 'v0' + str(int(dsp[2], 16)) + '.' + str(int(dsp[3:5], 16))
-
-        temp = self.E5.read_registers(1041, 1, 4)
-        _debug and log(temp)
-        red = hex(int(temp[0]))
-        inverter_data['fw_red'] = 'v0' + str(int(red[2], 16)) + '.' + str(int(red[3:5], 16))
-
-        temp = self.E5.read_registers(1043, 1, 4)
-        _debug and log(temp)
-        comm = hex(int(temp[0]))
-        inverter_data['fw_disp'] = 'v0' + str(int(comm[2], 16)) + '.' + str(int(comm[3:5], 16))
-
-        # Grab all bt_cont_data
-        bt_data = dict()
-
-        # This block grabs all of the registers to do with battery
-        bt_data_temp = dict()
-        start = 1536
-        num = 32
-        modbus_int_out = self.E5.read_registers(start - 1, num, 4)
-        _debug and log(modbus_int_out)
-
-        for x in range(0, num):
-            bt_data_temp[start + x] = (modbus_int_out[x])
-        ##
-
-        array = np.array([bt_data_temp[1566], bt_data_temp[1567]])
-        a = self.twos_comp(array, 16)
-
-        array = np.array([bt_data_temp[1547], bt_data_temp[1548]])
-        b = self.twos_comp(array, 16)
-
-        bt_data['bt_soc'] = float(bt_data_temp[1538])
-        bt_data['bt_voltage'] = float(bt_data_temp[1565])
-        bt_data['bt_current'] = float(a[0])  # == 1566 twos comp
-        bt_data['bt_wattage'] = a[1]  # == 1567 twos comp
-        bt_data['utility_current'] = float(b[0])  # float(bt_data_temp[1547])
-        bt_data['utility_power'] = float(b[1])  # bt_data_temp[1548]
-        bt_data['bt_capacity'] = float(bt_data_temp[1549])
-        bt_data['bt_op_mode'] = self.bt_mode_database(bt_data_temp[1552])
-
-        temp = self.E5.read_registers(1607, 2, 4)
-        _debug and log(temp)
-        bt_data['bt_module1_temp_min'] = float(temp[1])
-        bt_data['bt_module1_temp_max'] = float(temp[0])
-        # Grab all dpm_cont_data
-        dpm_data = dict()
-
-        dpm_data['test'] = 'This is a test'
-
-        # The structure of modbus_data is:
-        # {modbus_data: (inverter_data, bt_data, dpm_data)}
-
-        modbus_data = (inverter_data, bt_data, dpm_data)
+        # Read the register groups that are due in as few transactions as possible
+        now = time.monotonic()
+        due_groups = self.poll_scheduler.due_groups(now)
+        if due_groups:
+            self.latest_raw_data.update(self.read_register_plan(self.get_register_plan(due_groups), _debug))
+            self.poll_scheduler.mark_polled(due_groups, now)
+
+        # The structure of modbus_data is a ModbusSample holding every register
+        modbus_data = ModbusSample.from_registers(time.time(), self.latest_raw_data)
 
         return modbus_data
 
@@ -261,8 +376,8 @@ if __name__ == '__main__':
     while True:
         try:
             payload = modbus_methods.get_modbus_data(_debug=True)
-            log('BT SOC is: ', payload[1]['bt_soc'])
-            log(payload[0]['dc1_power'])
+            log('BT SOC is: ', payload.bt_soc)
+            log(payload.dc1_power)
 
             time.sleep(1)
         except OSError as e:
@@ -0,0 +1,176 @@
+import struct
+from datetime import datetime
+from collections import namedtuple
+
+# The fields of a ModbusSample (one for every register we read from the E5) and how each one is packed. Registers are
+# unsigned 16 bit values apart from the battery and utility current/power, which are two's complement
+SAMPLE_FIELDS = (
+    ('ac1_voltage', 'H'), ('ac1_current', 'H'), ('ac1_power', 'H'), ('ac1_freq', 'H'),
+    ('ac2_voltage', 'H'), ('ac2_current', 'H'), ('ac2_power', 'H'), ('ac2_freq', 'H'),
+    ('dc1_voltage', 'H'), ('dc1_current', 'H'), ('dc1_power', 'H'),
+    ('dc2_voltage', 'H'), ('dc2_current', 'H'), ('dc2_power', 'H'),
+    ('fw_dsp', 'H'), ('fw_red', 'H'), ('fw_disp', 'H'),
+    ('inverter_status', 'H'),
+    ('ambient_temp', 'H'), ('boost_1_temp', 'H'), ('boost_2_temp', 'H'), ('inverter_temp', 'H'),
+    ('bt_soc', 'H'), ('utility_current', 'h'), ('utility_power', 'h'), ('bt_capacity', 'H'),
+    ('inverter_op_mode', 'H'), ('bt_voltage', 'H'), ('bt_current', 'h'), ('bt_wattage', 'h'),
+    ('bt_module1_temp_max', 'H'), ('bt_module1_temp_min', 'H'),
+)
+
+# The names of the operation modes that the E5 reports in register 1551
+OPERATION_MODES = {0: "STAND_BY_MODE",
+                   1: "SELF_CONSUMPTION_MODE_INTERNAL",
+                   2: "PEAK_CUT_MODE",
+                   3: "CHARGE_FIRST_MODE",
+                   4: "DISCHARGE_FIRST_MODE",
+                   5: "WITHOUT_BT_MODE",
+                   6: "PV_CHARGE_BT_FIRST_MODE",
+                   11: "STAND_BY_PAUSE_MODE",
+                   12: "MAINTENANCE_MODE"}
+
+# The names of the inverter statuses that the E5 reports in register 1047
+INVERTER_STATUSES = {0: "Standby",
+                     1: "Countdown",
+                     2: "On Grid",
+                     3: "No DC",
+                     4: "Alarm",
+                     5: "Reserved",
+                     6: "Stand Alone"}
+
+
+def lookup_operation_mode(mode_int):
+    return OPERATION_MODES.get(mode_int, "STAND_ALONE_MODE")
+
+
+def lookup_inverter_status(status_int):
+    return INVERTER_STATUSES.get(status_int, "On")
+
+
+def decode_firmware_version(raw_value):
+    """ Converts a raw firmware register into a version string """
+    version = hex(int(raw_value))
+    return 'v0' + str(int(version[2], 16)) + '.' + str(int(version[3:5], 16))
+
+
+def twos_comp(value, bits=16):
+    """ Converts an unsigned register value into a signed one """
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value
+
+
+# Our day logs don't have every register in them. These are the values we use for the ones that are missing when we
+# replay a day log
+UNLOGGED_REGISTERS = {
+    'fw_dsp': 0x1234,
+    'fw_red': 0x1234,
+    'fw_disp': 0x1234,
+    'inverter_status': 2,
+    'ambient_temp': 30,
+    'boost_1_temp': 40,
+    'boost_2_temp': 40,
+    'inverter_temp': 45,
+    'bt_capacity': 60,
+    'inverter_op_mode': 1,
+}
+
+
+def to_register(value):
+    """ Converts a (possibly negative) number into an unsigned 16 bit register value """
+    return int(round(float(value))) & 0xFFFF
+
+
+def csv_row_to_registers(row):
+    """ Converts a row of one of our day logs back into the raw register values that the E5 would have given us. This
+    undoes the scaling that FirebaseMethods.condition_data applies """
+
+    registers = {
+        'ac1_power': to_register(row['ac1p']),
+        'ac1_voltage': to_register(float(row['ac1v']) * 10),
+        'ac1_current': to_register(float(row['ac1c']) * 100),
+        'ac1_freq': to_register(float(row['ac1_freq']) * 100),
+
+        'ac2_power': to_register(row['ac2p']),
+        'ac2_voltage': to_register(float(row['ac2v']) * 10),
+        'ac2_current': to_register(float(row['ac2c']) * 100),
+        # We don't log the AC2 frequency, so use AC1's
+        'ac2_freq': to_register(float(row['ac1_freq']) * 100),
+
+        'dc1_power': to_register(row['dc1p']),
+        'dc1_voltage': to_register(float(row['dc1v']) * 10),
+        'dc1_current': to_register(float(row['dc1c']) * 100),
+
+        'dc2_power': to_register(row['dc2p']),
+        'dc2_voltage': to_register(float(row['dc2v']) * 10),
+        'dc2_current': to_register(float(row['dc2c']) * 100),
+
+        # The battery power and current are logged with the opposite sign to the registers
+        'bt_wattage': to_register(-1 * float(row['btp'])),
+        'bt_voltage': to_register(float(row['btv']) * 10),
+        'bt_current': to_register(-1 * float(row['btc']) * 100),
+        'bt_soc': to_register(float(row['btsoc']) * 10),
+
+        'utility_power': to_register(row['utility_p']),
+        'utility_current': to_register(float(row['utility_c']) * 100),
+
+        'bt_module1_temp_max': to_register(float(row['bt_module1_max_temp']) * 10),
+        'bt_module1_temp_min': to_register(float(row['bt_module1_min_temp']) * 10),
+    }
+
+    return registers
+
+
+class ModbusSample(namedtuple('ModbusSample', ['time'] + [name for name, _ in SAMPLE_FIELDS])):
+    """ A single sample of every register that we read from the E5, with a POSIX timestamp. Values are the (integer)
+    register values, with the signed registers already converted from two's complement. Scaling is left to the
+    consumers, as it was when this was a tuple of dictionaries.
+
+    Samples are pickled as their packed struct form, so they are cheap to send between processes """
+
+    __slots__ = ()
+
+    # time is a double followed by every register
+    _STRUCT = struct.Struct('<d' + ''.join(code for _, code in SAMPLE_FIELDS))
+
+    @classmethod
+    def from_registers(cls, time, raw_data):
+        """ Creates a sample from a dictionary of raw (unsigned) register values keyed by field name """
+        values = [time]
+        for name, code in SAMPLE_FIELDS:
+            value = int(raw_data[name])
+            values.append(twos_comp(value) if code == 'h' else value)
+
+        return cls._make(values)
+
+    def pack(self):
+        return self._STRUCT.pack(*self)
+
+    @classmethod
+    def unpack(cls, data):
+        return cls._make(cls._STRUCT.unpack(data))
+
+    def __reduce__(self):
+        return unpack_sample, (self.pack(),)
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.time)
+
+    @property
+    def operation_mode(self):
+        return lookup_operation_mode(self.inverter_op_mode)
+
+    @property
+    def status(self):
+        return lookup_inverter_status(self.inverter_status)
+
+    @property
+    def firmware_versions(self):
+        """ Returns the (DSP, RED, DISP) firmware version strings """
+        return (decode_firmware_version(self.fw_dsp), decode_firmware_version(self.fw_red),
+                decode_firmware_version(self.fw_disp))
+
+
+def unpack_sample(data):
+    """ Recreates a ModbusSample from its packed form. This is what unpickling a sample calls """
+    return ModbusSample.unpack(data)
@@ -1,154 +1,242 @@
+import os
 import time
-import pyrebase
+import json
 import ast
 import csv
 from datetime import datetime
 from utils import log
+from csvintegrity import repair_csv_tail
 
 
 class WebAnalyticsMethods:
 
+    # Where we keep our running totals, and how many samples we integrate between saving them
+    _CHECKPOINT_PATH = '../data/checkpoints/webanalytics.json'
+    _CHECKPOINT_INTERVAL = 60
+
+    # The longest gap between two samples (in seconds) that we integrate across. After a longer gap (eg. Modbus was
+    # restarted) a sample counts for one second
+    _MAX_SAMPLE_GAP = 10
+
     def __init__(self):
         super().__init__()
         self.today = datetime.now().day
         self.current_analytics_data = dict()
 
-        self.analyze_csv_integrity()
-
-    @staticmethod
-    def analyze_csv_integrity():
-        """ This function analyzes the csv file and makes sure that there are no NULL bytes """
-
-        def fix_nulls(s):
-            """ This function takes a generator that replaces NULL bytes with blank """
-            for line in s:
-                yield line.replace('\0', '')
-
-        try:
-            current_csv = datetime.now().strftime('%Y-%m-%d') + '.csv'
-            fixed_csv_list = None
-
-            with open('../data/logs/' + current_csv) as csvfile:
-                if '\0' in csvfile.read():
-                    log('We found a null byte, lets fix it')
-
-                    # Reset our csv iterator
-                    csvfile.seek(0)
+        # How many samples we have integrated since we last saved a checkpoint
+        self._samples_since_checkpoint = 0
 
-                    # Remove the NULL bytes from the csv file
-                    fixed_csv = csv.reader(fix_nulls(csvfile))
-                    fixed_csv_list = list()
+        # The time of the last sample that we integrated
+        self._last_sample_time = None
 
-                    # Now save the rows to a list
-                    for row in fixed_csv:
-                        fixed_csv_list.append(row)
+        # The time of the last day log row that we integrated, as it is written in the day log
+        self._last_row_time = None
 
-            # If a list exists then we know that there was something wrong so we need to rewrite the csv file
-            if fixed_csv_list:
-                # Open the corrupt csv
-                with open('../data/logs/' + current_csv, mode='w', newline='') as f:
-                    writer = csv.writer(f)
+        # If the integrity check rewrote today's csv, byte offsets into it are no longer valid
+        self._csv_rewritten = self.analyze_csv_integrity()
 
-                    # Write the uncorrupt rows to it and replace the file
-                    for row in fixed_csv_list:
-                        if len(row) != 0:
-                            writer.writerow(row)
+    @staticmethod
+    def blank_analytics_data():
+        return {'dcp_t': 0,
+                'utility_p_export_t': 0,
+                'utility_p_import_t': 0,
+                'btp_charged_t': 0,
+                'btp_consumed_t': 0,
+                'ac2p_t': 0}
 
-                log('Fixed the csv file!!')
+    @staticmethod
+    def analyze_csv_integrity():
+        """ This function makes sure that today's csv file has no NULL bytes in it. Returns True if it had to repair
+        the file """
+        try:
+            return repair_csv_tail('../data/logs/' + datetime.now().strftime('%Y-%m-%d') + '.csv')
 
         except FileNotFoundError as e:
             log('File doesnt exist! Skipping integrity check')
+            return False
 
     def sync_analytics_data(self):
         self.analyse_todays_history()
 
     def analyse_todays_history(self):
+        """ Rebuilds today's analytics totals. If we have a checkpoint from today, we start from its totals and only
+        integrate the rows of today's csv that come after the last sample that it counted. The day log is written
+        through a buffer, so the rows just before the checkpoint's offset may not have reached the file when it was
+        saved. We read on from the offset, and use the time of the last sample to skip the rows that it already has.
+
+        The offset is only a shortcut past rows that we know were counted. If the integrity check rewrote the csv, or
+        it is now shorter than the offset, we read it from the start and go by the time alone """
         log('Analysing todays past data...')
 
+        today = datetime.now().strftime('%Y-%m-%d')
+        current_csv = '../data/logs/' + today + '.csv'
+
+        totals = self.blank_analytics_data()
+        offset = 0
+        last_time = None
+
+        checkpoint = self.load_analytics_checkpoint()
+        if checkpoint is not None and checkpoint['date'] == today:
+            totals.update(checkpoint['totals'])
+            last_time = checkpoint['last_time']
+            try:
+                if not self._csv_rewritten and checkpoint['offset'] <= os.path.getsize(current_csv):
+                    offset = checkpoint['offset']
+            except OSError:
+                pass
+            log('Resuming analytics from checkpoint at byte', offset, 'after', last_time)
+
         try:
-            current_csv = datetime.now().strftime('%Y-%m-%d') + '.csv'
-            with open('../data/logs/' + current_csv, 'r') as f:
-                dcp_total = 0
-                utility_p_export_total = 0
-                utility_p_import_total = 0
-                btp_consumed_total = 0
-                btp_charged_total = 0
-                ac2p_total = 0
-
-                reader = csv.reader(f)
-                next(reader)
-                for row in reader:
-                    dc1p = float(row[7])
-                    dc2p = float(row[10])
-                    ac2p = float(row[4])
-                    utility_p = float(row[17])
-                    btp = float(row[13])
-
-                    dcp_total += ((dc1p + dc2p) * (2 / 3600)) / 1000
-                    ac2p_total += (ac2p * (2 / 3600)) / 1000
-
-                    if utility_p >= 0:
-                        utility_p_export_total += (utility_p * (2 / 3600)) / 1000
-                    else:
-                        utility_p_import_total += (utility_p * (2 / 3600)) / 1000
-
-                    if btp >= 0:
-                        btp_consumed_total += (btp * (2 / 3600)) / 1000
-                    else:
-                        btp_charged_total += (btp * (2 / 3600)) / 1000
-                log('Done!')
-                log('DC Power: ', dcp_total)
-                log('Utility export/import: ', utility_p_export_total, utility_p_import_total)
-                log('Battery Consumed/Charged: ', btp_consumed_total, btp_charged_total)
-                log('AC2 Power: ', ac2p_total)
-
-            # Final synchronised data:
-            self.current_analytics_data = {'dcp_t': dcp_total,
-                                           'utility_p_export_t': utility_p_export_total,
-                                           'utility_p_import_t': utility_p_import_total,
-                                           'btp_charged_t': btp_charged_total,
-                                           'btp_consumed_t': btp_consumed_total,
-                                           'ac2p_t': ac2p_total}
+            with open(current_csv, 'rb') as f:
+                if offset == 0:
+                    # Skip the header
+                    f.readline()
+                else:
+                    # The checkpoint may have been taken while a row was being written. If so, that row was already
+                    # counted, so skip to the start of the next one
+                    f.seek(offset - 1)
+                    if f.read(1) != b'\n':
+                        f.readline()
+
+                rows, last_time = self.integrate_history_rows(
+                    csv.reader(line.decode('utf-8', 'replace') for line in f), totals, last_time)
+
+            log('Done! Integrated', rows, 'rows')
+            log('DC Power: ', totals['dcp_t'])
+            log('Utility export/import: ', totals['utility_p_export_t'], totals['utility_p_import_t'])
+            log('Battery Consumed/Charged: ', totals['btp_consumed_t'], totals['btp_charged_t'])
+            log('AC2 Power: ', totals['ac2p_t'])
 
         except FileNotFoundError as e:
             log(e, 'creating blank analytics object')
-            # Final synchronised data:
-            self.current_analytics_data = {'dcp_t': 0,
-                                           'utility_p_export_t': 0,
-                                           'utility_p_import_t': 0,
-                                           'btp_charged_t': 0,
-                                           'btp_consumed_t': 0,
-                                           'ac2p_t': 0}
+            totals = self.blank_analytics_data()
+
+        # Final synchronised data:
+        self.current_analytics_data = totals
+        self._last_row_time = last_time
+        self.save_analytics_checkpoint()
+
+    @staticmethod
+    def integrate_history_rows(reader, totals, after=None):
+        """ Adds the energy of every row of a day log to totals. Each row is 2 seconds. Rows from at or before the time
+        after have already been counted, so are skipped. Returns the number of rows and the time of the last one.
+
+        Times are compared as they are written in the day log (str of a datetime), which sort in the same order as the
+        times that they stand for """
+        rows = 0
+        last_time = after
+        for row in reader:
+            if not row or (after is not None and row[0] <= after):
+                continue
+
+            try:
+                dc1p = float(row[7])
+                dc2p = float(row[10])
+                ac2p = float(row[4])
+                utility_p = float(row[17])
+                btp = float(row[13])
+            except (ValueError, IndexError):
+                # Skip any corrupted rows
+                continue
+            last_time = row[0]
+
+            totals['dcp_t'] += ((dc1p + dc2p) * (2 / 3600)) / 1000
+            totals['ac2p_t'] += (ac2p * (2 / 3600)) / 1000
+
+            if utility_p >= 0:
+                totals['utility_p_export_t'] += (utility_p * (2 / 3600)) / 1000
+            else:
+                totals['utility_p_import_t'] += (utility_p * (2 / 3600)) / 1000
+
+            if btp >= 0:
+                totals['btp_consumed_t'] += (btp * (2 / 3600)) / 1000
+            else:
+                totals['btp_charged_t'] += (btp * (2 / 3600)) / 1000
+
+            rows += 1
+
+        return rows, last_time
+
+    def load_analytics_checkpoint(self):
+        """ Returns our last checkpoint ({'date', 'offset', 'last_time', 'totals'}), or None if we don't have a valid
+        one """
+        try:
+            with open(self._CHECKPOINT_PATH, 'r') as f:
+                checkpoint = json.load(f)
+            if not isinstance(checkpoint.get('offset'), int) or not isinstance(checkpoint.get('totals'), dict):
+                return None
+
+            # A checkpoint without the time of its last sample can't tell us which of the rows after it were counted
+            if 'last_time' not in checkpoint:
+                return None
+            return checkpoint
+
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def save_analytics_checkpoint(self):
+        """ Saves our running totals along with the time of the last sample that they count, and the size of today's
+        csv. Every row before that offset was written before the checkpoint, so a restart can carry on reading from it.
+        The checkpoint is replaced atomically, so a power cut leaves either the old or the new one """
+        today = datetime.now().strftime('%Y-%m-%d')
+        try:
+            offset = os.path.getsize('../data/logs/' + today + '.csv')
+        except OSError:
+            offset = 0
+
+        if self._last_sample_time is not None:
+            last_time = str(datetime.fromtimestamp(self._last_sample_time))
+        else:
+            last_time = self._last_row_time
+
+        checkpoint = {'date': today, 'offset': offset, 'last_time': last_time, 'totals': self.current_analytics_data}
+        temp_path = self._CHECKPOINT_PATH + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._CHECKPOINT_PATH), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(checkpoint, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self._CHECKPOINT_PATH)
+
+        except OSError as e:
+            log('Could not save analytics checkpoint', e)
+
+        self._samples_since_checkpoint = 0
 
     def update_analytics(self, new_data):
         day = datetime.now().day
         # Check if we have gone to a new day, if we have then we have to reset the current_analytics dict
         if day != self.today:
             log('New day - reset analytics!')
-            self.current_analytics_data = {'dcp_t': 0,
-                                           'utility_p_export_t': 0,
-                                           'utility_p_import_t': 0,
-                                           'btp_consumed_t': 0,
-                                           'btp_charged_t': 0,
-                                           'ac2p_t': 0}
+            self.current_analytics_data = self.blank_analytics_data()
             self.today = day
+            self.save_analytics_checkpoint()
+
+        # new_data is a ModbusSample of raw register values. Each sample is integrated over the time since the last one,
+        # as the Modbus loop skips a second now and then when it overruns
+        elapsed = 1 if self._last_sample_time is None else new_data.time - self._last_sample_time
+        if not 0 < elapsed <= self._MAX_SAMPLE_GAP:
+            elapsed = 1
+        self._last_sample_time = new_data.time
+        hours = elapsed / 3600
 
-        inverter_data_temp = new_data[0]
-        self.current_analytics_data['dcp_t'] += ((inverter_data_temp['dc1_power'] + inverter_data_temp['dc2_power']) * (
-                1 / 3600)) / 1000
-        self.current_analytics_data['ac2p_t'] += (inverter_data_temp['ac2_power'] * (1 / 3600)) / 1000
+        self.current_analytics_data['dcp_t'] += ((new_data.dc1_power + new_data.dc2_power) * hours) / 1000
+        self.current_analytics_data['ac2p_t'] += (new_data.ac2_power * hours) / 1000
 
-        bt_data_temp = new_data[1]
-        if bt_data_temp['utility_power'] >= 0:
-            self.current_analytics_data['utility_p_export_t'] += (bt_data_temp['utility_power'] * (1 / 3600)) / 1000
+        if new_data.utility_power >= 0:
+            self.current_analytics_data['utility_p_export_t'] += (new_data.utility_power * hours) / 1000
         else:
-            self.current_analytics_data['utility_p_import_t'] += (bt_data_temp['utility_power'] * (1 / 3600)) / 1000
+            self.current_analytics_data['utility_p_import_t'] += (new_data.utility_power * hours) / 1000
 
-        if float(-1 * bt_data_temp['bt_wattage']) >= 0:
-            self.current_analytics_data['btp_consumed_t'] += (float(-1 * bt_data_temp['bt_wattage']) * (
-                    1 / 3600)) / 1000
+        if float(-1 * new_data.bt_wattage) >= 0:
+            self.current_analytics_data['btp_consumed_t'] += (float(-1 * new_data.bt_wattage) * hours) / 1000
         else:
-            self.current_analytics_data['btp_charged_t'] += (float(-1 * bt_data_temp['bt_wattage']) * (1 / 3600)) / 1000
+            self.current_analytics_data['btp_charged_t'] += (float(-1 * new_data.bt_wattage) * hours) / 1000
+
+        self._samples_since_checkpoint += 1
+        if self._samples_since_checkpoint >= self._CHECKPOINT_INTERVAL:
+            self.save_analytics_checkpoint()
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import logging.handlers
+import time
 import logging
 
 
@@ -20,3 +21,92 @@ def log(*args, level=logging.INFO, print_out=False):
         print(args)
 
     logger.log(level, final_string)
+
+
+class Histogram:
+    """ A fixed bucket histogram. edges are the upper bounds of each bucket, with one extra bucket for anything larger """
+
+    def __init__(self, edges):
+        self.edges = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.total = 0
+        self.maximum = None
+
+    def add(self, value):
+        for i, edge in enumerate(self.edges):
+            if value <= edge:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+
+        self.total += 1
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.total = 0
+        self.maximum = None
+
+    def summary(self):
+        """ Returns a short human readable summary of the histogram """
+        buckets = ['<=' + str(edge) + ': ' + str(count) for edge, count in zip(self.edges, self.counts)]
+        buckets.append('>' + str(self.edges[-1]) + ': ' + str(self.counts[-1]))
+        return 'n=' + str(self.total) + ', max=' + str(self.maximum) + ', ' + ', '.join(buckets)
+
+
+class CycleClock:
+    """ Paces a loop at a fixed rate using absolute deadlines on the monotonic clock, so that the time we spend working
+    in each cycle does not make the loop drift. If a cycle overruns, the ticks that we missed are skipped and counted
+    rather than run back to back """
+
+    # Upper bounds (in seconds) of the buckets in our wake up jitter histogram
+    _JITTER_EDGES = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+
+    def __init__(self, period):
+        self.period = period
+
+        # The monotonic time of our first tick, and the number of ticks since then (including skipped ones)
+        self._start_time = None
+        self.tick = 0
+
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.jitter = Histogram(self._JITTER_EDGES)
+
+    def start(self):
+        """ Makes the current time our first tick """
+        self._start_time = time.monotonic()
+        self.tick = 0
+
+    def scheduled_time(self):
+        """ The monotonic time that the current tick was scheduled for """
+        return self._start_time + self.tick * self.period
+
+    def wait(self):
+        """ Sleeps until the next tick. Returns the number of ticks that were skipped because we overran """
+        if self._start_time is None:
+            self.start()
+
+        self.tick += 1
+        now = time.monotonic()
+        overrun = now - self.scheduled_time()
+
+        skipped = 0
+        if overrun > 0:
+            # We missed our deadline, so move on to the next tick that is still in the future
+            skipped = int(overrun // self.period) + 1
+            self.overruns += 1
+            self.skipped_ticks += skipped
+            self.tick += skipped
+            log('Cycle overran by', round(overrun, 3), 's, skipped', skipped, 'tick(s)', level=logging.WARNING)
+
+        deadline = self.scheduled_time()
+        time.sleep(max(0, deadline - time.monotonic()))
+        self.jitter.add(time.monotonic() - deadline)
+
+        return skipped
+
+    def stats(self):
+        return {'overruns': self.overruns, 'skipped_ticks': self.skipped_ticks, 'jitter': self.jitter.summary()}
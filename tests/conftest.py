@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The helpers import each other by their bare names, the same way they do when deltasolarcharger.py runs them
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deltasolarcharger')
+sys.path.insert(0, os.path.join(_ROOT, 'dschelpers'))
+sys.path.insert(0, _ROOT)
+
+# These are scripts that we run by hand against a real Firebase or FTP server, not tests
+collect_ignore = ['test.py', 'start_test.py', 'stream test.py', 'dynamic_buffer_calculations.py']
@@ -0,0 +1,112 @@
+from types import SimpleNamespace
+
+
+class HTTPError(OSError):
+    """ Stands in for requests' HTTPError. pyrebase raises one with the HTTPError for the response as its first
+    argument, and the response's text as its second """
+
+    def __init__(self, *args, response=None):
+        super().__init__(*args)
+        self.response = response
+
+
+def rejected(status_code, text):
+    error = HTTPError(str(status_code) + ' Client Error', response=SimpleNamespace(status_code=status_code))
+    return HTTPError(error, text)
+
+
+def split(path):
+    return [part for part in path.split('/') if part]
+
+
+class FakeDatabase:
+    """ Just enough of a pyrebase database for the uploader: child(path).update/set/remove. Updates are applied the way
+    Firebase applies a multi-path update, and like Firebase, an update where one key is inside another is rejected.
+    While offline is set every request fails with a ConnectionError, and a write to a path in forbidden is refused with
+    a 401 like the database rules refuse it """
+
+    def __init__(self):
+        self.tree = dict()
+        self.requests = list()
+        self.offline = False
+        self.forbidden = set()
+
+    def child(self, path):
+        return FakeReference(self, path)
+
+    def get(self, path):
+        node = self.tree
+        for part in split(path):
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def write(self, parts, value):
+        if not parts:
+            self.tree = value if isinstance(value, dict) else dict()
+            return
+
+        node = self.tree
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = dict()
+            node = node[part]
+
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+
+    def request(self, path, data, keys=('',)):
+        """ Checks a request that changes keys below path, and records it """
+        if self.offline:
+            raise ConnectionError('Network is unreachable')
+
+        locations = [tuple(split(path) + split(key)) for key in keys]
+        for location in locations:
+            if any('/'.join(location[:i]) in self.forbidden for i in range(len(location) + 1)):
+                raise rejected(401, '{"error" : "Permission denied"}')
+            for other in locations:
+                if other != location and other[:len(location)] == location:
+                    raise rejected(400, '{"error" : "Invalid data; ' + '/'.join(location) + ' is an ancestor of '
+                                   + '/'.join(other) + '"}')
+
+        self.requests.append((path, data))
+
+    def update(self, path, data):
+        self.request(path, data, list(data))
+        for key, value in data.items():
+            self.write(split(path) + split(key), value)
+
+
+class FakeReference:
+    def __init__(self, database, path):
+        self.database = database
+        self.path = path
+
+    def update(self, data, token=None):
+        self.database.update(self.path, data)
+
+    def set(self, data, token=None):
+        self.database.request(self.path, data)
+        self.database.write(split(self.path), data)
+
+    def remove(self, token=None):
+        self.database.request(self.path, None)
+        self.database.write(split(self.path), None)
+
+
+def apply_one_by_one(writes):
+    """ Returns the tree that we get by sending the writes to Firebase one at a time, which is what merging them has to
+    match """
+    database = FakeDatabase()
+    for method, path, data in writes:
+        reference = database.child(path)
+        if method == 'update':
+            reference.update(data)
+        elif method == 'set':
+            reference.set(data)
+        else:
+            reference.remove()
+    return database.tree
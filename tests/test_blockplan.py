@@ -0,0 +1,84 @@
+from queue import Queue
+from types import SimpleNamespace
+
+import pytest
+
+minimalmodbus = pytest.importorskip('minimalmodbus')
+
+import modbusmethods
+from modbusmethods import ModbusMethods, E5_REGISTER_MAP, plan_block_reads
+
+
+class FakeE5:
+    """ Records the transactions that we make, and refuses block reads that cover more than max_block registers """
+
+    def __init__(self, max_block=None):
+        self.serial = SimpleNamespace()
+        self.max_block = max_block
+        self.transactions = list()
+
+    def write_register(self, address, value, *args):
+        self.transactions.append(('write', address, value))
+
+    def read_registers(self, start, count, function_code):
+        self.transactions.append(('read', start, count))
+        if self.max_block is not None and count > self.max_block:
+            raise ValueError('Slave reporting error. The slave is indicating an error. The response is: 0x84 0x02')
+        return [0] * count
+
+
+# Every register group, which is what we read when we connect to the E5
+ALL_GROUPS = frozenset(ModbusMethods._POLL_PERIODS)
+
+
+@pytest.fixture
+def modbus(monkeypatch):
+    e5 = FakeE5()
+    monkeypatch.setattr(modbusmethods.minimalmodbus, 'Instrument', lambda *args: e5)
+    return ModbusMethods(Queue())
+
+
+def test_the_register_map_is_read_in_10_transactions(modbus):
+    raw_data = modbus.read_register_plan(modbus.get_register_plan(ALL_GROUPS))
+
+    assert len(modbus.E5.transactions) == 10
+    assert [transaction for transaction in modbus.E5.transactions if transaction[0] == 'write'] == [
+        ('write', 799, 0), ('write', 799, 32), ('write', 799, 48), ('write', 799, 49)]
+    assert set(raw_data) == set(register.name for register in E5_REGISTER_MAP)
+
+
+def test_every_register_is_in_exactly_one_block():
+    plan = plan_block_reads(E5_REGISTER_MAP, 24, 125)
+    registers = [register for block in plan for register in block.registers]
+
+    assert sorted(registers) == sorted(E5_REGISTER_MAP)
+    for block in plan:
+        assert block.count <= 125
+        assert all(block.start <= register.address < block.start + block.count for register in block.registers)
+
+
+def test_a_slave_error_halves_the_gap_and_clears_the_plan_cache(modbus):
+    modbus.E5.max_block = 40
+    plan = modbus.get_register_plan(ALL_GROUPS)
+    modbus.get_register_plan(frozenset(['ac']))
+
+    with pytest.raises(ValueError):
+        modbus.read_register_plan(plan)
+
+    assert modbus._MAX_REGISTER_GAP == 12
+    assert ModbusMethods._MAX_REGISTER_GAP == 24
+    assert modbus._plan_cache == dict()
+
+    # The next read is planned with the smaller gap, and the E5 takes it
+    new_plan = modbus.get_register_plan(ALL_GROUPS)
+    assert new_plan != plan
+    assert max(block.count for block in new_plan) < 40
+    modbus.read_register_plan(new_plan)
+
+
+def test_plans_are_cached_per_set_of_groups(modbus):
+    plan = modbus.get_register_plan(frozenset(['ac', 'dc']))
+
+    assert modbus.get_register_plan(frozenset(['dc', 'ac'])) is plan
+    assert set(block.page for block in plan) == {0, 32, 48, 49}
+    assert set(block.page for block in modbus.get_register_plan(frozenset(['battery']))) == {None}
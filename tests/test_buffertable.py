@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from analysemethods import BufferTable, BUFFER_CURVES
+
+
+def polynomial_buffer(curve, z):
+    """ What the dynamic buffer was before it was put in a table """
+    coefficients, clamp_z, clamp_buffer = curve
+    if z > clamp_z:
+        return clamp_buffer
+    return max(np.polynomial.polynomial.polyval(np.log(z), coefficients) / 100, 0.0)
+
+
+@pytest.mark.parametrize('name', sorted(BUFFER_CURVES))
+def test_the_table_matches_the_polynomial(name):
+    table = BufferTable.from_curve(BUFFER_CURVES[name])
+    for z in np.logspace(-9, 0, 2000):
+        assert table.lookup(z) == pytest.approx(polynomial_buffer(BUFFER_CURVES[name], z), abs=1e-4)
+
+
+def test_a_curve_from_firebase():
+    # Firebase turns a list into a dictionary keyed by index
+    table = BufferTable.from_curve({'coefficients': {'0': 10, '1': 0, '2': 0}, 'clamp_z': 0.2, 'clamp_buffer': 0.5})
+    assert table.coefficients == (10.0, 0.0, 0.0)
+    assert table.lookup(0.01) == pytest.approx(0.1)
+    assert table.lookup(0.3) == 0.5
+
+
+def test_clamp_z_has_to_be_above_the_table():
+    with pytest.raises(ValueError):
+        BufferTable((1, 2, 3), 0, 0.1)
@@ -0,0 +1,65 @@
+import pytest
+
+import csvintegrity
+from csvintegrity import repair_csv_tail, load_verified_offset
+
+
+@pytest.fixture
+def day_log(tmp_path, monkeypatch):
+    monkeypatch.setattr(csvintegrity, '_CHECKPOINT_DIR', str(tmp_path / 'checkpoints') + '/')
+    return str(tmp_path / '2019-03-01.csv')
+
+
+def write(path, data, mode='wb'):
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_a_clean_log_is_left_alone_and_checkpointed(day_log):
+    write(day_log, b'time,ac1p\n1,2\n3,4')
+
+    assert not repair_csv_tail(day_log)
+    assert read(day_log) == b'time,ac1p\n1,2\n3,4'
+
+    # The last row may not be finished, so it isn't counted as checked
+    assert load_verified_offset(day_log) == len(b'time,ac1p\n1,2\n')
+
+
+def test_null_bytes_from_a_power_cut_are_removed(day_log):
+    write(day_log, b'time,ac1p\n1,2\n' + b'\0' * 20 + b'\n3,4\n')
+
+    assert repair_csv_tail(day_log)
+    assert read(day_log) == b'time,ac1p\n1,2\n3,4\n'
+    assert load_verified_offset(day_log) == len(read(day_log))
+    assert not repair_csv_tail(day_log)
+
+
+def test_only_the_unchecked_tail_is_scanned(day_log):
+    write(day_log, b'time,ac1p\n1,2\n')
+    repair_csv_tail(day_log)
+
+    # Pretend the checked part went bad. We trust our checkpoint, so only the new rows are repaired
+    write(day_log, b'time,ac1p\n1,\0\n', 'r+b')
+    write(day_log, b'3,\0\0\n\0\0\n', 'ab')
+
+    assert repair_csv_tail(day_log)
+    assert read(day_log) == b'time,ac1p\n1,\0\n3,\n'
+
+
+def test_a_replaced_log_is_checked_from_the_start(day_log):
+    write(day_log, b'time,ac1p\n1,2\n3,4\n5,6\n')
+    repair_csv_tail(day_log)
+
+    write(day_log, b'time,\0ac1p\n')
+    assert repair_csv_tail(day_log)
+    assert read(day_log) == b'time,ac1p\n'
+
+
+def test_a_missing_log_raises(day_log):
+    with pytest.raises(FileNotFoundError):
+        repair_csv_tail(day_log)
@@ -0,0 +1,69 @@
+import pytest
+
+import utils
+from utils import CycleClock
+
+
+class FakeClock:
+    """ A monotonic clock that only moves when we sleep or do some 'work' """
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = list()
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def work(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils, 'time', clock)
+    return clock
+
+
+def test_ticks_stay_on_their_absolute_deadlines(clock):
+    cycle_clock = CycleClock(0.5)
+    cycle_clock.start()
+
+    for _ in range(4):
+        clock.work(0.1)
+        assert cycle_clock.wait() == 0
+
+    # The time that we spent working doesn't add up, as we sleep until each deadline rather than for a period
+    assert clock.now == pytest.approx(102.0)
+    assert clock.sleeps == [pytest.approx(0.4)] * 4
+    assert cycle_clock.stats()['overruns'] == 0
+
+
+def test_an_overrunning_tick_is_skipped_and_counted(clock):
+    cycle_clock = CycleClock(0.5)
+    cycle_clock.start()
+
+    # Overrunning by 0.7 s misses the deadlines at 100.5 and 101.0, so we wait for the one at 101.5
+    clock.work(1.2)
+    assert cycle_clock.wait() == 2
+    assert clock.now == pytest.approx(101.5)
+    assert cycle_clock.scheduled_time() == pytest.approx(101.5)
+
+    clock.work(0.1)
+    assert cycle_clock.wait() == 0
+    assert clock.now == pytest.approx(102.0)
+
+    stats = cycle_clock.stats()
+    assert stats['overruns'] == 1
+    assert stats['skipped_ticks'] == 2
+
+
+def test_the_first_wait_starts_the_clock(clock):
+    cycle_clock = CycleClock(1)
+
+    assert cycle_clock.wait() == 0
+    assert clock.now == pytest.approx(101.0)
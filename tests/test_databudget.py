@@ -0,0 +1,95 @@
+from datetime import datetime
+
+import pytest
+
+import databudget
+from databudget import DataBudget
+
+# The streams that FirebaseMethods schedules: (fastest, slowest, optional)
+STREAMS = {'live': (1, 60, True), 'history': (2, 900, False), 'analytics': (20, 3600, False)}
+
+NOW = datetime(2019, 3, 16)
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(NOW.year, NOW.month, NOW.day)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ Half way through March 2019, so there are 16 days left of the month. Returns a list holding the time, which
+    a test can move on """
+    now = [NOW.timestamp()]
+    monkeypatch.setattr(databudget, 'datetime', FixedDatetime)
+    monkeypatch.setattr(databudget.time, 'time', lambda: now[0])
+    return now
+
+
+def make_budget(tmp_path, monthly_bytes):
+    return DataBudget(monthly_bytes, STREAMS, state_path=str(tmp_path / 'databudget.json'))
+
+
+def test_we_upload_as_often_as_we_like_under_budget(tmp_path, clock):
+    assert make_budget(tmp_path, 10e9).update() == {'live': 1, 'history': 2, 'analytics': 20}
+
+
+def test_intervals_are_stretched_to_fit_what_is_left(tmp_path, clock):
+    budget = make_budget(tmp_path, 100e6)
+    intervals = budget.update()
+
+    allowed_rate = 100e6 * 0.95 / (datetime(2019, 3, 31, 23, 59, 59).timestamp() - clock[0])
+    assert budget.scheduled_rate(intervals) <= allowed_rate
+    assert budget.scheduled_rate({name: interval - 1 for name, interval in intervals.items()}) > allowed_rate * 0.9
+
+    # Every stream is stretched by about the same factor
+    assert intervals['live'] > 1
+    assert intervals['history'] == pytest.approx(2 * intervals['live'], abs=2)
+    assert intervals['analytics'] == pytest.approx(20 * intervals['live'], abs=20)
+
+
+def test_near_the_cap_optional_streams_are_switched_off(tmp_path, clock):
+    intervals = make_budget(tmp_path, 5e6).update()
+    assert intervals['live'] is None
+    assert 2 < intervals['history'] < 900
+
+    budget = make_budget(tmp_path, 5e6)
+    budget.record('ftp', 10e6)
+    assert budget.update() == {'live': None, 'history': 900, 'analytics': 3600}
+
+
+def test_traffic_we_dont_schedule_is_measured(tmp_path, clock):
+    budget = make_budget(tmp_path, 200e6)
+    budget.update()
+    budget.intervals = {'live': None, 'history': 900, 'analytics': 3600}
+    budget.record('firebase', (700 / 900 + 700 / 3600) * 100 / budget.overhead)
+
+    clock[0] += 100
+    budget.update()
+    assert budget.other_rate == pytest.approx(0)
+
+    # Whatever we sent on top of what our intervals would have used is averaged into other_rate
+    scheduled_rate = budget.scheduled_rate(budget.intervals)
+    budget.record('ocpp', (5000 + scheduled_rate) * 100 / budget.overhead)
+    clock[0] += 100
+    budget.update()
+    assert budget.other_rate == pytest.approx(0.2 * 5000)
+
+
+def test_payloads_are_averaged(tmp_path, clock):
+    budget = make_budget(tmp_path, 1e9)
+    budget.record_payload('live', 1000)
+    budget.record_payload('live', 2000)
+    assert budget.payloads['live'] == pytest.approx(1100)
+
+
+def test_usage_carries_over_a_restart_but_not_a_new_month(tmp_path, clock):
+    budget = make_budget(tmp_path, 1e9)
+    budget.record('ftp', 1000)
+    budget.save()
+    assert make_budget(tmp_path, 1e9).total_used() == pytest.approx(1000 * budget.overhead)
+
+    budget.month = '2019-02'
+    budget.save()
+    assert make_budget(tmp_path, 1e9).total_used() == 0
@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from daystore import (DAY_LOG_FIELDS, DAY_DTYPE, HEADER_SIZE, append_record, read_day, iter_log_rows, export_csv,
+                      import_csv, parse_log_time)
+
+
+def values(i):
+    return [float(i * len(DAY_LOG_FIELDS) + j) for j in range(len(DAY_LOG_FIELDS))]
+
+
+def test_records_round_trip(tmp_path):
+    path = str(tmp_path / '2019-03-01.day')
+    for i in range(3):
+        append_record(path, 1551398400.0 + i, values(i))
+
+    records = read_day(path)
+    assert len(records) == 3
+    assert list(records['time']) == [1551398400.0, 1551398401.0, 1551398402.0]
+    assert list(records[2][list(DAY_LOG_FIELDS)]) == values(2)
+
+
+def test_a_half_written_record_is_dropped(tmp_path):
+    path = str(tmp_path / '2019-03-01.day')
+    append_record(path, 1.0, values(0))
+    with open(path, 'ab') as f:
+        f.write(b'\0' * (DAY_DTYPE.itemsize // 2))
+
+    assert len(read_day(path)) == 1
+    append_record(path, 2.0, values(1))
+    assert list(read_day(path)['time']) == [1.0, 2.0]
+
+
+def test_a_file_that_isnt_a_day_file_is_refused(tmp_path):
+    path = str(tmp_path / 'bad.day')
+    with open(path, 'wb') as f:
+        f.write(b'x' * HEADER_SIZE)
+
+    with pytest.raises(ValueError):
+        read_day(path)
+
+
+def test_parse_log_time():
+    assert parse_log_time('2019-03-01 13:45:07.250000') == datetime(2019, 3, 1, 13, 45, 7, 250000).timestamp()
+
+
+def test_csv_round_trip(tmp_path):
+    csv_path = str(tmp_path / '2019-03-01.csv')
+    day_path = str(tmp_path / '2019-03-01.day')
+    with open(csv_path, 'w') as f:
+        f.write('time,' + ','.join(DAY_LOG_FIELDS) + '\n')
+        f.write('2019-03-01 00:00:01.500000,' + ','.join('%g' % value for value in values(0)) + '\n')
+        f.write('corrupted row\n')
+        f.write('2019-03-01 00:00:03.500000,' + ','.join('%g' % value for value in values(1)) + '\n')
+
+    assert import_csv(csv_path, day_path) == 2
+
+    exported_path = str(tmp_path / 'exported.csv')
+    export_csv(day_path, exported_path)
+
+    rows = list(iter_log_rows(exported_path))
+    assert [timestamp for timestamp, _ in rows] == [timestamp for timestamp, _ in iter_log_rows(day_path)]
+    assert [float(rows[1][1][name]) for name in DAY_LOG_FIELDS] == values(1)
+    assert np.array_equal(read_day(day_path)['ac1p'], np.array([values(0)[0], values(1)[0]], dtype='<f4'))
@@ -0,0 +1,41 @@
+from deltaencoder import DeltaEncoder, flatten
+
+
+def document(voltage, power, timestamp):
+    return {'inverter_data': {'AC1 Voltage': {'value': voltage, 'unit': 'V'},
+                              'DC1 Power': {'value': power, 'unit': 'W'}},
+            'timestamp': timestamp}
+
+
+def test_flatten():
+    assert flatten({'a': {'b': 1, 'c': {'d': 2}}, 'e': 3, 'f': {}}) == {'a/b': 1, 'a/c/d': 2, 'e': 3, 'f': {}}
+
+
+def test_the_first_update_is_a_keyframe():
+    encoder = DeltaEncoder()
+    assert encoder.encode(document(240.0, 1200, 1)) == document(240.0, 1200, 1)
+    assert encoder.stats()['keyframes'] == 1
+
+
+def test_only_fields_that_moved_past_their_deadband_are_sent():
+    encoder = DeltaEncoder({'AC1 Voltage': 0.5})
+    encoder.encode(document(240.0, 1200, 1))
+
+    assert encoder.encode(document(240.4, 1200, 2)) == {'timestamp': 2}
+    assert encoder.encode(document(240.6, 1250, 3)) == {'inverter_data/AC1 Voltage/value': 240.6,
+                                                          'inverter_data/DC1 Power/value': 1250, 'timestamp': 3}
+
+    # The deadband is measured from the value that we last sent, so a slow drift is still sent
+    assert encoder.encode(document(241.0, 1250, 4)) == {'timestamp': 4}
+    assert encoder.encode(document(241.2, 1250, 5)) == {'inverter_data/AC1 Voltage/value': 241.2, 'timestamp': 5}
+
+
+def test_reset_and_the_keyframe_interval_send_the_whole_document():
+    encoder = DeltaEncoder(keyframe_interval=0)
+    encoder.encode(document(240.0, 1200, 1))
+    assert encoder.encode(document(240.0, 1200, 2)) == document(240.0, 1200, 2)
+
+    encoder = DeltaEncoder()
+    encoder.encode(document(240.0, 1200, 1))
+    encoder.reset()
+    assert encoder.encode(document(240.0, 1200, 2)) == document(240.0, 1200, 2)
@@ -0,0 +1,43 @@
+import pytest
+
+from downsampler import WindowDownsampler
+
+
+def test_a_field_is_averaged_over_the_records_that_have_it():
+    downsampler = WindowDownsampler()
+    downsampler.add({'a': 1})
+    downsampler.add({'a': 3, 'b': 5})
+
+    assert downsampler.emit() == {'a': 2, 'b': 5}
+
+
+def test_modes():
+    downsampler = WindowDownsampler({'pv': 'range', 'low': 'min', 'high': 'max', 'status': 'last'})
+    for pv, status in [(1000, 1), (200, 2), (1300, 3)]:
+        downsampler.add({'pv': pv, 'low': pv, 'high': pv, 'status': status, 'mean': pv, 'name': 'E5'})
+
+    assert downsampler.emit() == {'pv': 833.33, 'pv_min': 200, 'pv_max': 1300, 'low': 200, 'high': 1300, 'status': 3,
+                                  'mean': 833.33, 'name': 'E5'}
+
+
+def test_emit_starts_a_new_window():
+    downsampler = WindowDownsampler()
+    downsampler.add({'a': 10, 'b': 1})
+    downsampler.emit()
+    assert downsampler.emit() is None
+
+    downsampler.add({'a': 2})
+    assert len(downsampler) == 1
+    assert downsampler.emit() == {'a': 2}
+
+
+def test_booleans_are_not_averaged():
+    downsampler = WindowDownsampler()
+    downsampler.add({'charging': True})
+    downsampler.add({'charging': False})
+    assert downsampler.emit() == {'charging': False}
+
+
+def test_an_unknown_mode_is_refused():
+    with pytest.raises(ValueError):
+        WindowDownsampler({'a': 'median'})
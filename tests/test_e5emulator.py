@@ -0,0 +1,107 @@
+import os
+import struct
+from queue import Queue
+
+import pytest
+
+pytest.importorskip('minimalmodbus')
+
+from e5emulator import E5Emulator, crc16
+from modbusmethods import ModbusMethods
+
+
+def request(slave_id, function_code, address, value):
+    frame = struct.pack('>BBHH', slave_id, function_code, address, value)
+    return frame + crc16(frame)
+
+
+@pytest.fixture
+def emulator(tmp_path):
+    # Without a day log the emulator serves an idle system
+    emulator = E5Emulator(str(tmp_path / 'missing.csv'))
+    emulator._start_time = 0
+    return emulator
+
+
+def test_crc16():
+    # The example from the Modbus over serial line specification
+    assert crc16(bytes([0x02, 0x07])) == bytes([0x41, 0x12])
+
+
+def test_read_input_registers_follow_the_page_select(emulator):
+    emulator.rows[0]['ac1_voltage'] = 2400
+    emulator.rows[0]['ac2_voltage'] = 2410
+
+    response = emulator.handle_request(request(1, 4, 1056, 1))
+    assert response[:5] == bytes([1, 4, 2]) + struct.pack('>H', 2400)
+    assert crc16(response[:-2]) == response[-2:]
+
+    emulator.handle_request(request(1, 6, 799, 32))
+    assert emulator.handle_request(request(1, 4, 1056, 1))[3:5] == struct.pack('>H', 2410)
+
+
+def test_writing_the_operation_mode_is_mirrored(emulator):
+    assert emulator.handle_request(request(1, 6, 25626, 4)) == request(1, 6, 25626, 4)
+    assert emulator.current_registers()['inverter_op_mode'] == 3
+
+
+def test_the_modes_that_we_write_are_read_back(tmp_path):
+    emulator = E5Emulator(str(tmp_path / 'missing.csv'), baudrate=1000000)
+    port = emulator.start()
+    try:
+        modbus = ModbusMethods(Queue(), e5_port=port)
+
+        read_back = list()
+        for mode in ('CHARGE_FIRST_MODE', 'WITHOUTBTMODE', 'SELF_CONSUMPTION_MODE_INTERNAL'):
+            modbus.analyse_to_modbus_queue.put({'purpose': 'inverter_op_mode', 'inverter_op_mode': mode})
+            modbus.poll_scheduler.reset()
+            read_back.append(modbus.get_modbus_data().operation_mode)
+        modbus.E5.serial.close()
+    finally:
+        emulator.stop()
+
+    assert read_back == ['CHARGE_FIRST_MODE', 'WITHOUT_BT_MODE', 'SELF_CONSUMPTION_MODE_INTERNAL']
+
+
+def test_requests_for_other_slaves_are_ignored(emulator):
+    assert emulator.handle_request(request(2, 4, 1056, 1)) is None
+    assert emulator.request_count == 0
+
+
+def test_gaps_and_bad_requests(emulator):
+    assert emulator.handle_request(request(1, 4, 1, 1))[3:5] == b'\x00\x00'
+
+    emulator.reject_gaps = True
+    assert emulator.handle_request(request(1, 4, 1, 1))[:3] == bytes([1, 0x84, 2])
+    assert emulator.handle_request(request(1, 4, 1056, 200))[:3] == bytes([1, 0x84, 3])
+    assert emulator.handle_request(request(1, 16, 1056, 1))[:3] == bytes([1, 0x90, 1])
+
+
+def test_faults(emulator):
+    emulator.faults = {'timeout': 1}
+    assert emulator.handle_request(request(1, 4, 1056, 1)) is None
+
+    emulator.faults = {'crc': 1}
+    response = emulator.handle_request(request(1, 4, 1056, 1))
+    assert crc16(response[:-2]) != response[-2:]
+
+    emulator.faults = {'exception': 1}
+    assert emulator.handle_request(request(1, 4, 1056, 1))[:3] == bytes([1, 0x84, 4])
+    assert emulator.fault_count == 3
+
+
+def test_serves_requests_over_its_pty(tmp_path):
+    emulator = E5Emulator(str(tmp_path / 'missing.csv'), baudrate=1000000)
+    port = emulator.start()
+    try:
+        fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+        os.write(fd, request(1, 6, 25626, 2))
+
+        response = b''
+        while len(response) < 8:
+            response += os.read(fd, 8)
+        os.close(fd)
+
+        assert response == request(1, 6, 25626, 2)
+    finally:
+        emulator.stop()
@@ -0,0 +1,211 @@
+from deltaencoder import DeltaEncoder
+from firebaseoutbox import FirebaseOutbox, can_merge
+from firebaseuploader import FirebaseUploader, merge_writes
+
+from fakefirebase import FakeDatabase, apply_one_by_one
+
+LIVE = 'users/uid/live_database'
+
+
+def live_document(voltage, timestamp):
+    return {'inverter_data': {'AC1 Voltage': {'value': voltage, 'unit': 'V'},
+                              'DC1 Power': {'value': 1200, 'unit': 'W'}},
+            'timestamp': timestamp}
+
+
+def make_outbox(tmp_path):
+    outbox = FirebaseOutbox(str(tmp_path / 'outbox.sqlite'))
+    outbox.open()
+    return outbox
+
+
+def test_updates_to_different_keys_are_coalesced(tmp_path):
+    outbox = make_outbox(tmp_path)
+    outbox.add([('update', 'a', {'x': 1}), ('update', 'a', {'y': 2}), ('update', 'a', {'x': 3})])
+
+    writes, last_id = outbox.batch()
+    assert writes == [('update', 'a', {'x': 3, 'y': 2})]
+
+    outbox.discard(last_id)
+    assert outbox.pending == 0
+
+
+def test_a_write_that_overlaps_stops_earlier_updates_from_being_merged_into(tmp_path):
+    outbox = make_outbox(tmp_path)
+    outbox.add([('update', 'a/b', {'x': 1}), ('set', 'a', {'b': {'x': 2}}), ('update', 'a/b', {'x': 3})])
+
+    writes, _ = outbox.batch()
+    assert writes == [('update', 'a/b', {'x': 1}), ('set', 'a', {'b': {'x': 2}}), ('update', 'a/b', {'x': 3})]
+
+
+def test_can_merge():
+    assert can_merge({'inverter_data/AC1 Voltage/value': 1}, {'inverter_data/AC1 Voltage/value': 2})
+    assert can_merge({'inverter_data/AC1 Voltage/value': 1}, {'inverter_data/DC1 Power/value': 2, 'timestamp': 3})
+    assert not can_merge({'inverter_data': {}}, {'inverter_data/AC1 Voltage/value': 2})
+    assert not can_merge({'inverter_data/AC1 Voltage/value': 1}, {'inverter_data': {}})
+    assert not can_merge({'/inverter_data/': {}}, {'inverter_data/AC1 Voltage': {}})
+
+
+def test_keyframes_and_deltas_are_not_coalesced_together(tmp_path):
+    # A keyframe from the delta encoder is nested, and the deltas after it are flattened paths inside it. Merging them
+    # gave an update that Firebase rejects, so the replay failed for ever
+    encoder = DeltaEncoder({'AC1 Voltage': 0.5})
+    writes = [('update', LIVE, encoder.encode(live_document(240.0, 1))),
+              ('update', LIVE, encoder.encode(live_document(241.0, 2))),
+              ('update', LIVE, encoder.encode(live_document(242.0, 3)))]
+    encoder.reset()
+    writes.append(('update', LIVE, encoder.encode(live_document(243.0, 4))))
+
+    assert 'inverter_data' in writes[0][2] and 'inverter_data' in writes[3][2]
+    assert writes[1][2] == {'inverter_data/AC1 Voltage/value': 241.0, 'timestamp': 2}
+
+    outbox = make_outbox(tmp_path)
+    outbox.add(writes)
+    batch, _ = outbox.batch()
+
+    for _, _, data in batch:
+        assert can_merge({}, data)
+        keys = list(data)
+        assert all(can_merge({key: None}, {other: None}) for key in keys for other in keys if key != other)
+
+    # Both deltas coalesce, but neither keyframe can take them
+    assert len(batch) == 3
+
+    database = FakeDatabase()
+    for path, data, _ in merge_writes(batch):
+        database.child(path).update(data)
+    assert database.tree == apply_one_by_one(writes)
+    assert database.get(LIVE + '/inverter_data/AC1 Voltage/value') == 243.0
+
+
+def test_the_outbox_replays_keyframes_and_deltas(tmp_path):
+    database = FakeDatabase()
+    uploader = FirebaseUploader(database, lambda: 'token', outbox=make_outbox(tmp_path))
+
+    writes = [('update', LIVE, live_document(240.0, 1)),
+              ('update', LIVE, {'inverter_data/AC1 Voltage/value': 241.0, 'timestamp': 2}),
+              ('update', LIVE, live_document(242.0, 3)),
+              ('update', LIVE, {'inverter_data/AC1 Voltage/value': 243.0, 'timestamp': 4})]
+
+    # Lose our connection while sending, so everything ends up in the outbox
+    database.offline = True
+    uploader.send_writes(writes)
+    assert not uploader.online
+    assert uploader.outbox.pending == len(writes)
+
+    database.offline = False
+    uploader.resume()
+    uploader.replay()
+
+    assert uploader.outbox.pending == 0
+    assert uploader.online
+    assert database.tree == apply_one_by_one(writes)
+
+
+def test_writes_survive_a_restart(tmp_path):
+    outbox = make_outbox(tmp_path)
+    outbox.add([('update', 'a', {'x': 1}), ('remove', 'b', None)])
+    outbox.close()
+
+    outbox = make_outbox(tmp_path)
+    assert outbox.pending == 2
+    assert outbox.batch() == ([('update', 'a', {'x': 1}), ('remove', 'b', None)], 2)
+
+
+def test_batch_stops_at_max_writes(tmp_path):
+    outbox = make_outbox(tmp_path)
+    outbox.add([('set', 'a', 1), ('set', 'b', 2), ('set', 'c', 3)])
+
+    writes, last_id = outbox.batch(max_writes=2)
+    assert writes == [('set', 'a', 1), ('set', 'b', 2)]
+
+    outbox.discard(last_id)
+    assert outbox.pending == 1
+    assert outbox.batch()[0] == [('set', 'c', 3)]
+
+
+def test_writes_that_cant_be_saved_are_refused(tmp_path):
+    outbox = make_outbox(tmp_path)
+    assert not outbox.add([('set', 'a', object())])
+    assert outbox.pending == 0
+
+
+def test_new_writes_queue_behind_the_outbox(tmp_path):
+    database = FakeDatabase()
+    uploader = FirebaseUploader(database, lambda: 'token', outbox=make_outbox(tmp_path))
+    lost = list()
+    uploader.on_error = lambda: lost.append(True)
+
+    database.offline = True
+    uploader.send_writes([('set', 'status', 'charging')])
+    assert lost == [True]
+
+    # While we are offline, or there is anything left in the outbox, new writes go in behind the old ones
+    database.offline = False
+    uploader.journal([('set', 'status', 'stopped')])
+    uploader.resume()
+    uploader.replay()
+
+    assert database.get('status') == 'stopped'
+    assert uploader.stats()['replayed'] == 2
+
+
+def test_stop_journals_what_is_still_queued(tmp_path):
+    database = FakeDatabase()
+    database.offline = True
+    # The outbox is only used from the uploader's thread, so it opens it there
+    outbox = FirebaseOutbox(str(tmp_path / 'outbox.sqlite'))
+    uploader = FirebaseUploader(database, lambda: 'token', outbox=outbox)
+    uploader.start()
+    uploader.set('status', 'charging')
+    uploader.stop()
+
+    outbox = make_outbox(tmp_path)
+    assert outbox.batch()[0] == [('set', 'status', 'charging')]
+    assert database.requests == []
+
+
+def test_the_oldest_writes_are_dropped_when_the_outbox_is_full(tmp_path):
+    outbox = FirebaseOutbox(str(tmp_path / 'outbox.sqlite'), max_pending=3)
+    outbox.add([('set', 'a', 1), ('set', 'b', 2)])
+    outbox.add([('set', 'c', 3), ('set', 'd', 4), ('set', 'e', 5)])
+
+    assert outbox.pending == 3
+    assert outbox.dropped == 2
+    assert outbox.batch()[0] == [('set', 'c', 3), ('set', 'd', 4), ('set', 'e', 5)]
+
+
+def test_only_the_latest_dead_letters_are_kept(tmp_path):
+    outbox = FirebaseOutbox(str(tmp_path / 'outbox.sqlite'), max_dead_letters=2)
+    for i in range(3):
+        outbox.dead_letter(('set', 'a', i), 'Permission denied')
+
+    assert outbox.dead_letters() == [('set', 'a', 1, 'Permission denied'), ('set', 'a', 2, 'Permission denied')]
+    assert outbox.pending == 0
+
+
+def test_a_write_that_firebase_rejects_doesnt_hold_up_the_outbox(tmp_path):
+    database = FakeDatabase()
+    uploader = FirebaseUploader(database, lambda: 'token', outbox=make_outbox(tmp_path))
+    lost = list()
+    uploader.on_error = lambda: lost.append(True)
+
+    writes = [('set', 'status', 'charging'), ('set', 'users/other/status', 'charging'), ('set', 'status', 'stopped')]
+    database.offline = True
+    uploader.send_writes(writes)
+    assert lost == [True]
+
+    # A 401 may just be an expired idToken, so the first few go offline to get a new one before it is dead lettered
+    database.offline = False
+    database.forbidden.add('users/other')
+    for _ in range(uploader.max_auth_failures + 1):
+        uploader.resume()
+        uploader.replay()
+
+    assert len(lost) == 1 + uploader.max_auth_failures
+    assert uploader.outbox.pending == 0
+    assert uploader.online
+    assert database.get('status') == 'stopped'
+    assert database.get('users/other') is None
+    assert [letter[:3] for letter in uploader.outbox.dead_letters()] == [writes[1]]
+    assert uploader.stats()['rejected'] == 1
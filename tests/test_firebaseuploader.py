@@ -0,0 +1,117 @@
+import time
+
+from firebaseuploader import FirebaseUploader, merge_writes, rejected_status
+
+from fakefirebase import FakeDatabase, apply_one_by_one, rejected
+
+
+def send_merged(writes):
+    database = FakeDatabase()
+    for path, data, _ in merge_writes(writes):
+        database.child(path).update(data)
+    return database
+
+
+def test_a_write_whose_own_keys_overlap_is_split():
+    writes = [('update', 'live', {'inverter_data': {'AC1 Voltage': {'value': 240}},
+                                  'inverter_data/AC1 Voltage/value': 241})]
+
+    updates = merge_writes(writes)
+    assert [(path, data) for path, data, _ in updates] == [
+        ('live', {'inverter_data': {'AC1 Voltage': {'value': 240}}}),
+        ('live/inverter_data/AC1 Voltage', {'value': 241})]
+
+    # The write is covered by the last update that it is in, so it is only counted as sent once they all are
+    assert [covered for _, _, covered in updates] == [[], writes]
+    assert send_merged(writes).get('live/inverter_data/AC1 Voltage/value') == 241
+
+
+def test_writes_are_merged_under_their_common_path():
+    writes = [('update', 'users/uid/live_database', {'timestamp': 1}),
+              ('update', 'users/uid/history', {'-Key1': {'ac1p': 100}}),
+              ('set', 'users/uid/evc_inputs/charging', True)]
+
+    assert [(path, data) for path, data, _ in merge_writes(writes)] == [
+        ('users/uid', {'live_database/timestamp': 1, 'history/-Key1': {'ac1p': 100}, 'evc_inputs/charging': True})]
+    assert send_merged(writes).tree == apply_one_by_one(writes)
+
+
+def test_a_later_write_to_the_same_location_replaces_the_earlier_one():
+    writes = [('set', 'a/b', 1), ('update', 'a', {'b': 2, 'c': 3})]
+
+    assert [(path, data) for path, data, _ in merge_writes(writes)] == [('a', {'b': 2, 'c': 3})]
+
+
+def test_overlapping_writes_keep_their_order():
+    writes = [('update', 'a/b', {'x': 1}), ('remove', 'a', None), ('set', 'a/b/x', 2)]
+
+    updates = merge_writes(writes)
+    assert [(path, data) for path, data, _ in updates] == [('a/b', {'x': 1}), ('', {'a': None}), ('a/b', {'x': 2})]
+    assert [covered for _, _, covered in updates] == [[writes[0]], [writes[1]], [writes[2]]]
+    assert send_merged(writes).tree == apply_one_by_one(writes)
+
+
+def test_push_keys_sort_in_the_order_they_were_made():
+    uploader = FirebaseUploader(None, lambda: 'token')
+    keys = [uploader.push_key() for _ in range(1000)]
+
+    assert all(len(key) == 20 for key in keys)
+    assert sorted(keys) == keys
+    assert len(set(keys)) == len(keys)
+
+
+def test_each_tick_is_one_request():
+    database = FakeDatabase()
+    uploader = FirebaseUploader(database, lambda: 'token')
+    uploader.start()
+    try:
+        for i in range(5):
+            uploader.update('users/uid/live_database', {'timestamp': i})
+        uploader.push('users/uid/history', {'ac1p': 100})
+        uploader.tick()
+
+        deadline = time.monotonic() + 5
+        while uploader.stats()['sent'] < 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        uploader.stop()
+
+    assert uploader.stats()['requests'] == 1
+    assert database.get('users/uid/live_database/timestamp') == 4
+    assert list(database.get('users/uid/history').values()) == [{'ac1p': 100}]
+
+
+def test_the_oldest_writes_are_dropped_when_the_queue_is_full():
+    uploader = FirebaseUploader(FakeDatabase(), lambda: 'token', maxsize=2)
+    for i in range(3):
+        uploader.set('a', i)
+
+    assert list(uploader._queue) == [('set', 'a', 1), ('set', 'a', 2)]
+    assert uploader.stats()['dropped'] == 1
+
+
+def test_only_a_4xx_is_a_rejection():
+    assert rejected_status(rejected(400, 'Invalid data')) == 400
+    assert rejected_status(rejected(401, 'Permission denied')) == 401
+    assert rejected_status(rejected(429, 'Too many requests')) is None
+    assert rejected_status(rejected(503, 'Service unavailable')) is None
+    assert rejected_status(ConnectionError('Network is unreachable')) is None
+    assert rejected_status(TimeoutError()) is None
+
+
+def test_rejected_writes_are_left_out_and_we_stay_online():
+    database = FakeDatabase()
+    database.forbidden.add('users/other')
+    uploader = FirebaseUploader(database, lambda: 'token', max_auth_failures=0)
+    lost = list()
+    uploader.on_error = lambda: lost.append(True)
+
+    writes = [('update', 'users/uid/live_database', {'timestamp': 1}), ('set', 'users/other/status', 'charging'),
+              ('set', 'users/uid/status', 'charging')]
+    uploader.send_writes(writes)
+
+    # The merged update is rejected as a whole, so its writes are sent one at a time to find the one at fault
+    assert lost == []
+    assert database.get('users/uid') == {'live_database': {'timestamp': 1}, 'status': 'charging'}
+    assert uploader.stats()['sent'] == 2
+    assert uploader.stats()['rejected'] == 1
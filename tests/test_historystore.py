@@ -0,0 +1,60 @@
+import sqlite3
+from datetime import datetime
+
+from daystore import DAY_LOG_FIELDS
+from historystore import HistoryStore, CHARGE_SESSION_FIELDS, ANALYTICS_FIELDS
+
+
+def timestamp(day, hour=12):
+    return datetime(2019, 3, day, hour).timestamp()
+
+
+def count(path, table):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test_rows_are_buffered_until_a_commit_is_due(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    store = HistoryStore(path, commit_interval=3600)
+    store.connection()
+
+    store.insert_inverter_row(timestamp(1), [1.0] * len(DAY_LOG_FIELDS))
+    assert count(path, 'inverter_history') == 0
+
+    store.commit_interval = 0
+    store.commit_due()
+    assert count(path, 'inverter_history') == 1
+    assert store.connection().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_queries(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.sqlite'), commit_interval=0)
+    for day in (1, 2, 4):
+        store.insert_inverter_row(timestamp(day), [float(day)] * len(DAY_LOG_FIELDS))
+    store.insert_charge_session_row('MEL-ACMP', 'session1', timestamp(1), [1.0] * len(CHARGE_SESSION_FIELDS) + [9.0])
+    store.insert_charge_session_row('MEL-ACMP', 'session2', timestamp(3), [2.0] * len(CHARGE_SESSION_FIELDS))
+    store.insert_analytics_row(timestamp(2), [3.0] * len(ANALYTICS_FIELDS))
+
+    assert [row[1] for row in store.inverter_rows(timestamp(2))] == [2.0, 4.0]
+    assert [row[1] for row in store.inverter_rows(timestamp(1), timestamp(4))] == [1.0, 2.0]
+    assert store.inverter_days_since(timestamp(2, 0)) == {'2019-03-02', '2019-03-03', '2019-03-04'}
+    assert store.inverter_days_since(timestamp(5)) == set()
+
+    # Extra values on the end of a charging session row are ignored
+    assert store.charge_session_rows('MEL-ACMP', 'session1') == [(timestamp(1),) + (1.0,) * len(CHARGE_SESSION_FIELDS)]
+    assert store.charge_sessions_since(timestamp(2)) == {('MEL-ACMP', 'session2')}
+    assert len(store.analytics_rows(timestamp(1))) == 1
+
+
+def test_close_commits_what_is_left(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    store = HistoryStore(path, commit_interval=3600)
+    store.insert_analytics_row(timestamp(1), [1.0] * len(ANALYTICS_FIELDS))
+    store.close()
+
+    assert count(path, 'analytics') == 1
+    assert len(HistoryStore(path).analytics_rows(0)) == 1
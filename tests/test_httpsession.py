@@ -0,0 +1,52 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+import pytest
+
+from httpsession import PooledSession
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PATCH(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_requests_reuse_one_connection(server):
+    session = PooledSession()
+    for _ in range(10):
+        session.patch(server + 'live_database.json', data='{"a": 1}').raise_for_status()
+
+    stats = session.stats()
+    assert stats['requests'] == 10
+    assert stats['new_connections'] == 1
+    assert stats['reused'] == 0.9
+    assert stats['bytes_sent'] > 10 * len('{"a": 1}')
+
+
+def test_after_fork_starts_a_new_pool(server):
+    session = PooledSession()
+    session.patch(server, data='{}')
+    session.after_fork()
+    session.patch(server, data='{}')
+
+    assert session.stats()['new_connections'] == 2
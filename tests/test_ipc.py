@@ -0,0 +1,92 @@
+from multiprocessing import Process
+from queue import Empty
+
+import pytest
+
+from ipc import Channel, SampleRing, PUBLISH, LOSSLESS, LATEST, FIFO, wait
+from modbussample import ModbusSample
+
+
+def make_sample(time=0.0):
+    return ModbusSample(*([time] + [0] * (len(ModbusSample._fields) - 1)))
+
+
+def put_from_child(channel, items):
+    for item in items:
+        channel.put(item)
+
+
+def test_latest_keeps_only_the_newest_item():
+    channel = Channel(LATEST)
+    channel.put({'charger': 10})
+    channel.put({'charger': 12})
+
+    assert channel.get_nowait() == {'charger': 12}
+    with pytest.raises(Empty):
+        channel.get_nowait()
+    assert channel.stats()['dropped'] == 1
+
+
+def test_lossless_keeps_every_item_in_order():
+    # Analyse sends charge modes and stops down the same channel as charge rates, so none of them can be overwritten
+    channel = Channel(LOSSLESS)
+    messages = ['MAX_CHARGE_STANDALONE', {'charger': 10}, 'stop', {'charger': 12}]
+    for message in messages:
+        channel.put(message)
+
+    wait([channel], 1)
+    received = list()
+    while len(received) < len(messages):
+        received.append(channel.get(timeout=1))
+
+    assert received == messages
+    assert channel.stats()['dropped'] == 0
+
+
+def test_fifo_drops_the_oldest_items_when_full():
+    channel = Channel(FIFO, capacity=3)
+    for i in range(5):
+        channel.put(i)
+
+    assert channel.get_all() == [2, 3, 4]
+    assert channel.stats()['dropped'] == 2
+
+
+@pytest.mark.parametrize('policy', [FIFO, LOSSLESS])
+def test_items_cross_processes_and_wake_the_consumer(policy):
+    channel = Channel(policy, capacity=8)
+    child = Process(target=put_from_child, args=(channel, [1, 2, 3]))
+    child.start()
+    child.join(5)
+
+    assert wait([channel], 1) == [channel]
+    assert channel.get_all() == [1, 2, 3]
+
+
+def test_an_item_that_is_too_big_is_refused():
+    channel = Channel(LATEST, max_item_size=16)
+    with pytest.raises(ValueError):
+        channel.put('x' * 100)
+
+
+def test_ring_readers_only_see_samples_with_their_flags():
+    ring = SampleRing(capacity=8)
+    every_sample = ring.reader()
+    published = ring.reader(PUBLISH)
+
+    ring.put(make_sample(1.0), PUBLISH)
+    ring.put(make_sample(1.5))
+    ring.put(make_sample(2.0), PUBLISH)
+
+    assert [sample.time for sample in every_sample.get_all()] == [1.0, 1.5, 2.0]
+    assert [sample.time for sample in published.get_all()] == [1.0, 2.0]
+
+
+def test_a_reader_that_falls_behind_counts_what_it_missed():
+    ring = SampleRing(capacity=4)
+    reader = ring.reader()
+    for i in range(10):
+        ring.put(make_sample(float(i)))
+
+    assert [sample.time for sample in reader.get_all()] == [6.0, 7.0, 8.0, 9.0]
+    assert reader.dropped == 6
@@ -0,0 +1,102 @@
+import pytest
+
+import logwriter
+from logwriter import LogWriters
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(logwriter, 'time', clock)
+    return clock
+
+
+def read(path):
+    with open(str(path)) as file:
+        return file.read()
+
+
+def test_rows_are_flushed_after_flush_rows(tmp_path, clock):
+    path = tmp_path / 'day.csv'
+    writers = LogWriters(flush_rows=3, flush_interval=30, fsync=False)
+
+    writers.writerow('inverter', str(path), [1], header=['time'])
+    writers.writerow('inverter', str(path), [2], header=['time'])
+    assert read(path) == ''
+
+    writers.writerow('inverter', str(path), [3], header=['time'])
+    assert read(path) == 'time\n1\n2\n3\n'
+    writers.close()
+
+
+def test_rows_are_flushed_after_flush_interval(tmp_path, clock):
+    path = tmp_path / 'day.csv'
+    writers = LogWriters(flush_rows=100, flush_interval=30, fsync=False)
+
+    writers.writerow('inverter', str(path), [1])
+    clock.now += 29
+    writers.flush_due()
+    assert read(path) == ''
+
+    # A quiet stream is flushed by flush_due, and a busy one by the next row after the interval
+    clock.now += 1
+    writers.flush_due()
+    assert read(path) == '1\n'
+
+    writers.writerow('inverter', str(path), [2])
+    clock.now += 30
+    writers.writerow('inverter', str(path), [3])
+    assert read(path) == '1\n2\n3\n'
+    writers.close()
+
+
+def test_the_header_is_only_written_to_an_empty_file(tmp_path, clock):
+    path = tmp_path / 'day.csv'
+    path.write_text('time\n0\n')
+    writers = LogWriters(flush_rows=1, fsync=False)
+
+    writers.writerow('inverter', str(path), [1], header=['time'])
+    assert read(path) == 'time\n0\n1\n'
+    writers.close()
+
+
+def test_a_new_path_closes_the_old_file(tmp_path, clock):
+    writers = LogWriters(flush_rows=100, fsync=False)
+
+    writers.writerow('inverter', str(tmp_path / 'monday.csv'), ['mon'])
+    old_writer = writers._writers['inverter']
+    writers.writerow('inverter', str(tmp_path / 'tuesday.csv'), ['tue'])
+
+    # Yesterday's rows are flushed when its file is closed
+    assert old_writer._file.closed
+    assert read(tmp_path / 'monday.csv') == 'mon\n'
+    assert len(writers._writers) == 1
+    writers.close()
+    assert read(tmp_path / 'tuesday.csv') == 'tue\n'
+
+
+def test_the_least_recently_used_file_is_closed_past_max_open(tmp_path, clock):
+    writers = LogWriters(flush_rows=100, fsync=False, max_open=2)
+
+    writers.writerow('a', str(tmp_path / 'a.csv'), [1])
+    writers.writerow('b', str(tmp_path / 'b.csv'), [1])
+    writers.writerow('a', str(tmp_path / 'a.csv'), [2])
+    writers.writerow('c', str(tmp_path / 'c.csv'), [1])
+
+    assert list(writers._writers) == ['a', 'c']
+    assert read(tmp_path / 'b.csv') == '1\n'
+
+    # Going back to a closed stream opens its file again and appends to it
+    writers.writerow('b', str(tmp_path / 'b.csv'), [2])
+    assert list(writers._writers) == ['c', 'b']
+    writers.close()
+    assert read(tmp_path / 'a.csv') == '1\n2\n'
+    assert read(tmp_path / 'b.csv') == '1\n2\n'
@@ -0,0 +1,39 @@
+import random
+
+import numpy as np
+import pytest
+
+from analysemethods import RollingWindowStats
+
+
+def weighted_average(values, window_size, damping_factor):
+    # The newest value has a weight of d, the one before it d * (1 - d) and so on
+    weights = [damping_factor * (1 - damping_factor) ** (window_size - 1 - i) for i in range(window_size)]
+    return float(np.dot(values, weights[window_size - len(values):]))
+
+
+@pytest.mark.parametrize('window_size', [1, 2, 8])
+def test_matches_recomputing_the_window(window_size):
+    random.seed(window_size)
+    stats = RollingWindowStats(window_size, damping_factor=0.6)
+    values = list()
+
+    for _ in range(2000):
+        value = random.choice([0.01, random.uniform(0, 5000)])
+        stats.append(value)
+        values = (values + [value])[-window_size:]
+
+        assert list(stats) == values
+        assert stats.mean() == pytest.approx(np.mean(values))
+        assert stats.stdev() == pytest.approx(np.std(values, ddof=1) if len(values) > 1 else 0.0, abs=1e-6)
+        assert stats.weighted_average() == pytest.approx(weighted_average(values, window_size, 0.6), abs=1e-6)
+
+
+def test_a_window_of_the_same_value_has_no_deviation():
+    # Analyse divides by the mean and takes the log of sd / mean, so a constant window has to give exactly 0
+    stats = RollingWindowStats(8)
+    for value in [1234.5, 17.25, 999.0] + [0.01] * 8:
+        stats.append(value)
+
+    assert stats.mean() == 0.01
+    assert stats.stdev() == 0.0
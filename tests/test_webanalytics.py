@@ -0,0 +1,153 @@
+import csv
+import json
+import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from logwriter import LogWriters
+from webanalyticsmethods import WebAnalyticsMethods
+
+HEADER = ['time', 'ac1p', 'ac1v', 'ac1c', 'ac2p', 'ac2v', 'ac2c', 'dc1p', 'dc1v', 'dc1c', 'dc2p', 'dc2v', 'dc2c', 'btp',
+          'btv', 'btc', 'btsoc', 'utility_p', 'utility_c', 'bt_module1_max_temp', 'bt_module1_min_temp', 'ac1_freq']
+
+# 3600 W for a 2 second row is 2 Wh
+ROW_KWH = 0.002
+
+
+@pytest.fixture
+def day_log(tmp_path, monkeypatch):
+    """ Runs in a directory next to data/logs, the way that deltasolarcharger does, and returns today's day log """
+    (tmp_path / 'run').mkdir()
+    (tmp_path / 'data' / 'logs').mkdir(parents=True)
+    monkeypatch.chdir(str(tmp_path / 'run'))
+    return str(tmp_path / 'data' / 'logs' / (datetime.now().strftime('%Y-%m-%d') + '.csv'))
+
+
+def row_time(i):
+    return datetime.now().replace(hour=12, minute=0, second=0, microsecond=0) + timedelta(seconds=2 * i)
+
+
+def day_log_row(i):
+    row = [str(row_time(i))] + [0] * (len(HEADER) - 1)
+    row[HEADER.index('dc1p')] = 3600
+    return row
+
+
+def log_row(writers, day_log, i):
+    writers.writerow('inverter_data', day_log, day_log_row(i), header=HEADER)
+
+
+def write_day_log(day_log, rows):
+    """ Writes a day log of rows 0 to rows - 1, and returns the size of the file after each row """
+    sizes = list()
+    with open(day_log, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for i in range(rows):
+            writer.writerow(day_log_row(i))
+            f.flush()
+            sizes.append(os.path.getsize(day_log))
+    return sizes
+
+
+def write_checkpoint(date, offset, last_time, dcp_t):
+    totals = WebAnalyticsMethods.blank_analytics_data()
+    totals['dcp_t'] = dcp_t
+    os.makedirs(os.path.dirname(WebAnalyticsMethods._CHECKPOINT_PATH), exist_ok=True)
+    with open(WebAnalyticsMethods._CHECKPOINT_PATH, 'w') as f:
+        json.dump({'date': date, 'offset': offset, 'last_time': last_time, 'totals': totals}, f)
+
+
+def analyse(csv_rewritten=False):
+    analytics = WebAnalyticsMethods()
+    analytics._csv_rewritten = csv_rewritten
+    analytics.analyse_todays_history()
+    return analytics.current_analytics_data['dcp_t']
+
+
+def sample(i):
+    return SimpleNamespace(time=row_time(i).timestamp(), dc1_power=3600, dc2_power=0, ac2_power=0, utility_power=0,
+                           bt_wattage=0)
+
+
+def test_rows_still_buffered_at_a_checkpoint_are_not_counted_twice(day_log):
+    writers = LogWriters(flush_rows=15, flush_interval=30, fsync=False)
+    analytics = WebAnalyticsMethods()
+    analytics.analyse_todays_history()
+
+    # Every sample is logged and integrated. When we checkpoint, the last 5 rows are still in the writer's buffer
+    for i in range(20):
+        log_row(writers, day_log, i)
+        analytics.update_analytics(sample(i))
+    analytics.save_analytics_checkpoint()
+    counted = analytics.current_analytics_data['dcp_t']
+
+    # We stop before integrating the last 3 rows, and the buffered rows reach the file when the log is closed
+    for i in range(20, 23):
+        log_row(writers, day_log, i)
+    writers.close()
+
+    restarted = WebAnalyticsMethods()
+    restarted.analyse_todays_history()
+    assert restarted.current_analytics_data['dcp_t'] == pytest.approx(counted + 3 * ROW_KWH)
+
+
+def test_a_saved_checkpoint_loads(day_log):
+    sizes = write_day_log(day_log, 3)
+    analytics = WebAnalyticsMethods()
+    analytics.analyse_todays_history()
+
+    checkpoint = analytics.load_analytics_checkpoint()
+    assert checkpoint['date'] == datetime.now().strftime('%Y-%m-%d')
+    assert checkpoint['offset'] == sizes[-1]
+    assert checkpoint['last_time'] == str(row_time(2))
+    assert checkpoint['totals']['dcp_t'] == pytest.approx(3 * ROW_KWH)
+
+
+def test_checkpoints_that_cant_be_used_are_ignored(day_log):
+    analytics = WebAnalyticsMethods()
+    os.makedirs(os.path.dirname(analytics._CHECKPOINT_PATH))
+
+    with open(analytics._CHECKPOINT_PATH, 'w') as f:
+        f.write('{"date": ')
+    assert analytics.load_analytics_checkpoint() is None
+
+    # A checkpoint from before we kept last_time can't tell which rows after its offset were counted
+    with open(analytics._CHECKPOINT_PATH, 'w') as f:
+        json.dump({'date': datetime.now().strftime('%Y-%m-%d'), 'offset': 0, 'totals': {}}, f)
+    assert analytics.load_analytics_checkpoint() is None
+
+
+def test_a_restart_only_integrates_what_comes_after_the_checkpoint(day_log):
+    sizes = write_day_log(day_log, 10)
+
+    # Rows 0 to 5 are before the offset, and the checkpoint counted up to row 3
+    write_checkpoint(datetime.now().strftime('%Y-%m-%d'), sizes[5], str(row_time(3)), 1.0)
+    assert analyse() == pytest.approx(1.0 + 4 * ROW_KWH)
+
+    # That restart saved a checkpoint of its own, so another one has nothing to add
+    assert analyse() == pytest.approx(1.0 + 4 * ROW_KWH)
+
+
+def test_a_rewritten_csv_is_read_from_the_start(day_log):
+    sizes = write_day_log(day_log, 10)
+    write_checkpoint(datetime.now().strftime('%Y-%m-%d'), sizes[5], str(row_time(3)), 1.0)
+
+    assert analyse(csv_rewritten=True) == pytest.approx(1.0 + 6 * ROW_KWH)
+
+
+def test_an_offset_past_the_end_of_the_csv_is_read_from_the_start(day_log):
+    sizes = write_day_log(day_log, 10)
+    write_checkpoint(datetime.now().strftime('%Y-%m-%d'), sizes[-1] + 100, str(row_time(3)), 1.0)
+
+    assert analyse() == pytest.approx(1.0 + 6 * ROW_KWH)
+
+
+def test_a_checkpoint_from_another_day_is_not_used(day_log):
+    sizes = write_day_log(day_log, 10)
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    write_checkpoint(yesterday, sizes[5], str(row_time(3)), 1.0)
+
+    assert analyse() == pytest.approx(10 * ROW_KWH)